@@ -0,0 +1,308 @@
+"""
+Contains a computer opponent for Hasami Shogi.
+Searches the game tree with negamax alpha-beta and iterative deepening,
+playing the best move found within a fixed time budget per move.
+"""
+import math
+import time
+from collections import namedtuple
+
+import variants
+from bitboard import BitboardRules
+from rules import Rules
+from transposition import EXACT, LOWER, UPPER, TranspositionTable
+
+# the outcome of a search. score is from the point of view of the side to move
+SearchResult = namedtuple("SearchResult", "move score depth nodes elapsed nps")
+
+
+class SearchTimeout(Exception):
+    """
+    Raised inside the search when the time budget for the move runs out.
+    """
+
+
+def opponent_of(player):
+    """
+    Returns the other player.
+    """
+    if player == "BLACK":
+        return "RED"
+    return "BLACK"
+
+
+class AlphaBeta:
+    """
+    A negamax alpha-beta searcher.
+
+    Deepens one ply at a time until time_limit seconds have passed and plays
+    the best move of the deepest search that finished. Moves are tried in the
+    order: transposition table move, captures, killer moves, then the rest by
+    history score, which makes the cutoffs come early.
+
+    Positions are evaluated as material (from the pieces remaining) plus
+    mobility (the number of legal moves each side has). Positions covered by
+    tablebases (a tablebase.TablebaseSet) get their exact result instead,
+    and positions in book (a book.OpeningBook) are played from the book
+    without searching.
+
+    Variant 1 on the 9x9 board is searched with bitboard.BitboardRules;
+    other variants with a rules.Rules copy, which handles any variant.
+    """
+    WIN_SCORE = 100000
+    # scores further from zero than this are wins or losses some plies away,
+    # well beyond anything evaluate returns
+    WIN_BOUND = WIN_SCORE - 10000
+    PIECE_VALUE = 100
+    MOBILITY_VALUE = 1
+    # how many nodes to search between checks of the clock
+    CHECK_EVERY = 1024
+
+    def __init__(self, time_limit=1.0, max_depth=32, tt_megabytes=16, tablebases=None, book=None):
+        self.time_limit = time_limit
+        self.tablebases = tablebases
+        self.book = book
+        self.max_depth = max_depth
+        self.table = TranspositionTable(tt_megabytes)
+        self.nodes = 0
+        self._deadline = None
+        self._stop = None
+        self._killers = []
+        self._history = {}
+
+    def search(self, game, info=None, stop=None):
+        """
+        Searches the position in game and returns a SearchResult.
+        game can be any rules object; the search runs on its own copy
+        so game itself is left untouched.
+
+        info, if given, is called as info(result, line) after each depth
+        finishes, with that depth's SearchResult and its principal variation
+        (the list of moves both sides are expected to play). stop, if given,
+        is called every CHECK_EVERY nodes and ends the search as soon as it
+        returns True. With time_limit None the search only ends at max_depth
+        or when stopped.
+        """
+        if self.book is not None:
+            entry = self.book.choose(game)
+            if entry is not None and entry.move[1] in game.test_move(entry.move[0]):
+                return SearchResult(entry.move, entry.score, 0, 0, 0.0, 0.0)
+
+        if game.VARIANT == variants.STANDARD:
+            position = BitboardRules()
+        else:
+            position = Rules(game.VARIANT)
+        position.set_position(game.board, game.get_active_player())
+
+        start = time.perf_counter()
+        self._deadline = math.inf if self.time_limit is None else start + self.time_limit
+        self._stop = stop
+        self.nodes = 0
+        self._killers = [[None, None] for _ in range(self.max_depth + 1)]
+        self._history = {}
+        self.table.new_search()
+
+        player = position.get_active_player()
+        best = SearchResult(None, 0, 0, 0, 0.0, 0.0)
+        for depth in range(1, self.max_depth + 1):
+            try:
+                score, move = self._root(position, depth, player)
+            except SearchTimeout:
+                break
+            elapsed = time.perf_counter() - start
+            best = SearchResult(move, score, depth, self.nodes, elapsed, self.nodes / max(elapsed, 1e-9))
+            if info is not None:
+                info(best, self.principal_variation(position, depth))
+            # no point searching deeper once the game is decided
+            if move is None or abs(score) >= self.WIN_SCORE - self.max_depth:
+                break
+
+        if best.move is None:
+            # out of time before depth 1 finished; play any legal move
+            move = next(position.legal_moves(), None)
+            best = best._replace(move=move)
+
+        elapsed = time.perf_counter() - start
+        return best._replace(nodes=self.nodes, elapsed=elapsed, nps=self.nodes / max(elapsed, 1e-9))
+
+    def principal_variation(self, game, length):
+        """
+        Returns the best line from the position in game, up to length moves,
+        by following the best moves stored in the transposition table.
+        """
+        line = []
+        undos = []
+        seen = set()
+        while len(line) < length and not game.winner and game.key not in seen:
+            seen.add(game.key)
+            entry = self.table.probe(game.key)
+            if entry is None or entry.move is None:
+                break
+            origin, destination = entry.move
+            # a key collision could hand back a move from another position
+            if game.board.get(origin) != game.get_active_player() or \
+               destination not in game.test_move(origin):
+                break
+            line.append(entry.move)
+            undos.append(game.make_move(origin, destination))
+        for undo in reversed(undos):
+            game.unmake_move(undo)
+        return line
+
+    def evaluate(self, game, player):
+        """
+        Returns the score of the position for player:
+        material first, then mobility.
+        """
+        opponent = opponent_of(player)
+        material = game.get_pieces_remaining(player) - game.get_pieces_remaining(opponent)
+        mobility = game.count_moves(player) - game.count_moves(opponent)
+        return material * self.PIECE_VALUE + mobility * self.MOBILITY_VALUE
+
+    def _to_table(self, score, ply):
+        """
+        Returns score as stored in the transposition table. A win or loss is
+        scored by how far it is from the root, but the same position can be
+        reached at other plies, so it is stored as its distance from here.
+        """
+        if score > self.WIN_BOUND:
+            return score + ply
+        if score < -self.WIN_BOUND:
+            return score - ply
+        return score
+
+    def _from_table(self, score, ply):
+        """
+        Returns a score read from the transposition table at ply, undoing _to_table.
+        """
+        if score > self.WIN_BOUND:
+            return score - ply
+        if score < -self.WIN_BOUND:
+            return score + ply
+        return score
+
+    def _root(self, game, depth, player):
+        """
+        Searches every root move to depth and returns (score, best move).
+        """
+        alpha, beta = -self.WIN_SCORE - 1, self.WIN_SCORE + 1
+        best_move = None
+        entry = self.table.probe(game.key)
+        for move in self._order_moves(game, 0, entry.move if entry else None):
+            undo = game.make_move(*move)
+            try:
+                score = -self._negamax(game, depth - 1, -beta, -alpha, 1, opponent_of(player))
+            finally:
+                game.unmake_move(undo)
+            if score > alpha:
+                alpha, best_move = score, move
+
+        self.table.store(game.key, depth, alpha, EXACT, best_move)
+        return alpha, best_move
+
+    def _negamax(self, game, depth, alpha, beta, ply, player):
+        """
+        Returns the score of the position for player, the side to move.
+        """
+        self.nodes += 1
+        if not self.nodes % self.CHECK_EVERY:
+            if time.perf_counter() > self._deadline or (self._stop is not None and self._stop()):
+                raise SearchTimeout
+
+        if game.winner:
+            # prefer quicker wins and slower losses
+            if game.winner == player:
+                return self.WIN_SCORE - ply
+            return -self.WIN_SCORE + ply
+
+        if self.tablebases is not None:
+            hit = self.tablebases.probe(game)
+            if hit is not None:
+                if hit.winner is None:
+                    return 0
+                # scored like a win or loss found by searching, hit.plies further on
+                if hit.winner == player:
+                    return self.WIN_SCORE - ply - hit.plies
+                return -self.WIN_SCORE + ply + hit.plies
+
+        if depth <= 0 or ply >= self.max_depth:
+            return self.evaluate(game, player)
+
+        original_alpha = alpha
+        entry = self.table.probe(game.key)
+        tt_move = None
+        if entry is not None:
+            tt_move = entry.move
+            if entry.depth >= depth:
+                value = self._from_table(entry.value, ply)
+                if entry.flag == EXACT:
+                    return value
+                if entry.flag == LOWER:
+                    alpha = max(alpha, value)
+                elif entry.flag == UPPER:
+                    beta = min(beta, value)
+                if alpha >= beta:
+                    return value
+
+        best_score = -self.WIN_SCORE - 1
+        best_move = None
+        searched = False
+        for move, captures in self._order_moves(game, ply, tt_move, with_captures=True):
+            searched = True
+            undo = game.make_move(*move)
+            try:
+                score = -self._negamax(game, depth - 1, -beta, -alpha, ply + 1, opponent_of(player))
+            finally:
+                game.unmake_move(undo)
+
+            if score > best_score:
+                best_score, best_move = score, move
+            if score > alpha:
+                alpha = score
+            if alpha >= beta:
+                if not captures:
+                    # remember quiet moves that caused a cutoff
+                    killers = self._killers[ply]
+                    if move != killers[0]:
+                        killers[1], killers[0] = killers[0], move
+                    self._history[move] = self._history.get(move, 0) + depth * depth
+                break
+
+        if not searched:
+            # no legal moves: treat being stuck as a loss
+            return -self.WIN_SCORE + ply
+
+        if best_score <= original_alpha:
+            flag = UPPER
+        elif best_score >= beta:
+            flag = LOWER
+        else:
+            flag = EXACT
+        self.table.store(game.key, depth, self._to_table(best_score, ply), flag, best_move)
+        return best_score
+
+    def _order_moves(self, game, ply, tt_move, with_captures=False):
+        """
+        Returns the legal moves in the order they should be searched.
+        With with_captures, returns (move, captures) pairs instead,
+        where captures is how many pawns the move captures.
+        """
+        killers = self._killers[ply] if ply < len(self._killers) else ()
+        history = self._history
+        scored = []
+        for move in game.legal_moves():
+            captures = len(game.preview_captures(*move))
+            if move == tt_move:
+                score = 1 << 30
+            elif captures:
+                score = (1 << 20) + captures
+            elif move in killers:
+                score = 1 << 16
+            else:
+                score = history.get(move, 0)
+            scored.append( (score, move, captures) )
+
+        scored.sort(key=lambda item: item[0], reverse=True)
+        if with_captures:
+            return [(move, captures) for _, move, captures in scored]
+        return [move for _, move, _ in scored]
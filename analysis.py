@@ -0,0 +1,130 @@
+"""
+Contains a background analyser for the game window.
+
+The analyser searches the position on the board in a separate process, so
+the search never holds up the window's main loop (a thread would share the
+interpreter lock with it). The search runs without a time limit, deepening
+until it is cancelled or given a new position, and sends its best line
+after every depth it finishes. The window polls for the newest line at most
+rate times a second.
+
+Cancelling only sets a shared job number, which the search checks every
+AlphaBeta.CHECK_EVERY nodes, so the worker drops an old position within a
+few milliseconds and the process is kept for the next one.
+"""
+import multiprocessing
+import queue
+import time
+from collections import namedtuple
+
+# a finished depth of the search for job. line is the principal variation,
+# starting with the best move; score is for the side to move
+Analysis = namedtuple("Analysis", "job depth score line nodes nps")
+
+
+def _worker(jobs, results, current):
+    """
+    Runs in the analysis process: searches each position put on jobs until
+    current stops naming its job, and puts every finished depth on results.
+    """
+    from ai import AlphaBeta
+    from rules import Rules
+
+    searcher = AlphaBeta(time_limit=None)
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        number, variant, board, player = job
+        if current.value != number:
+            # cancelled before it started
+            continue
+        game = Rules(variant)
+        game.set_position(board, player)
+
+        def info(result, line):
+            results.put(Analysis(number, result.depth, result.score, line, result.nodes, result.nps))
+
+        searcher.search(game, info=info, stop=lambda: current.value != number)
+
+
+class Analyser:
+    """
+    Analyses positions in the background for the game window.
+    """
+    def __init__(self, rate=4):
+        # most results handed out by poll per second
+        self.interval = 1 / rate
+        self._context = multiprocessing.get_context()
+        self._jobs = self._context.Queue()
+        self._results = self._context.Queue()
+        # number of the job being searched, 0 for none
+        self._current = self._context.RawValue("i", 0)
+        self._process = None
+        self._job = 0
+        self._latest = None
+        self._shown = None
+        self._last_poll = 0.0
+
+    @property
+    def active(self):
+        """
+        True while a position is being analysed.
+        """
+        return self._current.value != 0
+
+    def start(self, game):
+        """
+        Starts analysing the position in a rules object, dropping the last one.
+        """
+        if self._process is None:
+            self._process = self._context.Process(target=_worker, daemon=True,
+                                                  args=(self._jobs, self._results, self._current))
+            self._process.start()
+        self._job += 1
+        self._current.value = self._job
+        self._latest = None
+        self._shown = None
+        self._jobs.put( (self._job, game.VARIANT, dict(game.board), game.get_active_player()) )
+
+    def cancel(self):
+        """
+        Stops the analysis. The worker gives up its search straight away.
+        """
+        self._current.value = 0
+        self._latest = None
+        self._shown = None
+
+    def poll(self):
+        """
+        Returns the newest Analysis of the current position if there is one
+        that hasn't been returned yet and the last was at least interval
+        seconds ago; otherwise None.
+        """
+        while True:
+            try:
+                result = self._results.get_nowait()
+            except queue.Empty:
+                break
+            # results of older jobs can still be queued
+            if result.job == self._current.value:
+                self._latest = result
+
+        now = time.perf_counter()
+        if self._latest is None or self._latest is self._shown or now - self._last_poll < self.interval:
+            return None
+        self._last_poll = now
+        self._shown = self._latest
+        return self._latest
+
+    def close(self):
+        """
+        Stops the analysis process.
+        """
+        self.cancel()
+        if self._process is not None:
+            self._jobs.put(None)
+            self._process.join(1)
+            if self._process.is_alive():
+                self._process.terminate()
+            self._process = None
@@ -0,0 +1,247 @@
+"""
+Contains a batch simulator that plays thousands of games of Hasami Shogi at
+once using NumPy, for training and statistics.
+All the boards live in one (games, rows, cols) array and every step works out
+the legal moves, applies one move and resolves the custodian and corner
+captures for every game in the batch with whole-array operations.
+
+The results are the same as playing each game through rules.Rules.
+NumPy is only needed by this module:
+
+    pip install numpy
+"""
+import numpy as np
+
+import tables
+
+# square contents. OFF_BOARD only appears in the padded copies used for captures
+EMPTY, BLACK, RED, OFF_BOARD = 0, 1, 2, 3
+COLORS = {BLACK: "BLACK", RED: "RED"}
+# row and column steps for up, down, left, right, as in tables.DIRECTIONS
+DIRECTION_STEPS = np.array([(dy, dx) for dx, dy in tables.DIRECTIONS])
+
+
+class BatchSimulator:
+    """
+    Plays a batch of games side by side.
+
+    boards: (games, rows, cols) int8 array, indexed [game, y, x]
+    active: (games,) array of BLACK or RED, whose turn it is
+    remaining: (games, 3) array of pieces left, indexed by BLACK or RED
+    winner: (games,) array of BLACK, RED or EMPTY for unfinished games
+    stuck: (games,) bool array of games where the side to move had no move
+    plies: (games,) number of moves played in each game
+    """
+    def __init__(self, games, rows=9, cols=9, seed=None):
+        self.games = games
+        self.rows = rows
+        self.cols = cols
+        # the longest possible slide, and so the padding needed around boards
+        self.reach = max(rows, cols) - 1
+        self.rng = np.random.default_rng(seed)
+
+        # corner capture lookups: for each destination square the partner square
+        # and the corner square, or -1 for squares that aren't next to a corner
+        self._corner_partner = np.full( (rows, cols, 2), -1, dtype=np.int64)
+        self._corner = np.full( (rows, cols, 2), -1, dtype=np.int64)
+        for (x, y), ( (px, py), (cx, cy) ) in tables.get_tables(rows, cols).corner_caps.items():
+            self._corner_partner[y, x] = (py, px)
+            self._corner[y, x] = (cy, cx)
+
+        self.reset()
+
+    def reset(self):
+        """
+        Puts every game back to the starting position.
+        """
+        self.boards = np.zeros( (self.games, self.rows, self.cols), dtype=np.int8)
+        self.boards[:, 0, :] = RED
+        self.boards[:, -1, :] = BLACK
+        self.active = np.full(self.games, BLACK, dtype=np.int8)
+        self.remaining = np.zeros( (self.games, 3), dtype=np.int16)
+        self.remaining[:, BLACK] = self.cols
+        self.remaining[:, RED] = self.cols
+        self.winner = np.zeros(self.games, dtype=np.int8)
+        self.stuck = np.zeros(self.games, dtype=bool)
+        self.plies = np.zeros(self.games, dtype=np.int32)
+
+    @property
+    def finished(self):
+        """
+        Bool array of the games that are over.
+        """
+        return (self.winner != EMPTY) | self.stuck
+
+    def slide_lengths(self):
+        """
+        Returns a (games, 4, rows, cols) int8 array where [game, direction, y, x]
+        is how many squares the active player's pawn on (x, y) can slide in that
+        direction (0 for squares without one). Finished games have no moves.
+        """
+        games, rows, cols, reach = self.games, self.rows, self.cols, self.reach
+        empty = np.zeros( (games, rows + 2 * reach, cols + 2 * reach), dtype=bool)
+        empty[:, reach:reach + rows, reach:reach + cols] = self.boards == EMPTY
+
+        own = (self.boards == self.active[:, None, None]) & ~self.finished[:, None, None]
+        lengths = np.zeros( (games, 4, rows, cols), dtype=np.int8)
+        for direction, (dy, dx) in enumerate(DIRECTION_STEPS):
+            moving = own
+            for k in range(1, reach + 1):
+                # a pawn can slide k squares if it could slide k - 1 and square k is empty
+                top, left = reach + dy * k, reach + dx * k
+                moving = moving & empty[:, top:top + rows, left:left + cols]
+                if not moving.any():
+                    break
+                lengths[:, direction] += moving
+        return lengths
+
+    def legal_move_masks(self, lengths=None):
+        """
+        Returns a (games, 4, reach, rows, cols) bool array where
+        [game, direction, k - 1, y, x] is True when the active player's pawn on
+        (x, y) can slide k squares in that direction.
+        """
+        if lengths is None:
+            lengths = self.slide_lengths()
+        k = np.arange(1, self.reach + 1).reshape(1, 1, -1, 1, 1)
+        return lengths[:, :, None] >= k
+
+    def random_moves(self, lengths=None):
+        """
+        Picks a uniformly random legal move in every game.
+        Returns (origins, destinations, has_move) where origins and destinations
+        are (games, 2) arrays of (y, x) and has_move marks games that had a move.
+        """
+        if lengths is None:
+            lengths = self.slide_lengths()
+        flat = lengths.reshape(self.games, -1)
+        running = np.cumsum(flat, axis=1, dtype=np.int16)
+        counts = running[:, -1]
+        has_move = counts > 0
+
+        # choose the n'th legal move of each game for a random n below its move count:
+        # find the (direction, square) it falls in, then how far along that slide it is
+        choice = (self.rng.random(self.games) * counts).astype(np.int16)
+        cell = np.argmax(running > choice[:, None], axis=1)
+        row = np.arange(self.games)
+        k = choice - (running[row, cell] - flat[row, cell])
+        index = np.ravel_multi_index( (cell // (self.rows * self.cols), k,
+                                       cell % (self.rows * self.cols)),
+                                      (4, self.reach, self.rows * self.cols))
+        return self._decode(index) + (has_move,)
+
+    def _decode(self, index):
+        """
+        Turns flat legal_move_masks indices into (origins, destinations) arrays.
+        """
+        direction, k, y, x = np.unravel_index(index, (4, self.reach, self.rows, self.cols))
+        origins = np.stack( (y, x), axis=1)
+        destinations = origins + DIRECTION_STEPS[direction] * (k + 1)[:, None]
+        return origins, destinations
+
+    def apply_moves(self, origins, destinations, moving):
+        """
+        Makes the move from origins to destinations ((games, 2) arrays of (y, x))
+        in every game where moving is True, resolves captures and updates the
+        pieces remaining, winners and turns.
+        Returns a (games, rows, cols) bool array of the captured squares.
+        """
+        games = np.flatnonzero(moving)
+        active = self.active[games]
+        oy, ox = origins[games, 0], origins[games, 1]
+        dy, dx = destinations[games, 0], destinations[games, 1]
+        self.boards[games, oy, ox] = EMPTY
+        self.boards[games, dy, dx] = active
+
+        captured = np.zeros_like(self.boards, dtype=bool)
+        captured[games] = self._captures(games, dy, dx, active)
+        self.boards[captured] = EMPTY
+
+        # captured pieces always belong to the player who didn't move
+        opponent = np.where(self.active == BLACK, RED, BLACK)
+        lost = captured.sum(axis=(1, 2))
+        self.remaining[np.arange(self.games), opponent] -= lost.astype(np.int16)
+        self.plies[games] += 1
+
+        # same order as Rules._update_turn: black running out is checked first,
+        # and the turn doesn't pass once black has lost
+        black_lost = moving & (self.remaining[:, BLACK] < 2)
+        red_lost = moving & ~black_lost & (self.remaining[:, RED] < 2)
+        self.winner[black_lost] = RED
+        self.winner[red_lost] = BLACK
+        switch = moving & ~black_lost
+        self.active[switch] = opponent[switch]
+        return captured
+
+    def _captures(self, games, dy, dx, active):
+        """
+        Returns a (len(games), rows, cols) bool array of the pawns captured by
+        active's pawns that just moved onto (dx, dy) in each of games.
+        """
+        rows, cols, reach = self.rows, self.cols, self.reach
+        count = len(games)
+        opponent = np.where(active == BLACK, RED, BLACK)
+        # pad with OFF_BOARD so runs stop at the edge without bounds checks
+        padded = np.full( (count, rows + 2 * reach, cols + 2 * reach), OFF_BOARD, dtype=np.int8)
+        padded[:, reach:reach + rows, reach:reach + cols] = self.boards[games]
+        row = np.arange(count)
+        captured = np.zeros( (count, rows, cols), dtype=bool)
+
+        for step_y, step_x in DIRECTION_STEPS:
+            # length of the run of opponent pawns closed off by one of active's pawns
+            run = np.zeros(count, dtype=np.int64)
+            open_run = np.ones(count, dtype=bool)
+            for k in range(1, reach + 1):
+                square = padded[row, reach + dy + step_y * k, reach + dx + step_x * k]
+                closes = open_run & (k > 1) & (square == active)
+                run[closes] = k - 1
+                open_run &= square == opponent
+                if not open_run.any():
+                    break
+            for k in range(1, int(run.max(initial=0)) + 1):
+                hit = run >= k
+                captured[row[hit], dy[hit] + step_y * k, dx[hit] + step_x * k] = True
+
+        # corner captures
+        partner = self._corner_partner[dy, dx]
+        corner = self._corner[dy, dx]
+        near_corner = partner[:, 0] >= 0
+        hit = near_corner.copy()
+        hit[near_corner] = (
+            (self.boards[games[near_corner], partner[near_corner, 0], partner[near_corner, 1]]
+             == active[near_corner])
+            & (self.boards[games[near_corner], corner[near_corner, 0], corner[near_corner, 1]]
+               == opponent[near_corner]))
+        captured[row[hit], corner[hit, 0], corner[hit, 1]] = True
+        return captured
+
+    def step(self, policy=None):
+        """
+        Plays one move in every unfinished game. policy, if given, is called as
+        policy(simulator, lengths), with lengths from slide_lengths, and must return
+        (origins, destinations, has_move) like random_moves; by default moves are
+        picked uniformly at random.
+        Returns (origins, destinations, moved, captured).
+        """
+        lengths = self.slide_lengths()
+        if policy is None:
+            origins, destinations, has_move = self.random_moves(lengths)
+        else:
+            origins, destinations, has_move = policy(self, lengths)
+
+        # an unfinished game with nothing to move can't go on
+        self.stuck |= ~has_move & ~self.finished
+        moved = has_move & ~self.finished
+        captured = self.apply_moves(origins, destinations, moved)
+        return origins, destinations, moved, captured
+
+    def run(self, max_plies=200, policy=None):
+        """
+        Plays every game until it finishes or reaches max_plies moves.
+        Returns the number of games that finished.
+        """
+        for _ in range(max_plies):
+            if self.finished.all():
+                break
+            self.step(policy)
+        return int(self.finished.sum())
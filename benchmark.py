@@ -0,0 +1,795 @@
+"""
+Benchmarks for the Hasami Shogi engine.
+Everything in here runs headlessly.
+
+Usage: python benchmark.py [benchmark ...]
+Runs every benchmark when none are named.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import book
+import instrument
+import movecache
+import perft
+import positiondb
+import record
+import tablebase
+import variants
+from ai import AlphaBeta
+from mcts import MCTS
+from rules import Rules
+from bitboard import BitboardRules
+from transposition import EXACT, TranspositionTable
+
+# name -> benchmark function, filled in by the @benchmark decorator
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    """
+    Registers a benchmark function under its name minus the bench_ prefix.
+    Benchmarks take the parsed command line arguments and return a dictionary
+    of results.
+    """
+    BENCHMARKS[func.__name__.removeprefix("bench_")] = func
+    return func
+
+
+def random_positions(count, seed=0, max_plies=200, variant=None):
+    """
+    Returns a list of (board, active_player) positions reached by random play
+    from the starting position, skipping finished games.
+    """
+    rng = random.Random(seed)
+    positions = []
+    game = Rules(variant)
+    while len(positions) < count:
+        moves = list(game.legal_moves())
+        if game.winner or not moves or rng.random() < 1 / max_plies:
+            game.reset_game_state()
+            continue
+        positions.append( (dict(game.board), game.get_active_player()) )
+        game.make_move(*rng.choice(moves))
+    return positions
+
+
+def timed(func, repeat):
+    """
+    Calls func repeat times and returns the number of calls per second.
+    """
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return repeat / (time.perf_counter() - start)
+
+
+@benchmark
+def bench_bitboard(args):
+    """
+    Checks the bitboard backend agrees with the dictionary backend on random
+    positions, then compares legal-move generation and make/unmake speed.
+    """
+    positions = random_positions(args.positions, seed=args.seed)
+    results = {}
+
+    # correctness: every legal move and the captures it makes must match
+    for board, player in positions:
+        dict_game, bit_game = Rules(), BitboardRules()
+        dict_game.set_position(board, player)
+        bit_game.set_position(board, player)
+        if sorted(dict_game.legal_moves()) != sorted(bit_game.legal_moves()):
+            raise AssertionError(f"legal moves differ in {board}, {player} to move")
+        for origin, destination in list(dict_game.legal_moves()):
+            dict_game.set_position(board, player)
+            bit_game.set_position(board, player)
+            if (sorted(dict_game.make_move(origin, destination).captured or ())
+                    != sorted(bit_game.make_move(origin, destination).captured or ())):
+                raise AssertionError(f"captures of {origin}-{destination} differ in {board}")
+            if (dict_game.board, dict_game.winner, dict_game.key) != \
+               (bit_game.board, bit_game.winner, bit_game.key):
+                raise AssertionError(f"positions after {origin}-{destination} differ in {board}")
+    results["positions_checked"] = len(positions)
+
+    for name, backend in ( ("dict", Rules), ("bitboard", BitboardRules) ):
+        games = []
+        for board, player in positions:
+            game = backend()
+            game.set_position(board, player)
+            games.append(game)
+
+        def generate():
+            for game in games:
+                for _ in game.legal_moves():
+                    pass
+
+        def count():
+            for game in games:
+                game.count_moves()
+
+        results[f"{name}_movegen_positions_per_sec"] = timed(generate, args.repeat) * len(games)
+        results[f"{name}_count_moves_positions_per_sec"] = timed(count, args.repeat) * len(games)
+
+        # a make_move/unmake_move pair on every legal move of every position,
+        # timed directly as perft.py does; setting each position up is left out
+        def make_unmake():
+            elapsed = 0
+            for game in games:
+                moves = list(game.legal_moves())
+                start = time.perf_counter()
+                for move in moves:
+                    game.unmake_move(game.make_move(*move))
+                elapsed += time.perf_counter() - start
+            return elapsed
+
+        pairs = sum(len(list(game.legal_moves())) for game in games)
+        elapsed = min(make_unmake() for _ in range(args.repeat))
+        results[f"{name}_make_unmake_per_sec"] = pairs / elapsed
+
+    results["movegen_speedup"] = (results["bitboard_movegen_positions_per_sec"]
+                                  / results["dict_movegen_positions_per_sec"])
+    results["make_unmake_speedup"] = (results["bitboard_make_unmake_per_sec"]
+                                      / results["dict_make_unmake_per_sec"])
+    return results
+
+
+@benchmark
+def bench_make_unmake(args):
+    """
+    Runs perft.py's make/unmake round trip check, then times a make/unmake
+    pair for each backend on random positions.
+    """
+    results = {"positions_checked": perft.check_make_unmake(seed=args.seed)}
+    positions = random_positions(args.positions, seed=args.seed)
+
+    for name, backend in ( ("dict", Rules), ("bitboard", BitboardRules) ):
+        game = backend()
+        pairs = 0
+        elapsed = 0
+        for board, player in positions:
+            game.set_position(board, player)
+            moves = list(game.legal_moves())
+            start = time.perf_counter()
+            for move in moves:
+                game.unmake_move(game.make_move(*move))
+            elapsed += time.perf_counter() - start
+            pairs += len(moves)
+
+        results[f"{name}_make_unmake_per_sec"] = pairs / elapsed
+    return results
+
+
+@benchmark
+def bench_transposition(args):
+    """
+    Fills a transposition table with the keys of random positions, probes it
+    and reports the hit/miss/collision counters and probe speed.
+    """
+    table = TranspositionTable(megabytes=args.tt_megabytes)
+    keys = [Rules().key]
+    game = Rules()
+    for board, player in random_positions(args.positions, seed=args.seed):
+        game.set_position(board, player)
+        keys.append(game.key)
+
+    # store half of the keys, so that probing all of them gives hits and misses
+    for depth, key in enumerate(keys[::2]):
+        table.store(key, depth % 8, depth, EXACT)
+    probes = timed(lambda: [table.probe(key) for key in keys], args.repeat) * len(keys)
+
+    results = table.stats()
+    results["probes_per_sec"] = probes
+    return results
+
+
+@benchmark
+def bench_search(args):
+    """
+    Runs the alpha-beta searcher for a fixed time on a few positions and
+    reports the depth reached and nodes per second.
+    """
+    results = {}
+    positions = [(Rules().board, "BLACK")] + random_positions(2, seed=args.seed)
+    for number, (board, player) in enumerate(positions):
+        game = Rules()
+        game.set_position(board, player)
+        result = AlphaBeta(time_limit=args.search_time).search(game)
+        results[f"position_{number}_depth"] = result.depth
+        results[f"position_{number}_nodes_per_sec"] = result.nps
+    return results
+
+
+@benchmark
+def bench_mcts(args):
+    """
+    Reports MCTS playouts per second from the starting position at 1, 2, 4
+    and all workers, to show how well the search scales with cores.
+    """
+    results = {}
+    cores = os.cpu_count() or 1
+    for workers in sorted({1, 2, 4, cores}):
+        player = MCTS(time_limit=args.search_time, workers=workers, seed=args.seed)
+        try:
+            # the first search starts the pool, so only time the second one
+            player.search(Rules())
+            result = player.search(Rules())
+        finally:
+            player.close()
+        results[f"{workers}_workers_playouts_per_sec"] = result.playouts_per_sec
+        results[f"{workers}_workers_speedup"] = (result.playouts_per_sec
+                                                 / results["1_workers_playouts_per_sec"])
+    return results
+
+
+@benchmark
+def bench_batch(args):
+    """
+    Checks the NumPy batch simulator against Rules move by move on a small
+    batch, then reports how many random games per second it plays.
+    """
+    from batch import BatchSimulator, COLORS
+
+    # correctness: replay every batch move through Rules and compare boards
+    sim = BatchSimulator(64, seed=args.seed)
+    games = [Rules() for _ in range(sim.games)]
+    for _ in range(args.batch_plies):
+        origins, destinations, moved, _ = sim.step()
+        for n in map(int, moved.nonzero()[0]):
+            (oy, ox), (dy, dx) = origins[n], destinations[n]
+            if (int(dx), int(dy)) not in games[n].test_move( (int(ox), int(oy)) ):
+                raise AssertionError(f"game {n}: batch played an illegal move")
+            games[n].make_move( (int(ox), int(oy)), (int(dx), int(dy)) )
+        for n, game in enumerate(games):
+            board = {(int(x), int(y)): COLORS[int(sim.boards[n, y, x])]
+                     for y, x in zip(*sim.boards[n].nonzero())}
+            if (board, COLORS.get(int(sim.winner[n])), COLORS[int(sim.active[n])]) != \
+               (game.board, game.winner, game.get_active_player()):
+                raise AssertionError(f"game {n}: batch position differs from the rules engine")
+
+    sim = BatchSimulator(args.batch_games, seed=args.seed)
+    start = time.perf_counter()
+    finished = sim.run(max_plies=args.batch_plies)
+    elapsed = time.perf_counter() - start
+    return {
+            "games_checked": 64,
+            "games": args.batch_games,
+            "finished": finished,
+            "moves_per_sec": int(sim.plies.sum()) / elapsed,
+            "games_per_sec": args.batch_games / elapsed,
+           }
+
+
+def random_game(seed=0, max_plies=200):
+    """
+    Plays a random game and returns the list of moves as (origin, destination) pairs.
+    """
+    rng = random.Random(seed)
+    game = Rules()
+    moves = []
+    while not game.winner and len(moves) < max_plies:
+        legal = list(game.legal_moves())
+        if not legal:
+            break
+        moves.append(rng.choice(legal))
+        game.make_move(*moves[-1])
+    return moves
+
+
+@benchmark
+def bench_draw(args):
+    """
+    Renders a random game the way the GUI does (select a piece, highlight its
+    moves, make the move) using SDL's dummy video driver, so no window is opened.
+    Compares redrawing only the changed squares with redrawing the whole
+    window every frame.
+    """
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    import graphics
+
+    window = graphics.Graphics()
+    moves = random_game(seed=args.seed)
+    results = {}
+
+    for mode in ("full", "dirty"):
+        game = Rules()
+        window.invalidate()
+        window.draw(game.board, game.get_active_player())
+        window.present()
+        window.stats = {"frames": 0, "pixels": 0}
+
+        start = time.perf_counter()
+        for origin, destination in moves:
+            # selecting a piece shows its moves
+            if mode == "full":
+                window.invalidate()
+            window.draw(game.board, game.get_active_player())
+            window.highlight_square(game.test_move(origin))
+            window.present()
+            # then the move is made
+            game.make_move(origin, destination)
+            if mode == "full":
+                window.invalidate()
+            window.draw(game.board, game.get_active_player())
+            window.present()
+        elapsed = time.perf_counter() - start
+
+        frames = window.stats["frames"]
+        results[f"{mode}_ms_per_frame"] = 1000 * elapsed / frames
+        results[f"{mode}_pixels_per_frame"] = window.stats["pixels"] / frames
+
+    results["pixels_reduction"] = results["full_pixels_per_frame"] / results["dirty_pixels_per_frame"]
+    results["frame_time_reduction"] = results["full_ms_per_frame"] / results["dirty_ms_per_frame"]
+    return results
+
+
+@benchmark
+def bench_render(args):
+    """
+    Renders random games offscreen with render.py: how many frames a second
+    are drawn, and how many PNG images a second are drawn and written, at
+    full size and as 200 pixel thumbnails.
+    """
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    import render
+
+    games = [random_game(seed=args.seed + number, max_plies=100) for number in range(args.repeat)]
+    renderer = render.Renderer()
+    start = time.perf_counter()
+    frames = sum(1 for moves in games for _ in renderer.render_game(moves))
+    results = {"frames": frames, "draw_frames_per_sec": frames / (time.perf_counter() - start)}
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "games.hsg")
+        with record.RecordWriter(path) as writer:
+            for moves in games:
+                writer.write_game(moves)
+        for size in (render.graphics.WIN_WIDTH, 200):
+            start = time.perf_counter()
+            images = sum(written for written, _, _ in
+                         render.render([path], os.path.join(directory, str(size)), size, workers=0))
+            results[f"png_{size}px_images_per_sec"] = images / (time.perf_counter() - start)
+    return results
+
+
+@benchmark
+def bench_text(args):
+    """
+    Times drawing the game over message with the text cache warm, and with
+    the font and text caches emptied before every call.
+    """
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    import graphics
+
+    window = graphics.Graphics()
+
+    def cold():
+        graphics.get_font.cache_clear()
+        graphics._text_cache.clear()
+        window.display_game_over("BLACK")
+
+    cold_per_sec = timed(cold, args.repeat)
+    warm_per_sec = timed(lambda: window.display_game_over("BLACK"), 100 * args.repeat)
+    return {
+            "cold_ms_per_game_over": 1000 / cold_per_sec,
+            "warm_ms_per_game_over": 1000 / warm_per_sec,
+            "speedup": warm_per_sec / cold_per_sec,
+           }
+
+
+@benchmark
+def bench_record(args):
+    """
+    Times writing and reading random games in the binary record format, and
+    compares its size with the same games in algebraic notation.
+    """
+    games = [random_game(args.seed + n) for n in range(args.positions // 10 or 1)]
+    moves = sum(len(game) for game in games)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "games.hsg")
+
+        def write():
+            with record.RecordWriter(path) as writer:
+                for game in games:
+                    writer.write_game(game)
+
+        write_per_sec = timed(write, args.repeat)
+        read_per_sec = timed(lambda: sum(1 for _ in record.iter_games(path)), args.repeat)
+        size = os.path.getsize(path)
+        if [game.moves for game in record.iter_games(path)] != games:
+            raise AssertionError("record round trip failed")
+        # the text export replays each game to annotate its captures
+        start = time.perf_counter()
+        text = "".join(record.game_to_text(game) + "\n" for game in games)
+        export_per_sec = len(games) / (time.perf_counter() - start)
+
+    return {
+            "games": len(games),
+            "moves": moves,
+            "write_games_per_sec": write_per_sec * len(games),
+            "read_games_per_sec": read_per_sec * len(games),
+            "text_export_games_per_sec": export_per_sec,
+            "bytes_per_move": size / moves,
+            "text_bytes_per_move": len(text.encode()) / moves,
+           }
+
+
+@benchmark
+def bench_tablebase(args):
+    """
+    Builds the 2v2 and 3v2 tables for a 4x4 board and times probing them.
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for black, red in ( (2, 2), (3, 2) ):
+            stats = tablebase.generate(directory, 4, 4, black, red)
+            results[f"{black}v{red}_positions"] = stats["positions"]
+            results[f"{black}v{red}_build_positions_per_sec"] = stats["positions_per_sec"]
+
+        tables = tablebase.TablebaseSet(directory)
+        table = tables.table(4, 4, 3, 2)
+        games = []
+        for number in range(0, table.index.size, max(1, table.index.size // 1000)):
+            game = tablebase.rules_class(4, 4)()
+            game.set_position(*table.index.position(number))
+            games.append(game)
+        probes_per_sec = timed(lambda: [tables.probe(game) for game in games], args.repeat)
+        results["probes_per_sec"] = probes_per_sec * len(games)
+        tables.close()
+    return results
+
+
+@benchmark
+def bench_book(args):
+    """
+    Builds an opening book from the first moves of random games and times
+    looking positions up in it, compared with searching them.
+    """
+    builder = book.BookBuilder()
+    games = [random_game(args.seed + n, 8) for n in range(args.positions)]
+    for moves in games:
+        builder.add_game(moves, 8)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "book.hsb")
+        records = builder.write(path)
+        opening_book = book.OpeningBook(path)
+        positions = []
+        for moves in games[:100]:
+            game = Rules()
+            for move in moves[:4]:
+                game.make_move(*move)
+            positions.append(game)
+        if not all(opening_book.lookup(game) for game in positions):
+            raise AssertionError("book position missing")
+        lookups_per_sec = timed(lambda: [opening_book.lookup(game) for game in positions],
+                                args.repeat) * len(positions)
+        opening_book.close()
+    # with the book, the start position is answered without searching
+    searcher = AlphaBeta(time_limit=args.search_time)
+    search = searcher.search(Rules())
+    return {
+            "positions": len(builder.entries),
+            "records": records,
+            "lookups_per_sec": lookups_per_sec,
+            "lookup_us": 1e6 / lookups_per_sec,
+            "search_ms": 1000 * search.elapsed,
+           }
+
+
+@benchmark
+def bench_analysis(args):
+    """
+    Measures the background analyser: how long after a new position is given
+    its first line arrives (which includes dropping the old search), and how
+    late a 10ms sleep on the main thread wakes up while the analysis runs,
+    standing in for the window's frame timing.
+    """
+    from analysis import Analyser
+    from framestats import percentile
+
+    analyser = Analyser(rate=100)
+    game = Rules()
+    rng = random.Random(args.seed)
+    switches = []
+    lateness = []
+    for _ in range(args.repeat * 4):
+        start = time.perf_counter()
+        analyser.start(game)
+        while analyser.poll() is None:
+            time.sleep(0.001)
+        switches.append(time.perf_counter() - start)
+        # let it search a while before moving on, timing the main thread meanwhile
+        for _ in range(20):
+            start = time.perf_counter()
+            time.sleep(0.01)
+            lateness.append(time.perf_counter() - start - 0.01)
+        game.make_move(*rng.choice(list(game.legal_moves())))
+    analyser.close()
+    return {
+            "switch_ms_p50": 1000 * percentile(switches, 0.5),
+            "switch_ms_max": 1000 * max(switches),
+            "main_thread_lag_ms_p95": 1000 * percentile(lateness, 0.95),
+            "main_thread_lag_ms_max": 1000 * max(lateness),
+           }
+
+
+@benchmark
+def bench_movecache(args):
+    """
+    Plays random games and, in every position, selects each of the side to
+    move's pawns and previews the captures of each of their moves, as the
+    game window does while a player makes up their mind. Compares working
+    everything out each time with movecache.MoveCache, checking they agree,
+    once with every pawn selected and every move previewed a single time
+    and once with the repeats of real use: a pawn selected a few times and
+    several mouse motion events over each square.
+    """
+    games = [random_game(args.seed + n) for n in range(max(1, args.positions // 100))]
+
+    def play(selections, hovers, cache=None):
+        for moves in games:
+            game = Rules()
+            if cache is not None:
+                cache.clear()
+            for origin, destination in moves:
+                player = game.get_active_player()
+                for pos in [pos for pos, color in game.board.items() if color == player]:
+                    for _ in range(selections):
+                        legal = cache.moves(game, pos) if cache else game.test_move(pos)
+                    for square in legal:
+                        for _ in range(hovers):
+                            if cache:
+                                cache.captures(game, pos, square)
+                            else:
+                                game.preview_captures(pos, square)
+                game.make_move(origin, destination)
+
+    # the cache must agree with the rules in every position
+    cache = movecache.MoveCache()
+    for moves in games:
+        game = Rules()
+        for origin, destination in moves:
+            player = game.get_active_player()
+            for pos in [pos for pos, color in game.board.items() if color == player]:
+                if cache.moves(game, pos) != game.test_move(pos):
+                    raise AssertionError(f"cached moves of {pos} are wrong")
+                for square in game.test_move(pos):
+                    if cache.captures(game, pos, square) != tuple(game.preview_captures(pos, square)):
+                        raise AssertionError(f"cached captures of {pos}-{square} are wrong")
+            game.make_move(origin, destination)
+    results = {"pawns_updated_per_move": cache.stats["pawns_updated"] / max(1, cache.stats["misses"])}
+
+    positions = sum(len(moves) for moves in games)
+    for name, selections, hovers in ( ("once", 1, 1), ("repeated", 3, 5) ):
+        uncached = positions * timed(lambda: play(selections, hovers), args.repeat)
+        cached = positions * timed(lambda: play(selections, hovers, movecache.MoveCache()), args.repeat)
+        results[f"{name}_uncached_positions_per_sec"] = uncached
+        results[f"{name}_cached_positions_per_sec"] = cached
+        results[f"{name}_speedup"] = cached / uncached
+    return results
+
+
+@benchmark
+def bench_positiondb(args):
+    """
+    Indexes random games into a position database in two batches (two
+    segments), checks a sample of positions against a replay of the games,
+    and times queries before and after merging the segments.
+    """
+    games = [random_game(args.seed + n) for n in range(args.positions // 10 or 1)]
+    # where each position was reached, as (game id, ply)
+    reached = {}
+    for number, moves in enumerate(games):
+        game = Rules()
+        reached.setdefault(game.key, []).append( (number, 0) )
+        for ply, move in enumerate(moves, 1):
+            game.make_move(*move)
+            reached.setdefault(game.key, []).append( (number, ply) )
+    rng = random.Random(args.seed)
+    keys = rng.sample(sorted(reached), min(1000, len(reached)))
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "games.hsg")
+        results = {"games": len(games)}
+        database = positiondb.PositionDB(os.path.join(directory, "games.db"))
+        start = time.perf_counter()
+        half = len(games) // 2
+        for batch in (games[:half], games[half:]):
+            # the archive grows and only the new games are indexed
+            with record.RecordWriter(path, append=os.path.exists(path)) as writer:
+                for moves in batch:
+                    writer.write_game(moves)
+            sum(database.add([path]))
+        results["index_games_per_sec"] = len(games) / (time.perf_counter() - start)
+        results["bytes_per_position"] = sum(os.path.getsize(segment.path)
+                                            for segment in database.segments) / \
+                                        sum(len(found) for found in reached.values())
+
+        for name in ("segments", "compacted"):
+            if name == "compacted":
+                database.compact()
+            for key in keys:
+                if [tuple(posting) for posting in database.postings(key)] != sorted(reached[key]):
+                    raise AssertionError(f"{name}: wrong postings for key {key:#x}")
+
+            def query():
+                for key in keys:
+                    database.postings(key, 10)
+                    database.move_stats(key)
+
+            results[f"{name}_query_us"] = 1e6 / (timed(query, args.repeat) * len(keys))
+        database.close()
+    return results
+
+
+@benchmark
+def bench_variants(args):
+    """
+    Times move generation and make/unmake on random positions of each variant,
+    to show how the rules engine scales with the size of the board. Moves per
+    second should hold roughly steady as the board grows, since the rays are
+    precomputed per board size; positions per second fall with the number of
+    moves in each position.
+    """
+    results = {}
+    for variant in variants.VARIANTS.values():
+        game = Rules(variant)
+        positions = random_positions(args.positions // 5, args.seed, variant=variant)
+        moves = 0
+        for board, player in positions:
+            game.set_position(board, player)
+            moves += sum(1 for _ in game.legal_moves())
+
+        def generate():
+            for board, player in positions:
+                game.set_position(board, player)
+                for _ in game.legal_moves():
+                    pass
+
+        def make_unmake():
+            for board, player in positions:
+                game.set_position(board, player)
+                for move in list(game.legal_moves()):
+                    game.unmake_move(game.make_move(*move))
+
+        rate = timed(generate, args.repeat)
+        results[f"{variant.name}_moves_per_position"] = moves / len(positions)
+        results[f"{variant.name}_movegen_moves_per_sec"] = rate * moves
+        results[f"{variant.name}_make_unmake_per_sec"] = timed(make_unmake, args.repeat) * moves
+    return results
+
+
+@benchmark
+def bench_startup(args):
+    """
+    Times fresh Python processes importing the game and opening a headless
+    window, against the bare interpreter and against starting all of pygame
+    as graphics.py used to on import. Reports the median of repeat runs in
+    milliseconds, including interpreter startup.
+    """
+    steps = {
+             "python": "pass",
+             "import_rules": "import rules",
+             "import_game": "import game",
+             "headless_window": "import game; game.Game(headless=True)",
+             "pygame_init": "import pygame; pygame.init(); pygame.font.init()",
+            }
+    env = dict(os.environ, SDL_VIDEODRIVER="dummy", PYGAME_HIDE_SUPPORT_PROMPT="1")
+    directory = os.path.dirname(os.path.abspath(__file__))
+    results = {}
+    for name, code in steps.items():
+        times = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, "-c", code], cwd=directory, env=env, check=True,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            times.append(time.perf_counter() - start)
+        results[f"{name}_ms"] = 1000 * statistics.median(times)
+    return results
+
+
+@benchmark
+def bench_instrument(args):
+    """
+    Times make/unmake pairs on the dict rules with the instrumentation never
+    enabled, while enabled and after disabling it again, to show it costs
+    nothing while off, and checks every call was counted.
+    """
+    positions = random_positions(args.positions, seed=args.seed)
+    game = Rules()
+    instruments = instrument.Instruments(("rules.Rules.make_move",))
+
+    def pairs():
+        count = 0
+        for board, player in positions:
+            game.set_position(board, player)
+            for move in game.legal_moves():
+                game.unmake_move(game.make_move(*move))
+                count += 1
+        return count
+
+    count = pairs()
+    results = {"before_pairs_per_sec": count * timed(pairs, args.repeat)}
+    instruments.enable()
+    try:
+        results["enabled_pairs_per_sec"] = count * timed(pairs, args.repeat)
+    finally:
+        instruments.disable()
+    results["after_pairs_per_sec"] = count * timed(pairs, args.repeat)
+    if instruments.histograms["rules.Rules.make_move"].count != count * args.repeat:
+        raise AssertionError("instrumented calls were not all counted")
+    results["disabled_overhead_percent"] = 100 * (results["before_pairs_per_sec"]
+                                                  / results["after_pairs_per_sec"] - 1)
+    results["enabled_overhead_percent"] = 100 * (results["before_pairs_per_sec"]
+                                                 / results["enabled_pairs_per_sec"] - 1)
+    return results
+
+
+@benchmark
+def bench_perft(args):
+    """
+    Runs the perft and capture regression suite from perft.py, with its
+    microbenchmarks of test_move, check_captures, check_corner_cap and make_move.
+    """
+    return perft.run_suite(args.perft_depth, args.repeat)
+
+
+def main():
+    """
+    Parses the command line and runs the requested benchmarks.
+    """
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("benchmarks", nargs="*",
+                        help="benchmarks to run (default: all of " + ", ".join(sorted(BENCHMARKS)) + ")")
+    parser.add_argument("--positions", type=int, default=500,
+                        help="number of random positions to test on")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="number of timed repetitions")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument("--search-time", type=float, default=2.0,
+                        help="seconds per search position")
+    parser.add_argument("--batch-games", type=int, default=4096,
+                        help="number of games played side by side by the batch benchmark")
+    parser.add_argument("--batch-plies", type=int, default=200,
+                        help="moves per game in the batch benchmark")
+    parser.add_argument("--perft-depth", type=int, default=3, help="perft depth")
+    parser.add_argument("--json", help="also write the results to this file, for comparing "
+                                       "performance between versions")
+    parser.add_argument("--tt-megabytes", type=float, default=16,
+                        help="transposition table size")
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark {name!r}")
+
+    report = {
+              "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "python": platform.python_version(),
+              "machine": platform.machine(),
+              "cpus": os.cpu_count(),
+              "results": {},
+             }
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        print(f"{name}:")
+        results = BENCHMARKS[name](args)
+        report["results"][name] = results
+        for key, value in results.items():
+            if isinstance(value, float):
+                value = f"{value:,.1f}"
+            print(f"  {key}: {value}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,394 @@
+"""
+Contains a bitboard backend for the Hasami Shogi rules engine.
+Each colour is stored as an 81 bit integer where bit y * COLS + x is set
+when that colour has a pawn on (x, y). Sliding moves, custodian captures
+and corner captures are worked out with shifts and masks instead of
+walking the board one dictionary lookup at a time.
+
+BitboardRules has the same API as rules.Rules and gives the same results
+on every position, so either can be used wherever the other is.
+"""
+import tables
+import zobrist
+from rules import Rules, Undo
+
+ROWS, COLS = Rules.ROWS, Rules.COLS
+SQUARES = ROWS * COLS
+
+# directions are indexed 0-3 as up, down, left, right, as in tables.DIRECTIONS.
+# up and left run towards lower bit indices, down and right towards higher ones
+POSITIVE = (False, True, False, True)
+
+
+def to_index(pos):
+    """
+    Converts an (x, y) board position into a bit index.
+    """
+    return pos[1] * COLS + pos[0]
+
+
+def to_pos(index):
+    """
+    Converts a bit index back into an (x, y) board position.
+    """
+    return (index % COLS, index // COLS)
+
+
+def iter_bits(mask):
+    """
+    Yields the index of every set bit in mask, lowest first.
+    """
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+# the masks below are the bitboard form of the shared tables for this board size
+_TABLES = tables.get_tables(ROWS, COLS)
+
+
+def _to_mask(positions):
+    """
+    Returns a mask with the bit for each of positions set.
+    """
+    mask = 0
+    for pos in positions:
+        mask |= 1 << to_index(pos)
+    return mask
+
+
+# RAYS[direction][index]: every square from index to the edge of the board in
+# that direction, not including index itself
+RAYS = tuple(tuple(_to_mask(_TABLES.rays[to_pos(index)][direction]) for index in range(SQUARES))
+             for direction in range(4))
+
+# corner captures: moving onto one of these squares captures the opponent pawn
+# in the corner if the partner square is also held. index -> (partner, corner)
+CORNER_CAPS = {to_index(pos): (_to_mask([partner]), _to_mask([corner]))
+               for pos, (partner, corner) in _TABLES.corner_caps.items()}
+
+# RAYS[direction][index] plus index itself; xor-ing this off a ray cuts it short
+BEYOND = tuple(tuple(ray | (1 << index) for index, ray in enumerate(rays)) for rays in RAYS)
+# NEIGHBOURS[index]: mask of the (up to four) squares orthogonally next to index
+NEIGHBOURS = tuple(_to_mask(_TABLES.neighbours[to_pos(index)]) for index in range(SQUARES))
+# positions and indices, looked up rather than recomputed in the hot paths
+POSITIONS = tuple(to_pos(index) for index in range(SQUARES))
+INDICES = {pos: index for index, pos in enumerate(POSITIONS)}
+
+
+def _slides(direction, index, item):
+    """
+    Returns a dictionary mapping the index of the nearest blocker along the
+    ray from index in direction (-1 for none) to a tuple of item(pos) for
+    each square the pawn on index can slide to before it.
+    """
+    ray = _TABLES.rays[POSITIONS[index]][direction]
+    slides = {-1: tuple(item(pos) for pos in ray)}
+    for n, pos in enumerate(ray):
+        slides[INDICES[pos]] = tuple(item(square) for square in ray[:n])
+    return slides
+
+
+# SLIDE_MOVES[direction][index][blocker]: the (origin, destination) moves of a
+# pawn on index in that direction when blocker is the nearest occupied square,
+# and SLIDE_SQUARES the same for just the destinations. legal_moves and
+# test_move hand these out whole instead of pulling every move out bit by bit
+SLIDE_MOVES = tuple(tuple(_slides(direction, index, lambda pos, origin=POSITIONS[index]: (origin, pos))
+                          for index in range(SQUARES))
+                    for direction in range(4))
+SLIDE_SQUARES = tuple(tuple(_slides(direction, index, lambda pos: pos) for index in range(SQUARES))
+                      for direction in range(4))
+
+
+def slides(index, occupied, table):
+    """
+    Returns the four tuples (up, down, left, right) of table (SLIDE_MOVES or
+    SLIDE_SQUARES) for a pawn on index. As in move_mask, the nearest blocker is
+    the highest bit up and left and the lowest bit down and right.
+    """
+    up = RAYS[0][index] & occupied
+    down = RAYS[1][index] & occupied
+    left = RAYS[2][index] & occupied
+    right = RAYS[3][index] & occupied
+    return (table[0][index][up.bit_length() - 1],
+            table[1][index][(down & -down).bit_length() - 1],
+            table[2][index][left.bit_length() - 1],
+            table[3][index][(right & -right).bit_length() - 1])
+
+
+# the same Zobrist keys as the dictionary backend, indexed by bit
+_ZOBRIST = zobrist.get_keys(ROWS, COLS)
+PIECE_KEYS = {color: tuple(keys[pos] for pos in POSITIONS)
+              for color, keys in _ZOBRIST.pieces.items()}
+
+
+def move_mask(index, occupied):
+    """
+    Returns a mask of every empty square a pawn on index can slide to.
+    Uses the nearest blocker on each ray so each direction costs a handful of
+    integer operations no matter how long the ray is.
+    """
+    up, down, left, right = RAYS[0][index], RAYS[1][index], RAYS[2][index], RAYS[3][index]
+    # up and left run towards lower indices so their nearest blocker is the highest bit,
+    # down and right run towards higher indices so theirs is the lowest bit.
+    # cut each ray off at (and including) that first blocker
+    blockers = up & occupied
+    if blockers:
+        up ^= BEYOND[0][blockers.bit_length() - 1]
+    blockers = left & occupied
+    if blockers:
+        left ^= BEYOND[2][blockers.bit_length() - 1]
+    blockers = down & occupied
+    if blockers:
+        down ^= BEYOND[1][(blockers & -blockers).bit_length() - 1]
+    blockers = right & occupied
+    if blockers:
+        right ^= BEYOND[3][(blockers & -blockers).bit_length() - 1]
+    return up | down | left | right
+
+
+def capture_mask(index, own, opponent):
+    """
+    Returns a mask of the opponent pawns captured by own moving onto index.
+    own must already include the moved pawn.
+    """
+    captures = 0
+
+    corner = CORNER_CAPS.get(index)
+    if corner is not None:
+        partner, corner_bit = corner
+        if own & partner and opponent & corner_bit:
+            captures = corner_bit
+
+    # nothing can be captured unless an opponent pawn is next to index
+    if not NEIGHBOURS[index] & opponent:
+        return captures
+
+    for direction in range(4):
+        ray = RAYS[direction][index]
+        # the first square along the ray that isn't an opponent pawn
+        stop = ray & ~opponent
+        if not stop:
+            continue
+        if POSITIVE[direction]:
+            first = (stop & -stop).bit_length() - 1
+        else:
+            first = stop.bit_length() - 1
+        if own >> first & 1:
+            # everything between index and the bracketing pawn is an opponent pawn
+            captures |= ray ^ BEYOND[direction][first]
+
+    return captures
+
+
+class BitboardRules:
+    """
+    A game of Hasami Shogi (variant 1) stored as one bitboard per colour.
+    Has the same public API as rules.Rules.
+    """
+    VARIANT = Rules.VARIANT
+    ROWS = ROWS
+    COLS = COLS
+    # set to a record.RecordWriter to archive the games played through play_move
+    recorder = None
+
+    def __init__(self):
+        self._zobrist = _ZOBRIST
+        # used by the _update_turn shared with Rules
+        self._min_pieces = self.VARIANT.min_pieces
+        # initialize new game state
+        self.reset_game_state()
+
+    def reset_game_state(self):
+        """
+        Resets the game state to its initial conditions.
+        """
+        if self.recorder is not None:
+            self.recorder.end_game(self.winner)
+        # red fills the top row and black fills the bottom row
+        self._masks = {
+                       "RED": (1 << COLS) - 1,
+                       "BLACK": ((1 << COLS) - 1) << (SQUARES - COLS),
+                      }
+        # initialize player turn to black as they always start
+        self._active_player = "BLACK"
+        self._pieces_remaining = {
+                                  "BLACK": 9,
+                                  "RED": 9,
+                                 }
+        # initialize the new game as unfinished
+        self.winner = None
+        # Zobrist key of the position, kept up to date by make_move
+        self.key = _ZOBRIST.compute(self.board, self._active_player)
+        # undo records of the moves played so far, and of moves taken back
+        self._history = []
+        self._redo = []
+
+    @property
+    def board(self):
+        """
+        The position as a dictionary in the same format as Rules.board.
+        Built fresh on each access, so changing it does not change the game.
+        """
+        board = {}
+        for color, mask in self._masks.items():
+            for index in iter_bits(mask):
+                board[POSITIONS[index]] = color
+        return board
+
+    def set_position(self, board, active_player="BLACK"):
+        """
+        Sets up an arbitrary position from a Rules style board dictionary.
+        """
+        self._masks = {"BLACK": 0, "RED": 0}
+        for pos, color in board.items():
+            self._masks[color] |= 1 << INDICES[pos]
+        self._active_player = active_player
+        self._pieces_remaining = {color: mask.bit_count() for color, mask in self._masks.items()}
+        self.winner = None
+        self.key = _ZOBRIST.compute(board, active_player)
+        self._history = []
+        self._redo = []
+
+    def get_active_player(self):
+        """
+        Returns whose turn it is - either 'RED' or 'BLACK'.
+        """
+        return self._active_player
+
+    def get_pieces_remaining(self, player):
+        """
+        Returns the number of pieces 'RED' or 'BLACK' has left on the board.
+        """
+        return self._pieces_remaining[player]
+
+    def _opponent(self):
+        """
+        Returns the player whose turn it isn't.
+        """
+        if self._active_player == "BLACK":
+            return "RED"
+        return "BLACK"
+
+    def test_move(self, origin):
+        """
+        Returns the set of all squares the piece on origin can legally move to.
+        """
+        occupied = self._masks["BLACK"] | self._masks["RED"]
+        up, down, left, right = slides(INDICES[origin], occupied, SLIDE_SQUARES)
+        return {*up, *down, *left, *right}
+
+    def legal_moves(self):
+        """
+        Yields every legal (origin, destination) move for the active player.
+        """
+        occupied = self._masks["BLACK"] | self._masks["RED"]
+        up_rays, down_rays, left_rays, right_rays = RAYS
+        up_moves, down_moves, left_moves, right_moves = SLIDE_MOVES
+        # slides inlined, as this is the hottest loop of the search
+        for origin in iter_bits(self._masks[self._active_player]):
+            up = up_rays[origin] & occupied
+            down = down_rays[origin] & occupied
+            left = left_rays[origin] & occupied
+            right = right_rays[origin] & occupied
+            yield from up_moves[origin][up.bit_length() - 1]
+            yield from down_moves[origin][(down & -down).bit_length() - 1]
+            yield from left_moves[origin][left.bit_length() - 1]
+            yield from right_moves[origin][(right & -right).bit_length() - 1]
+
+    def count_moves(self, player=None):
+        """
+        Returns how many legal moves player (by default the active player) has.
+        """
+        occupied = self._masks["BLACK"] | self._masks["RED"]
+        return sum(move_mask(origin, occupied).bit_count()
+                   for origin in iter_bits(self._masks[player or self._active_player]))
+
+    def check_captures(self, pos):
+        """
+        Returns a list of the positions captured by the active player's
+        pawn on pos, including corner captures.
+        """
+        opponent = self._opponent()
+        captures = capture_mask(INDICES[pos], self._masks[self._active_player],
+                                self._masks[opponent])
+        return [POSITIONS[index] for index in iter_bits(captures)]
+
+    def preview_captures(self, origin, destination):
+        """
+        Returns the list of positions the active player would capture by
+        moving from origin to destination, without making the move.
+        """
+        index = INDICES[destination]
+        own = self._masks[self._active_player] ^ (1 << INDICES[origin]) ^ (1 << index)
+        captures = capture_mask(index, own, self._masks[self._opponent()])
+        return [POSITIONS[square] for square in iter_bits(captures)]
+
+    def check_corner_cap(self, origin, opponent):
+        """
+        Returns the corner position captured by moving onto origin, or None.
+        """
+        corner = CORNER_CAPS.get(INDICES[origin])
+        if corner is None:
+            return None
+        partner, corner_bit = corner
+        if self._masks[self._active_player] & partner and self._masks[opponent] & corner_bit:
+            return POSITIONS[corner_bit.bit_length() - 1]
+        return None
+
+    def make_move(self, origin, destination):
+        """
+        Moves the active player's piece from origin to destination,
+        removes any captured pieces and switches the turn.
+        Does not check the move is legal; use test_move for that.
+        Returns an Undo record for unmake_move.
+        """
+        player = self._active_player
+        opponent = self._opponent()
+        undo = Undo(origin, destination, None, player, self.winner, self.key)
+        start, index = INDICES[origin], INDICES[destination]
+        own = self._masks[player] ^ (1 << start) ^ (1 << index)
+        self._masks[player] = own
+        self.key ^= PIECE_KEYS[player][start] ^ PIECE_KEYS[player][index]
+
+        captures = capture_mask(index, own, self._masks[opponent])
+        if not captures:
+            self._update_turn()
+            return undo
+
+        self._masks[opponent] ^= captures
+        self._pieces_remaining[opponent] -= captures.bit_count()
+        captured = tuple(iter_bits(captures))
+        for square in captured:
+            self.key ^= PIECE_KEYS[opponent][square]
+        self._update_turn()
+
+        return undo._replace(captured=tuple(POSITIONS[square] for square in captured))
+
+    def unmake_move(self, undo):
+        """
+        Takes back the move described by an Undo record from make_move.
+        """
+        player = undo.player
+        self._masks[player] ^= (1 << INDICES[undo.origin]) | (1 << INDICES[undo.destination])
+
+        if undo.captured:
+            if player == "BLACK":
+                opponent = "RED"
+            else:
+                opponent = "BLACK"
+            for piece in undo.captured:
+                self._masks[opponent] |= 1 << INDICES[piece]
+            self._pieces_remaining[opponent] += len(undo.captured)
+
+        self._active_player = player
+        self.winner = undo.winner
+        self.key = undo.key
+
+    # the turn, win and history logic is identical for both backends
+    _update_turn = Rules._update_turn
+    count_repetitions = Rules.count_repetitions
+    play_move = Rules.play_move
+    takeback = Rules.takeback
+    redo = Rules.redo
@@ -0,0 +1,292 @@
+"""
+Contains an opening book for Hasami Shogi.
+
+Every game starts from the same position, so the first few moves can be
+worked out once, offline, and looked up instead of searched. The book maps
+positions to good moves, built from self-play with ai.AlphaBeta or from
+archived games (record.py).
+
+Positions are stored under a canonical key so symmetric positions share
+entries: the board can be mirrored left to right, and flipped top to
+bottom with the colours (and the side to move) swapped. The canonical key
+is the smallest Zobrist key of the position's four symmetric versions, and
+moves are stored as they would be played in that version.
+
+The book file is a header followed by fixed size records sorted by key,
+memory-mapped and searched by bisection:
+
+    header   4s magic b"HSBK", u8 version, u8 rows, u8 cols, u8 reserved, u32 records
+    record   u64 key, u8 origin square, u8 destination square, u16 weight, i32 score
+
+Squares are numbered y * cols + x. weight is how often the move was chosen
+and score is the search score for the side to move (0 if not searched).
+
+Usage:
+    python book.py build book.hsb [--games N] [--plies N] [--time S] [--records games.hsg]
+    python book.py show book.hsb
+"""
+import argparse
+import mmap
+import random
+import struct
+from collections import namedtuple
+
+import record
+import variants
+import zobrist
+from rules import Rules, square_name
+
+MAGIC = b"HSBK"
+VERSION = 1
+HEADER = struct.Struct("<4sBBBBI")
+RECORD = struct.Struct("<QBBHi")
+MAX_WEIGHT = 0xFFFF
+
+# a book move, in the frame of the position it was looked up for
+BookMove = namedtuple("BookMove", "move weight score")
+
+# the symmetries of the board as (mirror left to right, flip top to bottom
+# and swap colours). Each is its own inverse
+SYMMETRIES = ( (False, False), (True, False), (False, True), (True, True) )
+
+
+def transform_square(pos, symmetry, rows, cols):
+    """
+    Returns where the square pos ends up under a symmetry.
+    """
+    mirror, flip = symmetry
+    x, y = pos
+    if mirror:
+        x = cols - 1 - x
+    if flip:
+        y = rows - 1 - y
+    return (x, y)
+
+
+def transform_position(board, player, symmetry, rows, cols):
+    """
+    Returns (board, player) under a symmetry.
+    """
+    swap = {"BLACK": "RED", "RED": "BLACK"} if symmetry[1] else {"BLACK": "BLACK", "RED": "RED"}
+    return ({transform_square(pos, symmetry, rows, cols): swap[color] for pos, color in board.items()},
+            swap[player])
+
+
+def canonical(board, player, rows=9, cols=9):
+    """
+    Returns (key, symmetry): the canonical key of a position and the symmetry
+    that takes the position to its canonical version.
+    """
+    keys = zobrist.get_keys(rows, cols)
+    return min( (keys.compute(*transform_position(board, player, symmetry, rows, cols)), symmetry)
+                for symmetry in SYMMETRIES )
+
+
+class OpeningBook:
+    """
+    A memory-mapped book file.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.rows, self.cols, _, self.size = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} opening book")
+
+    def __len__(self):
+        return self.size
+
+    def _key_at(self, number):
+        """
+        Returns the key of record number.
+        """
+        return struct.unpack_from("<Q", self._map, HEADER.size + number * RECORD.size)[0]
+
+    def _records(self, key):
+        """
+        Returns the (key, origin, destination, weight, score) records for a key.
+        """
+        # bisect for the first record with the key
+        low, high = 0, self.size
+        while low < high:
+            middle = (low + high) // 2
+            if self._key_at(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        records = []
+        while low < self.size:
+            entry = RECORD.unpack_from(self._map, HEADER.size + low * RECORD.size)
+            if entry[0] != key:
+                break
+            records.append(entry)
+            low += 1
+        return records
+
+    def lookup(self, game):
+        """
+        Returns the book moves for the position in a rules object, most
+        played first, or an empty list if the position isn't in the book.
+        """
+        if (game.ROWS, game.COLS) != (self.rows, self.cols) or \
+           not variants.plays_standard_rules(game.VARIANT):
+            return []
+        key, symmetry = canonical(game.board, game.get_active_player(), self.rows, self.cols)
+        moves = []
+        for _, origin, destination, weight, score in self._records(key):
+            # back from the canonical version to the game's own
+            origin = transform_square( (origin % self.cols, origin // self.cols),
+                                       symmetry, self.rows, self.cols )
+            destination = transform_square( (destination % self.cols, destination // self.cols),
+                                            symmetry, self.rows, self.cols )
+            moves.append(BookMove( (origin, destination), weight, score ))
+        return moves
+
+    def choose(self, game, rng=None):
+        """
+        Returns a book move for the position in game, or None. With rng, picks
+        at random weighted by how often each move was chosen, for variety;
+        otherwise the most chosen move.
+        """
+        moves = self.lookup(game)
+        if not moves:
+            return None
+        if rng is None:
+            return moves[0]
+        return rng.choices(moves, weights=[entry.weight for entry in moves])[0]
+
+    def close(self):
+        """
+        Closes the file.
+        """
+        self._map.close()
+        self._file.close()
+
+
+class BookBuilder:
+    """
+    Collects book moves and writes them to a book file.
+    """
+    def __init__(self, rows=9, cols=9):
+        self.rows = rows
+        self.cols = cols
+        # canonical key -> (origin square, destination square) -> [weight, score]
+        self.entries = {}
+
+    def add(self, game, move, score=None, weight=1):
+        """
+        Adds a move for the position in a rules object. Adding a move again
+        adds to its weight; score replaces the stored score if given.
+        """
+        key, symmetry = canonical(game.board, game.get_active_player(), self.rows, self.cols)
+        origin, destination = (transform_square(pos, symmetry, self.rows, self.cols) for pos in move)
+        squares = (origin[1] * self.cols + origin[0], destination[1] * self.cols + destination[0])
+        entry = self.entries.setdefault(key, {}).setdefault(squares, [0, 0])
+        entry[0] = min(MAX_WEIGHT, entry[0] + weight)
+        if score is not None:
+            entry[1] = score
+
+    def add_game(self, moves, plies):
+        """
+        Adds the first plies moves of a game, e.g. from a record file.
+        """
+        game = Rules()
+        for move in moves[:plies]:
+            self.add(game, move)
+            game.make_move(*move)
+
+    def write(self, path):
+        """
+        Writes the book, sorted by key and then by weight. Returns the number of records.
+        """
+        records = []
+        for key, moves in self.entries.items():
+            for (origin, destination), (weight, score) in moves.items():
+                records.append( (key, -weight, origin, destination, score) )
+        records.sort()
+        with open(path, "wb") as file:
+            file.write(HEADER.pack(MAGIC, VERSION, self.rows, self.cols, 0, len(records)))
+            for key, weight, origin, destination, score in records:
+                file.write(RECORD.pack(key, origin, destination, -weight, score))
+        return len(records)
+
+
+def self_play(builder, games=50, plies=8, time_limit=0.2, explore=0.3, seed=0):
+    """
+    Plays games against itself with ai.AlphaBeta and adds the searched move
+    of every position in the first plies moves to builder. To reach more
+    positions, a random move is played instead with probability explore.
+    Each position (up to symmetry) is only searched once. Returns the number
+    of searches.
+    """
+    from ai import AlphaBeta
+
+    rng = random.Random(seed)
+    searcher = AlphaBeta(time_limit=time_limit)
+    rows, cols = builder.rows, builder.cols
+    # canonical key -> the searched move in the canonical version of the position
+    searched = {}
+    for _ in range(games):
+        game = Rules()
+        for _ in range(plies):
+            if game.winner:
+                break
+            key, symmetry = canonical(game.board, game.get_active_player(), rows, cols)
+            if key not in searched:
+                result = searcher.search(game)
+                if result.move is None:
+                    break
+                searched[key] = tuple(transform_square(pos, symmetry, rows, cols) for pos in result.move)
+                builder.add(game, result.move, result.score)
+            else:
+                # count the move again so positions reached often weigh more
+                builder.add(game, tuple(transform_square(pos, symmetry, rows, cols)
+                                        for pos in searched[key]))
+
+            if rng.random() < explore:
+                game.make_move(*rng.choice(list(game.legal_moves())))
+            else:
+                game.make_move(*(transform_square(pos, symmetry, rows, cols) for pos in searched[key]))
+    return len(searched)
+
+
+def main():
+    """
+    Builds or shows a book from the command line.
+    """
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["build", "show"])
+    parser.add_argument("path", help="book file")
+    parser.add_argument("--games", type=int, default=50, help="self-play games")
+    parser.add_argument("--plies", type=int, default=8, help="book depth in plies")
+    parser.add_argument("--time", type=float, default=0.2, help="seconds per searched position")
+    parser.add_argument("--explore", type=float, default=0.3,
+                        help="chance of a random move in self-play, to reach more positions")
+    parser.add_argument("--records", nargs="*", default=[],
+                        help="also add the openings of the games in these record files")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        builder = BookBuilder()
+        for path in args.records:
+            for game in record.iter_games(path):
+                builder.add_game(game.moves, args.plies)
+        searches = self_play(builder, args.games, args.plies, args.time, args.explore, args.seed)
+        count = builder.write(args.path)
+        print(f"{searches} positions searched, {len(builder.entries)} positions "
+              f"and {count} moves in the book")
+    else:
+        book = OpeningBook(args.path)
+        print(f"{len(book)} moves in the book")
+        for entry in book.lookup(Rules()):
+            origin, destination = entry.move
+            print(f"{square_name(origin)}-{square_name(destination)}: "
+                  f"weight {entry.weight}, score {entry.score}")
+        book.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""
+Contains a connection to a game server (server.py) for the pygame window.
+The window's main loop mustn't wait on the network, so messages from the
+server are read on a background thread and handed to a callback.
+"""
+import json
+import socket
+import threading
+
+from protocol import encode
+
+
+class Connection:
+    """
+    A connection to a game server. on_message is called from the reader
+    thread with each message the server sends, and with {"type": "closed"}
+    once the connection is gone.
+    """
+    def __init__(self, host, port, on_message):
+        self._socket = socket.create_connection( (host, port) )
+        # moves are tiny, so send them straight away
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._on_message = on_message
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._read, daemon=True)
+        self._thread.start()
+
+    def _read(self):
+        """
+        Reads messages until the connection closes.
+        """
+        try:
+            with self._socket.makefile("rb") as lines:
+                for line in lines:
+                    self._on_message(json.loads(line))
+        except (OSError, ValueError):
+            pass
+        self._on_message({"type": "closed"})
+
+    def send(self, message):
+        """
+        Sends a message to the server.
+        """
+        with self._lock:
+            self._socket.sendall(encode(message))
+
+    def close(self):
+        """
+        Closes the connection.
+        """
+        try:
+            self._socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._socket.close()
@@ -0,0 +1,84 @@
+"""
+Contains a small helper for measuring how the main loop spends its time:
+how long each frame takes to handle and present, and how much CPU the
+process uses while it is waiting for something to happen.
+"""
+import time
+from collections import deque
+
+
+def percentile(values, fraction):
+    """
+    Returns the value below which fraction of the sorted values fall.
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class FrameStats:
+    """
+    Collects frame times and idle CPU usage for the main loop.
+    Frame times cover handling events through to presenting the frame.
+    Idle CPU is the CPU time used by the whole process while the loop was
+    blocked waiting for events, as a percentage of the time spent waiting.
+    """
+    def __init__(self, keep=1000):
+        # only the most recent frames are kept for the percentiles
+        self.frame_times = deque(maxlen=keep)
+        self.frames = 0
+        self.idle_wall = 0.0
+        self.idle_cpu = 0.0
+        self._start_wall = time.perf_counter()
+        self._start_cpu = time.process_time()
+        self._frame_start = None
+        self._idle_start = None
+
+    def start_idle(self):
+        """
+        Call before blocking on the event queue.
+        """
+        self._idle_start = (time.perf_counter(), time.process_time())
+
+    def end_idle(self):
+        """
+        Call once the event queue returns.
+        """
+        wall, cpu = self._idle_start
+        self.idle_wall += time.perf_counter() - wall
+        self.idle_cpu += time.process_time() - cpu
+
+    def start_frame(self):
+        """
+        Call when starting to handle a batch of events.
+        """
+        self._frame_start = time.perf_counter()
+
+    def end_frame(self):
+        """
+        Call after presenting a frame. Frames that were never started are ignored.
+        """
+        if self._frame_start is None:
+            return
+        self.frame_times.append(time.perf_counter() - self._frame_start)
+        self.frames += 1
+        self._frame_start = None
+
+    def summary(self):
+        """
+        Returns a dictionary of the statistics so far. Times are in milliseconds.
+        """
+        wall = time.perf_counter() - self._start_wall
+        cpu = time.process_time() - self._start_cpu
+        times = list(self.frame_times)
+        return {
+                "frames": self.frames,
+                "fps": self.frames / wall if wall else 0.0,
+                "frame_ms_mean": 1000 * sum(times) / len(times) if times else 0.0,
+                "frame_ms_p50": 1000 * percentile(times, 0.5),
+                "frame_ms_p95": 1000 * percentile(times, 0.95),
+                "frame_ms_max": 1000 * max(times, default=0.0),
+                "cpu_percent": 100 * cpu / wall if wall else 0.0,
+                "idle_cpu_percent": 100 * self.idle_cpu / self.idle_wall if self.idle_wall else 0.0,
+               }
@@ -1,377 +1,615 @@
 """
 Contains classes and methods for creating a new game of Hasami Shogi
+
+pygame and graphics.py are only loaded once a Game is created, so tools
+that import this module don't pay for starting pygame.
 """
+import argparse
+import importlib.util
+import logging
+import os
 import sys
-import pygame
-import graphics
+import threading
+import time
+from ai import AlphaBeta
+from analysis import Analyser
+from book import OpeningBook
+from client import Connection
+from framestats import FrameStats
+from instrument import flush_logs, instruments, setup_logging
+from mcts import MCTS
+from movecache import MoveCache
+from record import RecordWriter, move_to_text
+from rules import Rules
+from protocol import DEFAULT_PORT, board_from_list
+from tablebase import TablebaseSet
+from variants import STANDARD, VARIANTS, get_variant
+
+
+def lazy_import(name):
+    """
+    Returns the module name, which is only really imported when one of its
+    attributes is first used.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+pygame = lazy_import("pygame")
+graphics = lazy_import("graphics")
+
+log = logging.getLogger("hasami")
 
-class Game:
+class Game(Rules):
     """
     An instance of Hasami Shogi.
     Initializes the game window and represents game state information
-    using Pygame by calling functions from graphics.py. 
+    using Pygame by calling functions from graphics.py. The rules themselves
+    live in rules.py so they can run without a window.
 
     with help from Michael Maranan's Pygame Checkers tutorial:
     https://thepythoncode.com/article/make-a-checkers-game-with-pygame-in-python
     """
-    # constants
-    ROWS = 9
-    COLS = 9
-
-    def __init__(self):
+    # most frames presented per second
+    FPS = 30
+    # longest the loop sleeps waiting for an event, in milliseconds
+    IDLE_TIMEOUT = 1000
+    # seconds between updates of the debug overlay
+    OVERLAY_INTERVAL = 0.5
+
+    def __init__(self, ai_players=None, show_stats=False, record_path=None, tablebases=None,
+                 book=None, server=None, variant=None, headless=False, log_level="INFO",
+                 profile_path=None):
+        # maps "BLACK" and/or "RED" to the searcher (AlphaBeta or MCTS) playing that colour
+        self.ai_players = ai_players or {}
+        # the thread searching for the computer's move, and what it found
+        self._ai_thread = None
+        self._ai_result = None
         # initialize the window and the game board.
         # window size is currently defined in graphics.py but may make dynamic later
-        self.graphics = graphics.Graphics()
+        # headless draws offscreen with no window, and ends once the game is over
+        self.headless = headless
+        variant = variant or STANDARD
+        self.graphics = graphics.Graphics(variant.rows, variant.cols, headless)
+        # events the other threads wake the main loop with: the computer player's
+        # search finishing, and each message from the server, in event.message
+        self.AI_DONE = pygame.USEREVENT + 1
+        self.NET_MESSAGE = pygame.USEREVENT + 2
         # handles pygame
         self.running = True
         self.fps = pygame.time.Clock()
+        # frame time and idle CPU measurements, logged on exit with show_stats
+        self.frame_stats = FrameStats()
+        self.show_stats = show_stats
+        # messages go through a buffered logger rather than straight to stdout
+        setup_logging(log_level)
+        # with profile_path, time the hot methods and write the timings there on exit
+        self.profile_path = profile_path
+        if profile_path:
+            instruments.enable()
+        # the debug overlay (F3) and when it was last updated
+        self.show_overlay = False
+        self._overlay_updated = 0.0
+        # endgame tables to look positions up in after each move, if any
+        self.tablebases = tablebases
+        # opening book for hints, if any
+        self.book = book
+        # background analysis of the position, toggled with the a key
+        self.analyser = None
+        self._analysed_key = None
+        # legal moves and capture previews of the position, for selecting and hovering
+        self.move_cache = MoveCache()
+        # squares highlighted as captured by the move under the mouse
+        self._preview = ()
 
         # initialize new game state
-        self.reset_game_state()
+        super().__init__(variant)
+
+        # archive every game played to record_path, adding to it if it already exists.
+        # record files only say how big the board is, not which rules were played
+        if record_path and self.VARIANT != STANDARD:
+            raise ValueError("game records are variant 1 only")
+        if record_path:
+            self.recorder = RecordWriter(record_path, self.ROWS, self.COLS,
+                                         append=os.path.exists(record_path))
+
+        # with server=(host, port), play online: the server checks and plays
+        # the moves, and this window only shows them
+        self.connection = None
+        # our colour in the online match, and whether a move is waiting on the server
+        self.net_color = None
+        self._move_sent = False
+        if server:
+            self.connection = Connection(*server, self._post_message)
+            self.connection.send({"type": "join"})
+            log.info("Waiting for an opponent...")
+
+    def _post_message(self, message):
+        """
+        Hands a message from the server to the main loop. Called on the network thread.
+        """
+        pygame.event.post(pygame.event.Event(self.NET_MESSAGE, message=message))
+
+    def _is_local_turn(self):
+        """
+        Returns True when the player to move is at this window, rather than
+        online, and has no move waiting on the server.
+        """
+        if self.connection is None:
+            return True
+        return self._active_player == self.net_color and not self._move_sent
+
+    def submit_move(self, origin, destination):
+        """
+        Plays a move chosen in this window, or sends it to the server when playing online.
+        """
+        if self.connection is None:
+            self.play_move(origin, destination)
+        else:
+            self._move_sent = True
+            self.connection.send({"type": "move", "origin": list(origin),
+                                  "destination": list(destination)})
+
+    def handle_message(self, message):
+        """
+        Updates the game from a message sent by the server.
+        """
+        kind = message["type"]
+        if kind == "start":
+            self.net_color = message["color"]
+            self._move_sent = False
+            self.set_position(board_from_list(message["board"]), message["turn"])
+            log.info("Match %s started, playing %s", message["match"], self.net_color)
+        elif kind == "moved":
+            # the server has already checked the move, so just show it
+            board = dict(self.board)
+            board[tuple(message["destination"])] = board.pop(tuple(message["origin"]))
+            for pos in message["captured"]:
+                del board[tuple(pos)]
+            self._move_sent = False
+            self.set_position(board, message["turn"])
+            self.winner = message["winner"]
+        elif kind == "error":
+            self._move_sent = False
+            log.warning("Server: %s", message["message"])
+        elif kind == "left":
+            log.info("Your opponent left; click New Game for another match")
+        elif kind == "closed":
+            log.warning("Lost the connection to the server")
+            self.net_color = None
+        self._selected_piece = None
+        self.graphics.draw(self.board, self._active_player)
 
     def reset_game_state(self):
         """
         Resets the game state to its initial conditions.
         called when the player clicks the new game button.
         """
-
-        # track the board state using a dictionary
-        # pawns are recorded using xy coords as keys in a tuple
-        self.board = self.create_board()
-        # initialize player turn to black as they always start
-        self._active_player = "BLACK"
-        # initialize dictionary to hold how many pieces lost by each player
-        self._pieces_remaining = {
-                                  "BLACK": 9,
-                                  "RED": 9,
-                                 }
+        super().reset_game_state()
         self._selected_piece = None
-        # initialize the new game as unfinished
-        self.winner = None
         # draw the pieces onto the board
         self.graphics.draw(self.board, self._active_player)
 
-
-    def create_board(self):
+    def play_move(self, origin, destination):
         """
-        Create the game board using a dictionary. The keys of each item are
-        a tuple representing coordinates on the board such that the first item key is (0, 0).
-        The value of each item represents whether that square is occupied by either
-        color of pawn or is unoccupied.
+        Moves the active player's selected piece.
+        Updates the board
         """
-        # create a new dictionary to hold the squares
-        new_board = {}
-        # list of the row letters to iterate through
-        for y in range (self.ROWS):
-            for x in range (self.COLS):
-                # fill the top row with Red pawns
-                if y == 0:
-                    new_board[ (x, y) ] = 'RED'
-                # fill the bottom row with Black pawns
-                elif y == 8:
-                    new_board[ (x, y) ] = 'BLACK'
-                # the rest of the board starts empty
-                #else:
-                #    new_board[ (x, y) ] = '.'
+        log.debug("Selected piece: %s", origin)
+        undo = super().play_move(origin, destination)
 
-        return new_board
+        for _ in undo.captured or ():
+            # captured pieces always belong to the player who didn't move
+            if undo.player == "BLACK":
+                log.debug("RED PIECE CAPTURED!")
+            else:
+                log.debug("BLACK PIECE CAPTURED!")
 
+        # and redraw the shogi board
+        self.graphics.draw(self.board, self._active_player)
 
+        if self.tablebases is not None:
+            hit = self.tablebases.probe(self)
+            if hit is not None and hit.winner:
+                log.info("Tablebase: %s wins in %d plies", hit.winner, hit.plies)
+            elif hit is not None:
+                log.info("Tablebase: draw")
 
-    def test_move(self, origin):
+        return undo
+
+    def takeback(self):
         """
-        Ensures that a given move is legal by checking that destination
-        is either horizontal or vertical to origin. Also checks to make sure there is no 
-        collision with other pieces. Returns True if move is legal, else returns False
+        Takes back the last move and redraws the board.
         """
-        # set to hold all possible moves from origin square. pawns can move horizontally
-        # or vertically like rooks. pawns cannot jump other pawns
-        legal_moves = set()
-
-        x, y = origin
-
-        # check horizontal spaces, first by checking to the right of origin
-
-        if x < self.COLS - 1:
-            for col in range(x + 1, self.COLS):
-                if not self.board.get( (col, y) ):
-                    legal_moves.add( (col, y) )
-                else:
-                    break
-        # then look to the left
-        if x > 0:
-            for col in range(x - 1, -1, -1):
-                if not self.board.get( (col, y) ):
-                    legal_moves.add( (col, y) )
-                else:
-                    break
-        # check vertical spaces starting with squares below origin
-        if y < self.ROWS - 1:
-            for row in range(y + 1, self.ROWS):
-                if not self.board.get( (x, row) ):
-                    legal_moves.add( (x, row ))
-                else:
-                    break
-        # then look at squares above origin
-        if y > 0:
-            for row in range(y - 1, -1, -1):
-                if not self.board.get( (x, row) ):
-                    legal_moves.add( (x, row) )
-                else:
-                    break
-
-        return legal_moves
-
+        undo = super().takeback()
+        self._selected_piece = None
+        self.graphics.draw(self.board, self._active_player)
+        return undo
 
-    def check_captures(self, pos):
+    def redo(self):
         """
-        Method called by make_move to check if any captures
-        are made by move.
-        First check if any opposing player pawns are adjacent to pawn that was just moved.
-        If yes then checks what is on the opposite site of opposing pawn.
-        If it is an empty square or off the board then return False. If it is a pawn belonging
-        to the active player then return the position of the captured pawn to make_move.
-        If two or more pawns of the opposing player are lined next to pawn then keep checking
-        until there is either an empty square, board boundary or pawn belonging to the player.
-
-        Also checks for corner captures by calling test_move on the active pawn and one perpendicular
-        pawn belonging to the active player surrounding an enemy pawn. Tests movement towards nearest
-        boundary by moving one square. If movement would take both off the board then corner capture
-        is True.
+        Replays the last move taken back and redraws the board.
         """
-        # initialize a list to hold capture positions to send back to make_move
-        capture_list = []
+        undo = super().redo()
+        self._selected_piece = None
+        self.graphics.draw(self.board, self._active_player)
+        return undo
 
-        # if origin is in corner cap position, then check if corner capture
-        corner_cap_positions = { (0, 1), (1, 0), (7, 0), (8, 1),
-                                   (0, 7), (1, 8), (7, 8), (8, 7) }
+    def show_hint(self):
+        """
+        Highlights the opening book's move for the position, if it has one.
+        """
+        entry = self.book.choose(self) if self.book is not None and not self.winner else None
+        if entry is None:
+            log.info("No book move for this position")
+            return
+        log.info("Book move: %s to %s (played %d times)", entry.move[0], entry.move[1], entry.weight)
+        self._selected_piece = None
+        self.graphics.draw(self.board, self._active_player)
+        self.graphics.highlight_square(entry.move)
 
-        # get the opposing player
-        if self._active_player == "BLACK":
-            opponent = "RED"
+    def toggle_analysis(self):
+        """
+        Turns the background analysis on or off.
+        """
+        if self.analyser is None:
+            self.analyser = Analyser()
+            log.info("Analysis on")
         else:
-            opponent = "BLACK"
-
-        # check for special corner captures
-        if pos in corner_cap_positions:
-            corner_capture = self.check_corner_cap(pos, opponent)
-            # returns None if no corner captures
-            if corner_capture is not None:
-                capture_list.append(corner_capture)
-
-        x, y = pos
-
-        # check for captures above piece
-        if y > 1:
-            n = 1
-            temp_caps = []
-            while self.board.get( (x, y - n) ) == opponent:
-                temp_caps.append( (x, y - n) )
-                n += 1
-
-            if n > 1:
-                if self.board.get( (x, y - n) ) == self._active_player:
-                    for piece in temp_caps:
-                        capture_list.append(piece)
-
-        # check for captures below piece
-        if y < self.ROWS - 2:
-            n = 1
-            temp_caps = []
-            while self.board.get( (x, y + n) ) == opponent:
-                temp_caps.append( (x, y + n) )
-                n += 1
-            if n > 1:
-                if self.board.get( (x, y + n) ) == self._active_player:
-                    for piece in temp_caps:
-                        capture_list.append(piece)
-
-
-        # check for captures left of piece
-        if x > 1:
-            n = 1
-            temp_caps = []
-            while self.board.get( (x - n, y) ) == opponent:
-                temp_caps.append( (x - n, y) )
-                n += 1
-
-            if n > 1:
-                if self.board.get( (x - n, y) ) == self._active_player:
-                    for piece in temp_caps:
-                        capture_list.append(piece)
-
-        # check for captures right of piece
-        if x < self.COLS - 2:
-            n = 1
-            temp_caps = []
-            while self.board.get( (x + n, y) ) == opponent:
-                temp_caps.append( ( x + n, y) )
-                n += 1
-            if n > 1:
-                if self.board.get( (x + n, y) ) == self._active_player:
-                    for piece in temp_caps:
-                        capture_list.append(piece)
-
-
-        return capture_list
-
-    def check_corner_cap(self, origin, opponent):
-        """
-        Helper method called by check_captures to check
-        for special corner_captures.
-        """
-        x, y = origin
-
-        # will hold any captured corner piece
-        capture = None
-        top_left = { (0, 1), (1, 0) }
-        top_right = { (7, 0), (8, 1) }
-        bottom_left = { (0, 7), (1, 8) }
-        bottom_right = { (7, 8), ( 8, 7) }
-
-        if origin in top_left:
-            for pos in top_left:
-                if self.board.get(pos) != self._active_player:
-                    return None
-            if self.board.get( (0, 0) ) == opponent:
-                capture = (0, 0)
-
-        elif origin in top_right:
-            for pos in top_right:
-                if self.board.get(pos) != self._active_player:
-                    return None
-                if self.board.get( (8, 0) ) == opponent:
-                    capture = (8, 0)
-
-        elif origin in bottom_left:
-            for pos in bottom_left:
-                if self.board.get(pos) != self._active_player:
-                    return None
-            if self.board.get( (0, 8) ) == opponent:
-                capture = (0, 8)
-
-        elif origin in bottom_right:
-            for pos in bottom_right:
-                if self.board.get(pos) != self._active_player:
-                    return None
-            if self.board.get( (8, 8) ) == opponent:
-                capture = (8, 8)
-
-        return capture
-
-    def make_move(self, origin, destination):
+            self._stop_analysis()
+            self.analyser.close()
+            self.analyser = None
+            log.info("Analysis off")
+
+    def _stop_analysis(self):
         """
-        Moves the active player's selected piece.
-        Updates the board
+        Cancels the analysis straight away and clears what it showed.
         """
-        print("Selected piece: " + str(origin))
-        # update the board: copy the piece to the clicked square,
-        self.board[ (destination) ] = self._active_player
-        # remove it from its origin,
-        del self.board[ (origin) ]
-        #self.board[ (origin) ] = '.'
-
-        # checking if the move makes any captures
-        cap_list = self.check_captures(destination)
-
-        # remove captured pieces from the board
-        for piece in cap_list:
-            # record whether the captured piece was black or red
-            if self.board[piece] == "BLACK":
-                self._pieces_remaining["BLACK"] -= 1
-                print("BLACK PIECE CAPTURED!")
-            else:
-                self._pieces_remaining["RED"] -= 1
-                print("RED PIECE CAPTURED!")
+        if self.analyser is None or not self.analyser.active:
+            return
+        self.analyser.cancel()
+        self._analysed_key = None
+        if self._selected_piece is None:
+            self.graphics.draw(self.board, self._active_player)
+        self.graphics.show_analysis(None)
 
-            # and delete the captured piece from the game board
-            del self.board[ (piece) ]
+    def _update_analysis(self):
+        """
+        Keeps the analyser working on the position on the board and shows its
+        newest best line. Analysis pauses while a piece is selected, while the
+        computer is thinking and once the game is over.
+        """
+        if self.analyser is None:
+            return
+        if self.winner or self._selected_piece is not None or self._ai_thread is not None:
+            self._stop_analysis()
+            return
+        if not self.analyser.active or self._analysed_key != self.key:
+            self.analyser.start(self)
+            self._analysed_key = self.key
+            self.graphics.draw(self.board, self._active_player)
+            self.graphics.show_analysis("Analysing...")
+            return
 
-        # switch the active player following a legal move
-        self._update_turn()
-        # and redraw the shogi board
+        result = self.analyser.poll()
+        if result is None or not result.line:
+            return
+        # replay the line on a copy to name its captures
+        snapshot = Rules(self.VARIANT)
+        snapshot.set_position(self.board, self._active_player)
+        moves = []
+        for origin, destination in result.line:
+            undo = snapshot.make_move(origin, destination)
+            moves.append(move_to_text(origin, destination, undo.captured or (), self.COLS))
         self.graphics.draw(self.board, self._active_player)
+        self.graphics.highlight_square(result.line[0], graphics.ANALYSIS_COLOR)
+        self.graphics.show_analysis(f"depth {result.depth}, {self._active_player} {result.score:+d}: "
+                                    + " ".join(moves))
 
+    def toggle_overlay(self):
+        """
+        Shows or hides the debug overlay, timing the hot methods while it is shown.
+        """
+        self.show_overlay = not self.show_overlay
+        if self.show_overlay:
+            instruments.enable()
+            self._overlay_updated = 0.0
+        else:
+            # keep timing for the profile written on exit
+            if not self.profile_path:
+                instruments.disable()
+            self.graphics.show_overlay(None)
+            self.graphics.draw(self.board, self._active_player)
 
-    def _update_turn(self):
+    def _update_overlay(self):
         """
-        Flips the active player depending on whether it's RED or BLACKs turn
-        following a legal move. Ends the game if a player has 1 or 0 pawns remaining.
+        Refreshes the debug overlay's numbers every OVERLAY_INTERVAL seconds.
         """
+        now = time.perf_counter()
+        if not self.show_overlay or now - self._overlay_updated < self.OVERLAY_INTERVAL:
+            return
+        self._overlay_updated = now
+        frames = self.frame_stats.summary()
+        lines = [f"fps {frames['fps']:.1f}  frame p50 {frames['frame_ms_p50']:.2f}ms "
+                 f"p95 {frames['frame_ms_p95']:.2f}ms max {frames['frame_ms_max']:.2f}ms",
+                 f"idle cpu {frames['idle_cpu_percent']:.1f}%  "
+                 f"pixels/frame {self.graphics.stats['pixels'] / max(1, self.graphics.stats['frames']):,.0f}"]
+        self.graphics.show_overlay(lines + instruments.lines())
+
+    def write_profile(self):
+        """
+        Writes the method timings and frame statistics to profile_path.
+        """
+        instruments.dump(self.profile_path, frames=self.frame_stats.summary(),
+                         graphics=self.graphics.stats, move_cache=self.move_cache.stats)
+        log.info("Profile written to %s", self.profile_path)
 
-        if self._pieces_remaining["BLACK"] < 2:
-            self.winner = "RED"
+    def preview_move(self, destination):
+        """
+        Highlights the pawns the selected piece would capture by moving to
+        destination, replacing the last preview. Nothing is highlighted when
+        destination isn't one of its moves.
+        """
+        captured = ()
+        if self._selected_piece and destination is not None:
+            captured = self.move_cache.captures(self, self._selected_piece, destination)
+        if captured == self._preview:
             return
+        self.graphics.clear_highlight(self._preview)
+        self.graphics.highlight_square(captured, graphics.CAPTURE_COLOR)
+        self._preview = captured
 
-        if self._pieces_remaining["RED"] < 2:
-            self.winner = "BLACK"
+    def _update_ai(self):
+        """
+        Starts a search in a background thread when it is a computer player's
+        turn, and plays its move once the search has finished. The search runs
+        outside the main loop so the window keeps responding while it thinks.
+        """
+        if self._ai_thread is not None:
+            if self._ai_thread.is_alive():
+                return
+            self._ai_thread = None
+            key, result = self._ai_result
+            # ignore the result if the position changed while searching,
+            # e.g. after a takeback or a new game
+            if key == self.key and not self.winner and result.move:
+                stats = ", ".join(f"{name} {value:,.4g}" for name, value in result._asdict().items()
+                                  if name != "move")
+                log.info("%s plays %s: %s", self._active_player, result.move, stats)
+                self.submit_move(*result.move)
+
+        searcher = self.ai_players.get(self._active_player)
+        if searcher is None or self.winner or not self._is_local_turn():
+            return
 
-        # else switch the active player
-        if self._active_player == "BLACK":
-            self._active_player = "RED"
-        else:
-            self._active_player = "BLACK"
+        # search a snapshot so the game can't change under the search
+        snapshot = Rules(self.VARIANT)
+        snapshot.set_position(self.board, self._active_player)
+        key = self.key
 
+        def think():
+            self._ai_result = (key, searcher.search(snapshot))
+            # wake up the main loop to play the move
+            pygame.event.post(pygame.event.Event(self.AI_DONE))
+
+        self._ai_thread = threading.Thread(target=think, daemon=True)
+        self._ai_thread.start()
 
     def main_loop(self):
         """
-        main game loop
+        main game loop.
+        Sleeps until an event arrives instead of polling, and only presents a
+        frame when something on screen changed, at most FPS times a second.
         """
-        while self.running is True:
+        mouse_pos = None
+        possible_moves = frozenset()
+        game_over_shown = False
 
-            for self.event in pygame.event.get():
+        while self.running is True:
+            # start the computer's search, or play the move it found
+            self._update_ai()
+            # and keep the analysis up to date
+            self._update_analysis()
+
+            # only draw the game over message once per game
+            if not self.winner:
+                game_over_shown = False
+            elif not game_over_shown:
+                self.graphics.display_game_over(self.winner)
+                game_over_shown = True
+                # nobody is watching a headless game, so stop once it is over
+                if self.headless:
+                    pygame.event.post(pygame.event.Event(pygame.QUIT))
+
+            self._update_overlay()
+
+            # update only the parts of the window that changed
+            if self.graphics.dirty_rects:
+                self.graphics.present()
+                self.frame_stats.end_frame()
+                self.fps.tick(self.FPS)
+
+            # block until something happens, then take everything that's queued
+            # wake up for the analysis' next line while it runs
+            timeout = self.IDLE_TIMEOUT
+            if self.analyser is not None and self.analyser.active:
+                timeout = int(1000 * self.analyser.interval)
+            # and for the overlay's next update
+            if self.show_overlay:
+                timeout = min(timeout, int(1000 * self.OVERLAY_INTERVAL))
+            # write out the frame's log messages in one go before sleeping
+            flush_logs()
+            self.frame_stats.start_idle()
+            events = [pygame.event.wait(timeout)] + pygame.event.get()
+            self.frame_stats.end_idle()
+            self.frame_stats.start_frame()
+
+            for self.event in events:
 
                 if self.event.type == pygame.QUIT:
                     self.running = False
+                    if self.show_stats:
+                        log.info("%s", self.frame_stats.summary())
+                    if self.profile_path:
+                        self.write_profile()
+                    if self.recorder is not None:
+                        self.recorder.end_game(self.winner)
+                        self.recorder.close()
+                    if self.connection is not None:
+                        self.connection.close()
+                    if self.analyser is not None:
+                        self.analyser.close()
+                    flush_logs()
                     pygame.quit()
                     sys.exit()
 
                 # next check if reset button clicked - only time we care about mouse up
                 # helps debounce and prevent accidental clicks
-                if self.event.type == pygame.MOUSEBUTTONUP:
+                if self.event.type == pygame.MOUSEBUTTONUP and mouse_pos:
                     mouse_up = pygame.mouse.get_pos()
                     # ensure reset button was both clicked and released
                     if self.graphics.button_press(mouse_pos) and self.graphics.button_press(mouse_up):
                         self.reset_game_state()
+                        if self.connection is not None:
+                            # online, a new game means a new match
+                            self.net_color = None
+                            self.connection.send({"type": "join"})
+
+                if self.event.type == self.NET_MESSAGE:
+                    self.handle_message(self.event.message)
+
+                # left and right arrow keys take back and redo moves, except online
+                if self.event.type == pygame.KEYDOWN:
+                    if self.event.key == pygame.K_LEFT and self.connection is None:
+                        self.takeback()
+                    elif self.event.key == pygame.K_RIGHT and self.connection is None:
+                        self.redo()
+                    elif self.event.key == pygame.K_h:
+                        self.show_hint()
+                    elif self.event.key == pygame.K_a:
+                        self.toggle_analysis()
+                    elif self.event.key == pygame.K_F3:
+                        self.toggle_overlay()
+
+                # moving the mouse over one of the selected piece's moves previews its captures
+                if self.event.type == pygame.MOUSEMOTION and self._selected_piece:
+                    hovered = self.graphics.get_occupant(self.event.pos)
+                    self.preview_move(hovered if hovered in possible_moves else None)
 
                 if self.event.type == pygame.MOUSEBUTTONDOWN:
                     # get the position of the click
                     mouse_pos = pygame.mouse.get_pos()
-                    if not self.winner:
+                    # the computer's pieces, and the online opponent's, can't be moved by clicking
+                    if not self.winner and self._active_player not in self.ai_players \
+                       and self._is_local_turn():
 
                         # and check that occupant at position matches player whose turn it is
                         clicked_square = self.graphics.get_occupant(mouse_pos)
 
+                        # clicking the selected piece again changes nothing
+                        if clicked_square == self._selected_piece:
+                            pass
+
                         # check that clicked square contains piece belonging to active player
-                        if self.board.get(clicked_square) == self._active_player:
+                        elif self.board.get(clicked_square) == self._active_player:
 
+                            # stop the analysis before anything else so it lets go of the CPU
+                            self._stop_analysis()
                             self._selected_piece = clicked_square
+                            self._preview = ()
                             # refresh the board/clear any existing highlights
                             self.graphics.draw(self.board, self._active_player)
-                            # show all available moves from origin
-                            possible_moves = self.test_move(self._selected_piece)
+                            # show all available moves from origin, worked out once per position
+                            possible_moves = self.move_cache.moves(self, self._selected_piece)
                             # highlight the squares that the selected piece can legally move to
                             self.graphics.highlight_square(possible_moves)
 
                         # also check if clicked square is a legal move for the selected piece.
                         elif self._selected_piece and clicked_square in possible_moves:
+                            self._stop_analysis()
                             # call make move method
-                            self.make_move(self._selected_piece, clicked_square)
+                            self.submit_move(self._selected_piece, clicked_square)
                             # reset the selected piece and move set once the move is made
                             self._selected_piece = None
-                            possible_moves = None
-
-            if self.winner:
-                self.graphics.display_game_over(self.winner)
+                            self._preview = ()
+                            possible_moves = frozenset()
 
 
-            # redraw the pygame board
-            #self.graphics.draw(self.board)
-            pygame.display.update()
-            #self.fps.tick(30)
+def parse_args():
+    """
+    Parses the command line options.
+    """
+    parser = argparse.ArgumentParser(description="Play Hasami Shogi.")
+    parser.add_argument("--ai", choices=["BLACK", "RED", "BOTH"], type=str.upper,
+                        help="let the computer play this colour")
+    parser.add_argument("--time", type=float, default=2.0,
+                        help="seconds the computer may think per move")
+    parser.add_argument("--engine", choices=["alphabeta", "mcts"], default="alphabeta",
+                        help="how the computer searches for moves")
+    parser.add_argument("--stats", action="store_true",
+                        help="print frame time and CPU usage statistics on exit")
+    parser.add_argument("--record", metavar="PATH",
+                        help="save every game played to this game record file")
+    parser.add_argument("--tablebase", metavar="DIR",
+                        help="directory of endgame tables built by tablebase.py")
+    parser.add_argument("--book", metavar="PATH",
+                        help="opening book built by book.py, for the computer and for hints (h key)")
+    parser.add_argument("--connect", metavar="HOST[:PORT]",
+                        help="play online against another player through a game server (server.py)")
+    parser.add_argument("--variant", choices=list(VARIANTS), default=STANDARD.name,
+                        help="which game to play: hasami (variant 1), dai (Dai Hasami Shogi), "
+                             "or variant 1 on a bigger board")
+    parser.add_argument("--log-level", default="INFO", type=str.upper,
+                        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help="least important messages to show; DEBUG shows every move")
+    parser.add_argument("--profile", metavar="PATH",
+                        help="time the rules engine and drawing, and write the timings and frame "
+                             "statistics to this JSON file on exit (F3 shows them on screen)")
+    parser.add_argument("--headless", action="store_true",
+                        help="run without a window (SDL's dummy video driver) until the game "
+                             "ends, e.g. for computer games with --record")
+    args = parser.parse_args()
+    if args.headless and not (args.ai == "BOTH" or (args.ai and args.connect)):
+        parser.error("--headless needs the computer to make every move: "
+                     "use --ai both, or --ai with --connect")
+    # the server and the Monte Carlo player only know variant 1
+    if args.variant != STANDARD.name and args.connect:
+        parser.error("online games are variant 1 only")
+    if args.variant != STANDARD.name and args.engine == "mcts":
+        parser.error("the mcts engine only plays variant 1")
+    # and a record file can't say which variant its games are
+    if args.variant != STANDARD.name and args.record:
+        parser.error("game records are variant 1 only")
+    return args
 
 
 if __name__ == "__main__":
 
-    new_game = Game()
+    args = parse_args()
+    tablebases = TablebaseSet(args.tablebase) if args.tablebase else None
+    book = OpeningBook(args.book) if args.book else None
+    players = {}
+    if args.ai:
+        for color in ("BLACK", "RED"):
+            if args.ai in (color, "BOTH"):
+                if args.engine == "mcts":
+                    players[color] = MCTS(time_limit=args.time)
+                else:
+                    players[color] = AlphaBeta(time_limit=args.time, tablebases=tablebases, book=book)
+
+    server = None
+    if args.connect:
+        host, _, port = args.connect.partition(":")
+        server = (host, int(port or DEFAULT_PORT))
+
+    new_game = Game(players, show_stats=args.stats, record_path=args.record,
+                    tablebases=tablebases, book=book, server=server, variant=get_variant(args.variant),
+                    headless=args.headless, log_level=args.log_level, profile_path=args.profile)
     new_game.main_loop()
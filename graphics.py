@@ -5,39 +5,167 @@ With help from Tech With Jim's lovely checkers pygame implementation:
 https://www.youtube.com/watch?v=vnd3RfeG3NM
 Also used Arslan Mirza's Chess pygame tutorial:
 https://medium.com/javarevisited/how-to-build-a-chess-game-with-pygame-in-python-9eb0a7591776
+
+Importing this module doesn't start pygame; the display and font
+subsystems are initialised when the first window is created.
 """
+import os
 import sys
+from collections import OrderedDict
+from functools import lru_cache
 import pygame
 
 # constants, but may experiment with enabling scaling in an options menu
 
 WIN_WIDTH, WIN_HEIGHT = 750, 750
-# Hasami Shogi boardsize is 9x9
+# Hasami Shogi boardsize is 9x9, though other variants can ask for other sizes
 ROWS, COLS = 9, 9
 # board is a surface that is blit'd onto screen
 BOARD_WIDTH, BOARD_HEIGHT = (WIN_WIDTH - 100), (WIN_HEIGHT - 100)
 # height and width of each individual square,
 # floor division is making board tiling wonky depending on screen size
 HIGHLIGHT_COLOR = (100, 250, 90)
+# squares of the analysis' best move
+ANALYSIS_COLOR = (120, 170, 250)
+# pawns the move under the mouse would capture
+CAPTURE_COLOR = (250, 130, 110)
+# the debug overlay's box is a fixed width so each update covers the last
+OVERLAY_WIDTH = 520
 SQUARE_SIZE = BOARD_WIDTH // COLS
-# board letters
-ROW_LETTERS = ('a', 'b', 'c', 'd', 'e', 'f', 'g', 'h', 'i')
+# board letters, enough for a 19x19 board
+ROW_LETTERS = tuple('abcdefghijklmnopqrs')
+
+
+# most rendered text surfaces kept by render_text
+TEXT_CACHE_SIZE = 256
+# rendered text surfaces keyed by (face, size, bold, italic, text, color),
+# least recently used first
+_text_cache = OrderedDict()
+
+
+def init_display(headless=False):
+    """
+    Initialises the pygame subsystems the window uses, the display and fonts,
+    rather than everything pygame.init() would start (audio, joysticks...).
+    With headless, uses SDL's dummy video driver so no window is shown and no
+    display is needed, e.g. for rendering offscreen. headless only has an
+    effect before the display is first initialised.
+    """
+    if not pygame.display.get_init():
+        if headless:
+            os.environ["SDL_VIDEODRIVER"] = "dummy"
+        pygame.display.init()
+    if not pygame.font.get_init():
+        pygame.font.init()
+
+
+@lru_cache(maxsize=None)
+def get_font(face, size, bold=False, italic=False):
+    """
+    Returns the system font with the given face, size and style.
+    SysFont scans the installed fonts, so each font is only looked up once.
+    """
+    if not pygame.font.get_init():
+        pygame.font.init()
+    return pygame.font.SysFont(face, size, bold=bold, italic=italic)
+
+
+def render_text(text, size, color, face='arial', bold=False, italic=False):
+    """
+    Returns an antialiased surface of text in the given font and color.
+    Surfaces are cached, so text that is drawn again isn't rasterized again.
+    The least recently used surfaces are dropped once there are more than
+    TEXT_CACHE_SIZE of them.
+    """
+    key = (face, size, bold, italic, text, color)
+    surface = _text_cache.get(key)
+    if surface is not None:
+        _text_cache.move_to_end(key)
+        return surface
 
+    surface = get_font(face, size, bold, italic).render(text, True, color)
+    _text_cache[key] = surface
+    if len(_text_cache) > TEXT_CACHE_SIZE:
+        _text_cache.popitem(last=False)
+    return surface
 
-pygame.init()
+# loaded piece images, already rotated, scaled and converted, keyed by (color, size)
+_sprite_cache = {}
 
-pygame.font.init()
-main_font = pygame.font.SysFont('arial', 20)
+
+def get_sprite(color, size):
+    """
+    Returns the image for a piece of the given color scaled to size x size pixels.
+    Each image is only loaded from disk, rotated and scaled the first time it
+    is asked for at a size. Asking for a new size empties the cache.
+    """
+    key = (color, size)
+    sprite = _sprite_cache.get(key)
+    if sprite is not None:
+        return sprite
+
+    # the square size changed, so the old sprites are no use any more
+    if any(cached_size != size for _, cached_size in _sprite_cache):
+        _sprite_cache.clear()
+
+    # relative to this file, so the pieces are found from any working directory
+    sprite = pygame.image.load(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                            "pieces", f"{color.lower()}_piece.png"))
+
+    # red pieces should be rotated 180 degrees as though they are facing opposite player
+    if color == "RED":
+        sprite = pygame.transform.rotate(sprite, 180)
+
+    # scale the piece pngs using the square size based on the set board resolution
+    sprite = pygame.transform.smoothscale(sprite, (size, size))
+
+    # match the display's pixel format so blitting is fast. needs a display mode set
+    if pygame.display.get_surface() is not None:
+        sprite = sprite.convert_alpha()
+
+    _sprite_cache[key] = sprite
+    return sprite
 
 class Graphics:
     """
     Class containing methods and attributes to create, update,
     and display the shogi game window and board using Pygame.
+
+    Everything that never changes (grid, labels, border, button) is rendered
+    once onto a background layer. After that only the squares whose piece or
+    highlight changed are redrawn, and present() updates just those parts of
+    the window.
+
+    rows and cols set the size of the board; the squares shrink to fit
+    bigger boards into the same window. headless renders without showing a
+    window (see init_display).
     """
-    def __init__(self):
+    def __init__(self, rows=ROWS, cols=COLS, headless=False):
+        self.rows = rows
+        self.cols = cols
+        self.square_size = min(BOARD_WIDTH // cols, BOARD_HEIGHT // rows)
+        init_display(headless)
         self.screen = self.create_screen()
+        # static layer the squares are redrawn from
+        self.background = pygame.Surface(self.screen.get_size())
+        self.background.fill("WHITE")
         self.board = self.create_board()
         self.restart = self.new_game_button()
+        self.screen.blit(self.background, (0, 0))
+
+        # what is currently shown, so draw can work out what changed
+        self._pieces = {}
+        self._highlighted = set()
+        self._turn = None
+        self._analysis_text = None
+        # debug overlay surface shown over the top left corner, if any
+        self._overlay = None
+        self._overlay_changed = False
+        self._full_redraw = True
+        # rects of the screen changed since the last present()
+        self.dirty_rects = [self.screen.get_rect()]
+        # totals over every present(), for measuring rendering cost
+        self.stats = {"frames": 0, "pixels": 0}
 
 
     def create_screen(self):
@@ -54,89 +182,128 @@ class Graphics:
     def create_board(self):
 
         """
-        Initialize the game board
+        Initialize the game board and draw it onto the background layer
         """
         # set up the board
         board = pygame.Surface((BOARD_WIDTH, BOARD_HEIGHT))
         board.fill((250, 250, 180))
 
-        # render the rows and column coordinates
-
-
         # draw the board including col and row nums and letters
-        col_num = 9
-        row_index = 0
-
-        for x in range(0, WIN_WIDTH, SQUARE_SIZE):
-            for y in range(0, BOARD_HEIGHT, SQUARE_SIZE):
-
-                rect = pygame.Rect(x, y, SQUARE_SIZE, SQUARE_SIZE)
-                # render the column numbers
-
-                if y == 0 and x > 0 and col_num > 0:
-                    col_rect = pygame.Rect(x + 10, 10, SQUARE_SIZE, 0)
-                    col_text = main_font.render(str(col_num), True, (0, 0, 0))
-                    self.screen.blit(col_text, col_rect)
-                    # decrement col num
-                    col_num = int(col_num) - 1
-
-                # render the row letters
-                if y > 0 and x > BOARD_WIDTH:
-                    row_rect = pygame.Rect(WIN_WIDTH - 25, y, SQUARE_SIZE, 0)
-                    row_text = main_font.render(ROW_LETTERS[row_index], True, (0, 0, 0))
-                    self.screen.blit(row_text, row_rect)
-                    # increment the row index to get the next letter
-                    row_index += 1
-
+        size = self.square_size
+        # smaller labels for the smaller squares of big boards
+        label_size = min(20, size // 2)
+
+        # render the column numbers over the middle of each column, counting down from the left
+        for col in range(self.cols):
+            col_text = render_text(str(self.cols - col), label_size, (0, 0, 0))
+            self.background.blit(col_text, col_text.get_rect(center=(50 + col * size + size // 2, 20)))
+
+        # render the row letters down the right hand side
+        for row in range(self.rows):
+            row_text = render_text(ROW_LETTERS[row], label_size, (0, 0, 0))
+            self.background.blit(row_text, row_text.get_rect(center=(WIN_WIDTH - 20,
+                                                                     50 + row * size + size // 2)))
+
+        for x in range(self.cols):
+            for y in range(self.rows):
+                rect = pygame.Rect(x * size, y * size, size, size)
                 pygame.draw.rect(board, "BLACK", rect, 1)
 
         # draw a black square around the game board because it looks nice
         border = pygame.Rect(40, 40, BOARD_WIDTH + 18, BOARD_HEIGHT + 18)
-        pygame.draw.rect(self.screen, "BLACK", border, 1)
+        pygame.draw.rect(self.background, "BLACK", border, 1)
 
-        # add the board to the screen
-        self.screen.blit(board, (50, 50))
+        # add the board to the background
+        self.background.blit(board, (50, 50))
 
         return board
 
-    def draw(self, pieces, turn):
+    def square_rect(self, pos):
         """
-        Render the current board state
+        Returns the rect of the screen covered by the square at pos.
         """
+        size = self.square_size
+        return pygame.Rect(50 + pos[0] * size, 50 + pos[1] * size, size, size)
 
-        # clear area where the player turn text is displayed
-        status_rect = pygame.Rect( (BOARD_WIDTH - SQUARE_SIZE),
-                                  WIN_HEIGHT - 35, (SQUARE_SIZE * 3), 30)
-        self.screen.fill((255, 255, 255), status_rect)
-
-        # draw  player turn status text in the cleared area
-        status_text = main_font.render(str(turn + "\'s turn"), True, (turn))
-        self.screen.blit(status_text, status_rect)
-
-        self.board.fill((250, 250, 180))
-
-        for x in range(0, WIN_WIDTH, SQUARE_SIZE):
-            for y in range(0, BOARD_HEIGHT, SQUARE_SIZE):
-
-                rect = pygame.Rect(x, y, SQUARE_SIZE, SQUARE_SIZE)
-
-                pygame.draw.rect(self.board, "BLACK", rect, 1)
-
-        # go through the board dictionary and find any pieces
-        for y in range (ROWS):
-            for x in range (COLS):
-                # if piece exists at coord
-                if pieces.get( (x, y )) == 'BLACK':
-                    piece = Piece("BLACK", x, y, "pawn")
-                    # then draw it onto the board
-                    piece.draw(self.board)
-
-                elif pieces.get( (x, y )) == 'RED':
-                    piece = Piece("RED", x, y, "pawn")
-                    piece.draw(self.board)
-
+    def _draw_square(self, pos, piece, highlight=False, color=HIGHLIGHT_COLOR):
+        """
+        Redraws one square from the background, with its highlight and piece,
+        and marks it dirty.
+        """
+        rect = self.square_rect(pos)
+        self.screen.blit(self.background, rect, rect)
+        if highlight:
+            # inset to leave the grid lines alone
+            self.screen.fill(color, rect.inflate(-4, -4))
+        if piece:
+            Piece(piece, pos[0], pos[1], "pawn").draw(self.screen, rect.topleft, self.square_size)
+        self.dirty_rects.append(rect)
+
+    def invalidate(self):
+        """
+        Makes the next draw redraw the whole window.
+        """
+        self._full_redraw = True
 
-        self.screen.blit(self.board, (50, 50))
+    def draw(self, pieces, turn):
+        """
+        Render the current board state, clearing any highlights.
+        Only squares that changed since the last draw are redrawn.
+        """
+        if self._full_redraw:
+            self.screen.blit(self.background, (0, 0))
+            self.dirty_rects = [self.screen.get_rect()]
+            for pos, piece in pieces.items():
+                Piece(piece, pos[0], pos[1], "pawn").draw(self.screen, self.square_rect(pos).topleft,
+                                                          self.square_size)
+            self._highlighted = set()
+            self._turn = None
+            self._analysis_text = None
+            self._full_redraw = False
+        else:
+            drawn = self._pieces
+            changed = {pos for pos in drawn.keys() | pieces.keys()
+                       if drawn.get(pos) != pieces.get(pos)}
+            # clear any highlights too
+            for pos in changed | self._highlighted:
+                self._draw_square(pos, pieces.get(pos))
+            self._highlighted = set()
+
+        self._pieces = dict(pieces)
+
+        if turn != self._turn:
+            # clear area where the player turn text is displayed
+            status_rect = pygame.Rect( (BOARD_WIDTH - SQUARE_SIZE),
+                                      WIN_HEIGHT - 35, (SQUARE_SIZE * 3), 30)
+            self.screen.fill((255, 255, 255), status_rect)
+
+            # draw  player turn status text in the cleared area
+            status_text = render_text(str(turn + "\'s turn"), 20, turn)
+            self.screen.blit(status_text, status_rect)
+            self.dirty_rects.append(status_rect)
+            self._turn = turn
+
+    def present(self):
+        """
+        Updates the parts of the window that changed since the last call.
+        Returns the number of pixels updated.
+        """
+        if self._overlay is not None:
+            # keep the overlay on top of anything drawn underneath it
+            rect = self._overlay.get_rect()
+            if self._overlay_changed or rect.collidelist(self.dirty_rects) != -1:
+                self.screen.blit(self._overlay, rect)
+                if not self._overlay_changed:
+                    self.dirty_rects.append(rect)
+                self._overlay_changed = False
+        if not self.dirty_rects:
+            return 0
+        pixels = sum(rect.width * rect.height for rect in self.dirty_rects)
+        pygame.display.update(self.dirty_rects)
+        self.dirty_rects = []
+        self.stats["frames"] += 1
+        self.stats["pixels"] += pixels
+        return pixels
 
 
     def get_occupant(self, pos):
@@ -145,9 +312,9 @@ class Graphics:
         If one exists then return piece.
         """
 
-        row = (pos[0] - 50) // SQUARE_SIZE
+        row = (pos[0] - 50) // self.square_size
 
-        column = (pos[1] - 50) // SQUARE_SIZE
+        column = (pos[1] - 50) // self.square_size
 
         # reversed x and y since board is 2d array of rows of columns
         # piece = pieces.get( (y_square, x_square ))
@@ -155,34 +322,79 @@ class Graphics:
 
     # def highlight_square(self, squares)
     # takes a list of tuples containing coordinates of squares to be highlighted.
-    def highlight_square(self, squares):
+    def highlight_square(self, squares, color=HIGHLIGHT_COLOR):
         """
         Highlights squares on the board to indicate selected piece
         and possible moves.
         """
         for pos in squares:
-            # hacky math is to account for borders; does not scale. bad solution
-            rect = pygame.Rect(pos[0] * SQUARE_SIZE + 2, 
-                               pos[1] * SQUARE_SIZE + 2, SQUARE_SIZE - 4, SQUARE_SIZE - 4)
-            self.board.fill(HIGHLIGHT_COLOR, rect)
-            self.screen.blit(self.board, (50, 50))
+            self._draw_square(pos, self._pieces.get(pos), highlight=True, color=color)
+            self._highlighted.add(pos)
 
-    def new_game_button(self):
+    def clear_highlight(self, squares):
         """
-        Draws a New Game button onto the screen.
+        Takes the highlight off squares, leaving any other highlights alone.
         """
+        for pos in squares:
+            if pos in self._highlighted:
+                self._draw_square(pos, self._pieces.get(pos))
+                self._highlighted.discard(pos)
 
-        button_font = pygame.font.SysFont('arial', 15)
+    def show_analysis(self, text=None):
+        """
+        Shows a line of analysis between the New Game button and the turn
+        text, or clears it when text is None.
+        """
+        if text == self._analysis_text:
+            return
+        analysis_rect = pygame.Rect(170, WIN_HEIGHT - 35, 400, 30)
+        self.screen.fill((255, 255, 255), analysis_rect)
+        if text:
+            # cut long lines off rather than draw over the turn text
+            self.screen.blit(render_text(text, 15, "BLACK"), analysis_rect.move(0, 4),
+                             pygame.Rect(0, 0, analysis_rect.width, analysis_rect.height))
+        self.dirty_rects.append(analysis_rect)
+        self._analysis_text = text
+
+    def show_overlay(self, lines=None):
+        """
+        Shows lines of debug text in a box over the top left corner of the
+        window, kept on top of whatever is drawn until it is hidden again by
+        passing None.
+        """
+        if lines is None:
+            if self._overlay is not None:
+                self._overlay = None
+                # the box covered squares draw doesn't know about
+                self.invalidate()
+            return
+        # rendered straight from the font: the numbers change too often to be worth caching
+        font = get_font('couriernew', 13)
+        height = font.get_linesize()
+        overlay = pygame.Surface((OVERLAY_WIDTH, 10 + height * len(lines)))
+        overlay.fill((30, 30, 30))
+        for n, line in enumerate(lines):
+            overlay.blit(font.render(line, True, (240, 240, 240)), (5, 5 + n * height))
+        if self._overlay is not None and self._overlay.get_height() > overlay.get_height():
+            self.invalidate()
+        self._overlay = overlay
+        self._overlay_changed = True
+        self.dirty_rects.append(overlay.get_rect())
 
-        text = button_font.render("New Game", True, "BLACK")
+    def new_game_button(self):
+        """
+        Draws a New Game button onto the background.
+        """
+
+        text = render_text("New Game", 15, "BLACK")
         rect = pygame.Rect(50, WIN_HEIGHT - 35, (SQUARE_SIZE * 1.5), 30)
         # draw the button outline
 
-        pygame.draw.rect(self.screen, "BLACK", rect, 1)
+        pygame.draw.rect(self.background, "BLACK", rect, 1)
         # get the rect of the text and center it in the button rect
         text_rect = text.get_rect(center=rect.center)
 
-        self.screen.blit(text, text_rect)
+        self.background.blit(text, text_rect)
         # return the new game rect to the constructor to check for presses later
         return rect
 
@@ -201,17 +413,16 @@ class Graphics:
         the winner's name.
         """
 
-        # Set up font and message
-        font = pygame.font.SysFont('arial', 75, bold=True)
+        # Set up message
         game_over_text = "Game Over"
         winner_text = f"{winner} Wins!"
 
         # Render the messages
-        game_over_surface = font.render(game_over_text, True, (255, 180, 0)) # nice gold color
+        game_over_surface = render_text(game_over_text, 75, (255, 180, 0), bold=True) # nice gold color
 
-        game_over_shadow = font.render(game_over_text, True, (0, 0, 0))      # black shadow
+        game_over_shadow = render_text(game_over_text, 75, (0, 0, 0), bold=True)      # black shadow
 
-        winner_surface = font.render(winner_text, True, (winner))            # use the winning color
+        winner_surface = render_text(winner_text, 75, winner, bold=True)              # use the winning color
 
         # Calculate positions for centered text
         game_over_rect = game_over_surface.get_rect(center=(WIN_WIDTH // 2, WIN_HEIGHT // 2 - 50))
@@ -223,6 +434,10 @@ class Graphics:
         self.screen.blit(game_over_surface, game_over_rect)
         self.screen.blit(winner_surface, winner_rect)
 
+        # the overlay covers squares that draw doesn't know about
+        self.dirty_rects.append(game_over_rect.inflate(6, 6).union(winner_rect))
+        self.invalidate()
+
 
 
 
@@ -238,18 +453,16 @@ class Piece:
         # defaults to False; only true when piece is clicked
         self.selected = False
 
-    def draw(self, surface):
+    def draw(self, surface, topleft=None, size=SQUARE_SIZE):
         """
         draw the piece and place it in the middle of its square
-        width of 0 makes it filled
+        width of 0 makes it filled.
+        topleft overrides where the piece goes, e.g. when drawing straight
+        onto the screen instead of the board surface. size is the width of
+        a square
         """
-        piece_png = pygame.image.load(f"pieces/{self.color.lower()}_piece.png")
-
-        # red pieces should be rotated 180 degrees as though they are facing opposite player
-        if self.color == "RED":
-            piece_png = pygame.transform.rotate(piece_png, 180)
-
-        # scale the piece pngs using the square size based on the set board resolution
-        piece_png = pygame.transform.smoothscale(piece_png, (SQUARE_SIZE, SQUARE_SIZE))
+        piece_png = get_sprite(self.color, size)
 
-        surface.blit(piece_png, (self.x * SQUARE_SIZE, self.y * SQUARE_SIZE))
+        if topleft is None:
+            topleft = (self.x * size, self.y * size)
+        surface.blit(piece_png, topleft)
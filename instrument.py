@@ -0,0 +1,220 @@
+"""
+Contains optional instrumentation for finding where the time goes: call
+counters and timing histograms for the hot methods of the rules engine and
+the renderer, and the logging setup for the game window.
+
+Nothing is measured until Instruments.enable() is called. It swaps each
+instrumented method on its class for a wrapper that times the call, and
+disable() puts the original methods back, so there is no cost at all while
+instrumentation is off.
+"""
+import functools
+import importlib
+import json
+import logging
+import logging.handlers
+import sys
+import time
+
+# the methods timed by default, as module.Class.method
+TARGETS = (
+           "rules.Rules.test_move",
+           "rules.Rules.check_captures",
+           "rules.Rules.make_move",
+           "graphics.Graphics.draw",
+           "graphics.Graphics.highlight_square",
+          )
+
+# histogram buckets are powers of two nanoseconds, starting at 2 ** FIRST_BUCKET (about a microsecond)
+FIRST_BUCKET = 10
+BUCKETS = 24
+
+
+class Histogram:
+    """
+    Counts calls and sorts their durations into power of two buckets, so
+    recording a call is cheap and the memory used doesn't grow.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets every recorded call.
+        """
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+        self.buckets = [0] * BUCKETS
+
+    def add(self, ns):
+        """
+        Records a call that took ns nanoseconds.
+        """
+        self.count += 1
+        self.total_ns += ns
+        if ns > self.max_ns:
+            self.max_ns = ns
+        self.buckets[min(BUCKETS - 1, max(0, ns.bit_length() - FIRST_BUCKET))] += 1
+
+    def percentile(self, fraction):
+        """
+        Returns the upper bound, in microseconds, of the bucket holding the
+        call below which fraction of the calls fall.
+        """
+        if not self.count:
+            return 0.0
+        wanted = fraction * self.count
+        seen = 0
+        for index, calls in enumerate(self.buckets):
+            seen += calls
+            if seen >= wanted:
+                return min(self.max_ns, 1 << (index + FIRST_BUCKET)) / 1000
+        return self.max_ns / 1000
+
+    def summary(self):
+        """
+        Returns a dictionary of the statistics. Times are in microseconds.
+        """
+        return {
+                "calls": self.count,
+                "total_ms": self.total_ns / 1e6,
+                "mean_us": self.total_ns / self.count / 1000 if self.count else 0.0,
+                "p50_us": self.percentile(0.5),
+                "p95_us": self.percentile(0.95),
+                "p99_us": self.percentile(0.99),
+                "max_us": self.max_ns / 1000,
+                "buckets": {f"<{(1 << (index + FIRST_BUCKET)) / 1000:g}us": calls
+                            for index, calls in enumerate(self.buckets) if calls},
+               }
+
+
+def _timed(func, histogram):
+    """
+    Returns a wrapper around func that records how long each call takes.
+    """
+    clock = time.perf_counter_ns
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = clock()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            histogram.add(clock() - start)
+    return wrapper
+
+
+class Instruments:
+    """
+    Times the methods named in targets (as module.Class.method) while enabled.
+    Calls from every thread are counted; the counts can be slightly off if
+    two threads call the same method at the same moment.
+    """
+    def __init__(self, targets=TARGETS):
+        self.targets = targets
+        # target -> Histogram, kept across enable/disable until reset
+        self.histograms = {target: Histogram() for target in targets}
+        # target -> (class, original method) while enabled
+        self._originals = {}
+        self.started = None
+
+    @property
+    def enabled(self):
+        """
+        True while the methods are being timed.
+        """
+        return bool(self._originals)
+
+    def enable(self):
+        """
+        Starts timing the target methods, importing their modules if need be.
+        """
+        if self.enabled:
+            return
+        for target in self.targets:
+            module, cls, method = target.rsplit(".", 2)
+            owner = getattr(importlib.import_module(module), cls)
+            # look in the class itself, not its bases, so disable restores exactly what was there
+            original = owner.__dict__[method]
+            self._originals[target] = (owner, original)
+            setattr(owner, method, _timed(original, self.histograms[target]))
+        self.started = time.perf_counter()
+
+    def disable(self):
+        """
+        Puts the original methods back.
+        """
+        for target, (owner, original) in self._originals.items():
+            setattr(owner, target.rsplit(".", 1)[1], original)
+        self._originals = {}
+
+    def reset(self):
+        """
+        Clears the counts and timings.
+        """
+        for histogram in self.histograms.values():
+            histogram.reset()
+        self.started = time.perf_counter() if self.enabled else None
+
+    def summary(self):
+        """
+        Returns each target's Histogram summary, by target.
+        """
+        return {target: histogram.summary() for target, histogram in self.histograms.items()}
+
+    def lines(self):
+        """
+        Returns a short line of text per target, for showing on screen.
+        """
+        lines = []
+        for target, histogram in self.histograms.items():
+            name = ".".join(target.rsplit(".", 2)[1:])
+            lines.append(f"{name:<28} {histogram.count:>8} "
+                         f"p50 {histogram.percentile(0.5):>7.1f}us "
+                         f"p95 {histogram.percentile(0.95):>7.1f}us")
+        return lines
+
+    def dump(self, path, **extra):
+        """
+        Writes the timings, and any extra sections such as frame statistics,
+        to a JSON file for looking at offline.
+        """
+        report = {
+                  "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                  "seconds": time.perf_counter() - self.started if self.started else 0.0,
+                  "calls": self.summary(),
+                 }
+        report.update(extra)
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+
+
+# the instruments used by the game window
+instruments = Instruments()
+
+
+def setup_logging(level="INFO", capacity=1000):
+    """
+    Sends the game's log messages to stdout through a buffer, and returns
+    the logger. Messages are held until flush_logs() is called (the main loop
+    calls it before it waits for events), the buffer fills up or an error is
+    logged, so logging never costs a write per message while a frame is
+    being handled.
+    """
+    logger = logging.getLogger("hasami")
+    logger.setLevel(level.upper() if isinstance(level, str) else level)
+    if not logger.handlers:
+        output = logging.StreamHandler(sys.stdout)
+        output.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(logging.handlers.MemoryHandler(capacity, logging.ERROR, output))
+        logger.propagate = False
+    return logger
+
+
+def flush_logs():
+    """
+    Writes out the log messages held in the buffer.
+    """
+    for handler in logging.getLogger("hasami").handlers:
+        handler.flush()
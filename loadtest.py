@@ -0,0 +1,213 @@
+"""
+Load test for the game server: connects many bot clients at once, pairs
+them into matches and has them play random legal moves as fast as the
+server answers.
+
+Each bot keeps its own copy of the game to pick legal moves and checks
+that the server's results (captures, turn, winner) match its own. Reports
+the moves per second, the round trip time from sending a move to seeing
+its result, and the server's own statistics.
+
+Usage:
+    python loadtest.py [--clients N] [--moves N] [--host HOST] [--port PORT]
+    python loadtest.py --spawn      start a server on a free port just for the test
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+from framestats import percentile
+from rules import Rules
+from protocol import DEFAULT_PORT, board_from_list, encode
+
+
+class Bot:
+    """
+    A client that plays random moves.
+    """
+    # seconds to wait for a message before giving up, e.g. when left waiting for an opponent
+    IDLE_TIMEOUT = 5.0
+
+    def __init__(self, number, max_moves, rng):
+        self.number = number
+        self.max_moves = max_moves
+        self.rng = rng
+        self.game = Rules()
+        self.color = None
+        self.round_trips = []
+        self.moves = 0
+        self.mismatches = 0
+        self.games = 0
+        self._sent = None
+
+    async def run(self, host, port):
+        """
+        Plays games until max_moves of its own have been played.
+        """
+        reader, writer = await asyncio.open_connection(host, port)
+        sock = writer.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        writer.write(encode({"type": "join"}))
+        in_flight = False
+        try:
+            while self.moves < self.max_moves:
+                try:
+                    line = await asyncio.wait_for(reader.readline(), self.IDLE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    # nobody left to play against
+                    break
+                if not line:
+                    break
+                message = json.loads(line)
+                kind = message["type"]
+                if kind == "start":
+                    self.color = message["color"]
+                    self.games += 1
+                    self.game.set_position(board_from_list(message["board"]), message["turn"])
+                elif kind == "moved":
+                    self._check(message)
+                elif kind == "left":
+                    # the opponent is done; start again with someone else. A move
+                    # already on its way will be refused, as the match is over
+                    in_flight = self._sent is not None
+                    self._sent = None
+                    writer.write(encode({"type": "join"}))
+                elif kind == "error":
+                    # the bots only send legal moves, so the server should never refuse one
+                    if not in_flight:
+                        self.mismatches += 1
+                    in_flight = False
+
+                if kind in ("start", "moved"):
+                    if self.game.winner:
+                        writer.write(encode({"type": "join"}))
+                    elif self.game.get_active_player() == self.color:
+                        self._move(writer)
+                await writer.drain()
+        finally:
+            writer.close()
+
+    def _move(self, writer):
+        """
+        Sends a random legal move.
+        """
+        moves = list(self.game.legal_moves())
+        if not moves:
+            return
+        origin, destination = self.rng.choice(moves)
+        self._sent = time.perf_counter()
+        writer.write(encode({"type": "move", "origin": list(origin), "destination": list(destination)}))
+
+    def _check(self, message):
+        """
+        Plays the server's move on the bot's own game and checks the results agree.
+        """
+        if self._sent is not None and self.game.get_active_player() == self.color:
+            self.round_trips.append(time.perf_counter() - self._sent)
+            self._sent = None
+            self.moves += 1
+        undo = self.game.make_move(tuple(message["origin"]), tuple(message["destination"]))
+        captured = {tuple(pos) for pos in message["captured"]}
+        if captured != set(undo.captured or ()) or message["winner"] != self.game.winner \
+           or message["turn"] != self.game.get_active_player():
+            self.mismatches += 1
+
+
+async def server_stats(host, port):
+    """
+    Returns the server's statistics message.
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(encode({"type": "stats"}))
+    message = json.loads(await reader.readline())
+    writer.close()
+    return message
+
+
+async def load_test(host, port, clients, moves, seed):
+    """
+    Runs the bots and returns a dictionary of results.
+    """
+    rng = random.Random(seed)
+    bots = [Bot(number, moves, random.Random(rng.random())) for number in range(clients)]
+    start = time.perf_counter()
+    results = await asyncio.gather(*(bot.run(host, port) for bot in bots), return_exceptions=True)
+    elapsed = time.perf_counter() - start
+    failed = [result for result in results if isinstance(result, Exception)]
+
+    round_trips = [rtt for bot in bots for rtt in bot.round_trips]
+    total_moves = sum(bot.moves for bot in bots)
+    results = {
+            "clients": clients,
+            "failed_clients": len(failed),
+            "games": sum(bot.games for bot in bots) // 2,
+            "moves": total_moves,
+            "mismatches": sum(bot.mismatches for bot in bots),
+            "seconds": elapsed,
+            "moves_per_sec": total_moves / elapsed,
+            "rtt_ms_p50": 1000 * percentile(round_trips, 0.5),
+            "rtt_ms_p95": 1000 * percentile(round_trips, 0.95),
+            "rtt_ms_max": 1000 * max(round_trips, default=0.0),
+           }
+    stats = await server_stats(host, port)
+    del stats["type"]
+    results.update( (f"server_{key}", value) for key, value in stats.items() )
+    return results
+
+
+def free_port():
+    """
+    Returns a TCP port nobody is listening on.
+    """
+    with socket.socket() as sock:
+        sock.bind( ("127.0.0.1", 0) )
+        return sock.getsockname()[1]
+
+
+def main():
+    """
+    Runs the load test from the command line.
+    """
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--clients", type=int, default=200, help="bot clients, two per match")
+    parser.add_argument("--moves", type=int, default=50, help="moves each bot plays")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument("--spawn", action="store_true",
+                        help="start a server on a free port for the test and stop it afterwards")
+    args = parser.parse_args()
+
+    server = None
+    if args.spawn:
+        args.port = free_port()
+        server = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(__file__), "server.py"),
+                                   "--host", args.host,
+                                   "--port", str(args.port)], stdout=subprocess.PIPE)
+        # the server prints a line once it is listening
+        server.stdout.readline()
+    try:
+        results = asyncio.run(load_test(args.host, args.port, args.clients, args.moves, args.seed))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    for key, value in results.items():
+        if isinstance(value, float):
+            value = f"{value:,.1f}"
+        print(f"{key}: {value}")
+    if results["mismatches"] or results["failed_clients"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
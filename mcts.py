@@ -0,0 +1,205 @@
+"""
+Contains a Monte Carlo Tree Search player for Hasami Shogi.
+Uses root parallelism: every worker process grows its own search tree from
+the same position, and the visit counts of the root moves are added
+together at the end to pick the move. The workers share nothing while they
+search, so throughput scales with the number of cores.
+"""
+import math
+import os
+import random
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from bitboard import BitboardRules, iter_bits, move_mask, POSITIONS
+
+# visits and win_rate are for the chosen move, summed over all workers
+MCTSResult = namedtuple("MCTSResult", "move visits win_rate playouts elapsed playouts_per_sec")
+
+
+def random_move(game, rng):
+    """
+    Returns a random legal move for the active player of a BitboardRules game,
+    or None if there isn't one. Picks a random pawn that can move and then
+    a random destination for it, which is much cheaper than listing every move.
+    """
+    masks = game._masks
+    occupied = masks["BLACK"] | masks["RED"]
+    origins = list(iter_bits(masks[game.get_active_player()]))
+    rng.shuffle(origins)
+    for origin in origins:
+        destinations = move_mask(origin, occupied)
+        if destinations:
+            return POSITIONS[origin], POSITIONS[rng.choice(list(iter_bits(destinations)))]
+    return None
+
+
+def playout(game, rng, max_plies):
+    """
+    Plays random moves until the game ends or max_plies have been played,
+    then returns the winner. Games that run out of plies go to whoever has
+    more pieces left, or None if it is even. Undoes every move before returning.
+    """
+    undos = []
+    try:
+        while not game.winner and len(undos) < max_plies:
+            move = random_move(game, rng)
+            if move is None:
+                break
+            undos.append(game.make_move(*move))
+
+        if game.winner:
+            return game.winner
+        black, red = game.get_pieces_remaining("BLACK"), game.get_pieces_remaining("RED")
+        if black > red:
+            return "BLACK"
+        if red > black:
+            return "RED"
+        return None
+    finally:
+        for undo in reversed(undos):
+            game.unmake_move(undo)
+
+
+class _Node:
+    """
+    A node in the search tree. wins are counted for player, the player who
+    made the move leading to this node.
+    """
+    __slots__ = ("move", "parent", "player", "children", "untried", "visits", "wins")
+
+    def __init__(self, move, parent, player, untried):
+        self.move = move
+        self.parent = parent
+        self.player = player
+        self.children = []
+        self.untried = untried
+        self.visits = 0
+        self.wins = 0.0
+
+    def select_child(self, exploration):
+        """
+        Returns the child with the highest UCT score.
+        """
+        log_visits = math.log(self.visits)
+        return max(self.children, key=lambda child: child.wins / child.visits
+                   + exploration * math.sqrt(log_visits / child.visits))
+
+
+def search_tree(board, player, time_limit, playouts, exploration, max_plies, seed):
+    """
+    Grows one search tree from the position and returns the root statistics
+    as ({move: (visits, wins)}, playouts played).
+    Runs in a worker process, so everything it takes and returns is picklable.
+    Stops after time_limit seconds or after playouts playouts, whichever is first.
+    """
+    rng = random.Random(seed)
+    game = BitboardRules()
+    game.set_position(board, player)
+    root = _Node(None, None, None, list(game.legal_moves()))
+    deadline = time.perf_counter() + time_limit if time_limit else None
+
+    played = 0
+    while (playouts is None or played < playouts) and \
+          (deadline is None or time.perf_counter() < deadline):
+        node = root
+        undos = []
+
+        # selection: walk down through fully expanded nodes
+        while not node.untried and node.children:
+            node = node.select_child(exploration)
+            undos.append(game.make_move(*node.move))
+
+        # expansion: add one untried move
+        if node.untried and not game.winner:
+            move = node.untried.pop(rng.randrange(len(node.untried)))
+            mover = game.get_active_player()
+            undos.append(game.make_move(*move))
+            child = _Node(move, node, mover, [] if game.winner else list(game.legal_moves()))
+            node.children.append(child)
+            node = child
+
+        # simulation
+        winner = playout(game, rng, max_plies)
+
+        # backpropagation
+        while node is not None:
+            node.visits += 1
+            if winner is None:
+                node.wins += 0.5
+            elif winner == node.player:
+                node.wins += 1
+            node = node.parent
+        for undo in reversed(undos):
+            game.unmake_move(undo)
+        played += 1
+
+    return {child.move: (child.visits, child.wins) for child in root.children}, played
+
+
+class MCTS:
+    """
+    A Monte Carlo Tree Search player that spreads its playouts over a pool
+    of worker processes using root parallelism.
+
+    Searches for time_limit seconds, or for a total number of playouts if
+    playouts is given. workers defaults to the number of cores; with one
+    worker the search runs in this process.
+    """
+    def __init__(self, time_limit=1.0, playouts=None, workers=None, exploration=1.4,
+                 max_plies=200, seed=None):
+        self.time_limit = time_limit
+        self.playouts = playouts
+        self.workers = workers or os.cpu_count() or 1
+        self.exploration = exploration
+        self.max_plies = max_plies
+        self._rng = random.Random(seed)
+        self._pool = None
+
+    def search(self, game):
+        """
+        Searches the position in game and returns an MCTSResult.
+        """
+        board, player = dict(game.board), game.get_active_player()
+        time_limit = None if self.playouts else self.time_limit
+        jobs = []
+        for worker in range(self.workers):
+            playouts = None
+            if self.playouts:
+                # split the playouts as evenly as possible
+                playouts = self.playouts // self.workers + (worker < self.playouts % self.workers)
+            jobs.append( (board, player, time_limit, playouts, self.exploration,
+                          self.max_plies, self._rng.getrandbits(32)) )
+
+        start = time.perf_counter()
+        if self.workers == 1:
+            results = [search_tree(*jobs[0])]
+        else:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(self.workers)
+            results = list(self._pool.map(search_tree, *zip(*jobs)))
+        elapsed = time.perf_counter() - start
+
+        # merge the root statistics of every tree
+        totals = {}
+        played = 0
+        for stats, count in results:
+            played += count
+            for move, (visits, wins) in stats.items():
+                total = totals.setdefault(move, [0, 0.0])
+                total[0] += visits
+                total[1] += wins
+
+        if not totals:
+            return MCTSResult(None, 0, 0.0, played, elapsed, played / max(elapsed, 1e-9))
+        move, (visits, wins) = max(totals.items(), key=lambda item: item[1][0])
+        return MCTSResult(move, visits, wins / visits, played, elapsed, played / max(elapsed, 1e-9))
+
+    def close(self):
+        """
+        Shuts down the worker processes.
+        """
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
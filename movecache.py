@@ -0,0 +1,127 @@
+"""
+Contains a cache of the legal moves and capture previews of a position,
+for the game window.
+
+The destinations of every pawn on the board (of both colours, so nothing
+needs working out when the turn passes) are kept between positions. When
+the position changes, only the pawns that can see one of the changed
+squares along a row or column have their moves worked out again; the rest
+of the board is untouched. What each move would capture is worked out the
+first time it is asked for, e.g. while hovering over a destination, and
+kept until the position changes.
+"""
+
+
+class MoveCache:
+    """
+    Legal moves and capture previews for the position of a rules object,
+    brought up to date with its board (by the position's Zobrist key) on
+    every call.
+    """
+    def __init__(self):
+        # key of the position cached, None before the first call
+        self.key = None
+        self._variant = None
+        self._board = {}
+        self._player = None
+        # position of each pawn -> frozenset of the squares it can move to
+        self._moves = {}
+        # (origin, destination) -> tuple of the squares the move would capture
+        self._captures = {}
+        # counts for measuring how well the cache works: calls answered
+        # without working anything out, and pawns whose moves were worked out
+        self.stats = {"hits": 0, "misses": 0, "pawns_updated": 0}
+
+    def clear(self):
+        """
+        Forgets everything, so the next call works out the whole board again.
+        """
+        self.key = None
+        self._variant = None
+        self._board = {}
+        self._moves = {}
+        self._captures = {}
+
+    def sync(self, game):
+        """
+        Brings the cache up to date with game's position, working out the
+        moves again only for the pawns affected by what changed.
+        """
+        if game.key == self.key and game.VARIANT == self._variant:
+            return
+        self.stats["misses"] += 1
+        board = game.board
+        if game.VARIANT != self._variant:
+            self._moves = {}
+            stale = set(board)
+        else:
+            changed = {pos for pos, _ in set(self._board.items()) ^ set(board.items())}
+            for pos in changed:
+                self._moves.pop(pos, None)
+            stale = self._watchers(game, changed)
+            stale.update(pos for pos in changed if pos in board)
+
+        for pos in stale:
+            self._moves[pos] = frozenset(game.test_move(pos))
+        self.stats["pawns_updated"] += len(stale)
+
+        self.key = game.key
+        self._variant = game.VARIANT
+        self._board = dict(board)
+        self._player = game.get_active_player()
+        self._captures = {}
+
+    def _watchers(self, game, squares):
+        """
+        Returns the set of pawns whose moves can depend on squares: for each
+        square, the nearest pawn in each direction and, where pawns can jump,
+        the pawn behind one that is right next to the square.
+        """
+        board = game.board
+        rays = game._tables.rays
+        watchers = set()
+        for square in squares:
+            for ray in rays[square]:
+                for n, pos in enumerate(ray):
+                    if pos in board:
+                        watchers.add(pos)
+                        # a pawn two squares away can jump onto square over this one
+                        if game._jumps and n == 0 and len(ray) > 1 and ray[1] in board:
+                            watchers.add(ray[1])
+                        break
+        return watchers
+
+    def moves(self, game, origin):
+        """
+        Returns the frozenset of squares the pawn on origin can move to, or
+        an empty set if it isn't one of the active player's pawns.
+        """
+        if game.key == self.key:
+            self.stats["hits"] += 1
+        else:
+            self.sync(game)
+        if self._board.get(origin) != self._player:
+            return frozenset()
+        return self._moves[origin]
+
+    def legal_moves(self, game):
+        """
+        Returns a dictionary of the active player's pawns and the squares each can move to.
+        """
+        self.sync(game)
+        return {pos: moves for pos, moves in self._moves.items() if self._board[pos] == self._player}
+
+    def captures(self, game, origin, destination):
+        """
+        Returns a tuple of the squares that moving from origin to destination
+        would capture, or an empty tuple if it isn't a legal move.
+        """
+        move = (origin, destination)
+        captured = self._captures.get(move) if game.key == self.key else None
+        if captured is not None:
+            self.stats["hits"] += 1
+            return captured
+        if destination not in self.moves(game, origin):
+            return ()
+        captured = self._captures[move] = tuple(game.preview_captures(origin, destination))
+        return captured
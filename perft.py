@@ -0,0 +1,342 @@
+"""
+Contains a perft (move path enumeration) and capture regression suite for
+the rules engine, plus microbenchmarks of its hot paths.
+
+perft counts every sequence of legal moves to a given depth. The counts
+are compared with known values, so any change to move generation or
+captures that changes the game tree shows up straight away. The capture
+cases check exact results for the examples in TODO.md and every corner
+capture. make_move and unmake_move are checked to be exact inverses along
+random games. Both rules backends are checked, and the checks raise
+AssertionError themselves, so they still run under python -O.
+
+Runs headlessly. Usage:
+    python perft.py [--depth N] [--json results.json]
+"""
+import argparse
+import json
+import random
+import time
+
+from bitboard import BitboardRules
+from rules import Rules, parse_square
+
+BACKENDS = (("dict", Rules), ("bitboard", BitboardRules))
+
+# the example position from the original assignment in TODO.md
+TODO_DIAGRAM = """
+  1 2 3 4 5 6 7 8 9
+a . . . . . B . . .
+b . . . . . R . . .
+c . . B R R . . . .
+d B . . . . . . . .
+e R . . . . . . . .
+f R . . . . . . . .
+g R . . . . . . . .
+h . . . . . B . . .
+i R B . . . . . . .
+"""
+
+
+def parse_diagram(diagram):
+    """
+    Returns a board dictionary from a text diagram like the one in TODO.md:
+    a header row of column numbers, then one row per letter with B, R or .
+    for each square.
+    """
+    lines = [line.split() for line in diagram.strip().splitlines()]
+    numbers = lines[0]
+    board = {}
+    for letter, *squares in lines[1:]:
+        for number, square in zip(numbers, squares):
+            if square == "B":
+                board[parse_square(letter + number)] = "BLACK"
+            elif square == "R":
+                board[parse_square(letter + number)] = "RED"
+    return board
+
+
+def corner_cases():
+    """
+    Returns a capture case for each way of corner capturing: both colours,
+    all four corners and both squares next to each corner. In each case the
+    partner square is already held and the mover steps onto the other one.
+    """
+    cases = []
+    corners = {
+               "a9": ("a8", "b9"),
+               "a1": ("a2", "b1"),
+               "i9": ("i8", "h9"),
+               "i1": ("i2", "h1"),
+              }
+    for player, opponent in (("BLACK", "RED"), ("RED", "BLACK")):
+        for corner, pair in corners.items():
+            for target, partner in (pair, pair[::-1]):
+                x, y = parse_square(target)
+                # come in from the middle of the board along the row or column
+                if target[0] in "ai":
+                    origin = (x, 4)
+                else:
+                    origin = (4, y)
+                board = {
+                         parse_square(corner): opponent,
+                         parse_square(partner): player,
+                         origin: player,
+                         # spare pawns so nobody drops below two pieces
+                         (4, 4): opponent,
+                         (5, 5): opponent,
+                         (6, 6): player,
+                        }
+                cases.append( (f"corner {corner} {player} onto {target}", board, player,
+                               origin, parse_square(target), {parse_square(corner)}) )
+    return cases
+
+
+def capture_cases():
+    """
+    Returns the curated capture cases as
+    (name, board, player, origin, destination, expected captured squares).
+    """
+    todo = parse_diagram(TODO_DIAGRAM)
+    squares = lambda *names: {parse_square(name) for name in names}
+    return [
+            ("todo h6-c6", todo, "BLACK", parse_square("h6"), parse_square("c6"),
+             squares("c4", "c5", "b6")),
+            ("todo h6-h1", todo, "BLACK", parse_square("h6"), parse_square("h1"),
+             squares("e1", "f1", "g1", "i1")),
+            ("todo h6-h5 quiet", todo, "BLACK", parse_square("h6"), parse_square("h5"), set()),
+           ] + corner_cases()
+
+
+# known perft node counts: position name -> {depth: nodes}
+PERFT_EXPECTED = {
+                  "start": {1: 63, 2: 3717, 3: 254219, 4: 16599273},
+                  "todo": {1: 58, 2: 3448, 3: 195490, 4: 12383474},
+                 }
+
+
+def perft_positions():
+    """
+    Returns the positions perft is run from as {name: (board, player)}.
+    """
+    return {
+            "start": (Rules().board, "BLACK"),
+            "todo": (parse_diagram(TODO_DIAGRAM), "BLACK"),
+           }
+
+
+def perft(game, depth):
+    """
+    Returns the number of legal move sequences of length depth from the
+    position in game. Finished games have no moves. Uses make/unmake,
+    so game is left as it was.
+    """
+    if game.winner:
+        return 0
+    if depth == 1:
+        return game.count_moves()
+    nodes = 0
+    for move in list(game.legal_moves()):
+        undo = game.make_move(*move)
+        nodes += perft(game, depth - 1)
+        game.unmake_move(undo)
+    return nodes
+
+
+def check_captures():
+    """
+    Checks every capture case on both backends. Returns the number of cases
+    and raises AssertionError on the first wrong result.
+    """
+    cases = capture_cases()
+    for name, backend in BACKENDS:
+        for case, board, player, origin, destination, expected in cases:
+            game = backend()
+            game.set_position(board, player)
+            if destination not in game.test_move(origin):
+                raise AssertionError(f"{name}: {case}: move not legal")
+            captured = set(game.make_move(origin, destination).captured or ())
+            if captured != expected:
+                raise AssertionError(f"{name}: {case}: captured {captured}, expected {expected}")
+    return len(cases)
+
+
+def snapshot(game):
+    """
+    Returns everything that makes up a game's state, for comparing games.
+    """
+    return (dict(game.board), game.get_active_player(), dict(game._pieces_remaining), game.winner,
+            game.key)
+
+
+def check_make_unmake(games=10, plies=200, seed=0):
+    """
+    Plays random games on both backends. In every position, each legal move
+    is made and unmade and the state must come back exactly, and the Zobrist
+    key make_move keeps up to date must match one computed from scratch.
+    Then each game is unwound move by move back to the start, checking every
+    earlier state. Returns the number of positions checked and raises
+    AssertionError on the first difference.
+    """
+    positions = 0
+    for name, backend in BACKENDS:
+        rng = random.Random(seed)
+        game = backend()
+        for number in range(games):
+            game.reset_game_state()
+            states, undos = [], []
+            while not game.winner and len(undos) < plies:
+                moves = list(game.legal_moves())
+                if not moves:
+                    break
+                before = snapshot(game)
+                for move in moves:
+                    game.unmake_move(game.make_move(*move))
+                    if snapshot(game) != before:
+                        raise AssertionError(f"{name}: game {number} ply {len(undos)}: "
+                                             f"unmaking {move} didn't restore the position")
+                positions += 1
+                states.append(before)
+                undos.append(game.make_move(*rng.choice(moves)))
+                if game.key != game._zobrist.compute(game.board, game.get_active_player()):
+                    raise AssertionError(f"{name}: game {number} ply {len(undos)}: "
+                                         "Zobrist key out of date")
+            while undos:
+                game.unmake_move(undos.pop())
+                if snapshot(game) != states.pop():
+                    raise AssertionError(f"{name}: game {number}: unwinding to ply {len(undos)} "
+                                         "didn't restore the position")
+    return positions
+
+
+def run_perft(depth):
+    """
+    Runs perft to depth from every perft position on both backends, checking
+    the counts against PERFT_EXPECTED where known. Returns a dictionary of
+    node counts and nodes per second.
+    """
+    results = {}
+    for position, (board, player) in perft_positions().items():
+        for name, backend in BACKENDS:
+            game = backend()
+            game.set_position(board, player)
+            for ply in range(1, depth + 1):
+                start = time.perf_counter()
+                nodes = perft(game, ply)
+                elapsed = time.perf_counter() - start
+                # deeper than the known counts, the backends must at least agree
+                expected = PERFT_EXPECTED[position].get(ply, results.get(f"{position}_perft_{ply}"))
+                if expected is not None and nodes != expected:
+                    raise AssertionError(f"{name}: perft({position}, {ply}) = {nodes}, "
+                                         f"expected {expected}")
+                results[f"{position}_perft_{ply}"] = nodes
+            results[f"{name}_{position}_perft_{depth}_nodes_per_sec"] = nodes / max(elapsed, 1e-9)
+    return results
+
+
+def microbenchmarks(repeat=3):
+    """
+    Times test_move, check_captures, check_corner_cap and make_move on
+    each backend. Returns calls per second for each.
+    """
+    results = {}
+    todo = parse_diagram(TODO_DIAGRAM)
+    cases = capture_cases()
+    for name, backend in BACKENDS:
+        game = backend()
+        game.set_position(todo, "BLACK")
+        origins = [pos for pos, color in todo.items() if color == "BLACK"]
+
+        def best_rate(func, calls):
+            # best of repeat runs, as calls per second
+            return max(calls / _time(func) for _ in range(repeat))
+
+        results[f"{name}_test_move_per_sec"] = best_rate(
+            lambda: [game.test_move(origin) for origin in origins * 200], len(origins) * 200)
+
+        # check_captures and check_corner_cap straight after each case's move
+        capture_games = []
+        corner_games = []
+        for case, board, player, origin, destination, _ in cases:
+            case_game = backend()
+            board = dict(board)
+            del board[origin]
+            board[destination] = player
+            case_game.set_position(board, player)
+            capture_games.append( (case_game, destination) )
+            if case.startswith("corner"):
+                opponent = "RED" if player == "BLACK" else "BLACK"
+                corner_games.append( (case_game, destination, opponent) )
+        results[f"{name}_check_captures_per_sec"] = best_rate(
+            lambda: [case_game.check_captures(pos) for case_game, pos in capture_games * 200],
+            len(capture_games) * 200)
+        results[f"{name}_check_corner_cap_per_sec"] = best_rate(
+            lambda: [case_game.check_corner_cap(pos, opponent)
+                     for case_game, pos, opponent in corner_games * 200],
+            len(corner_games) * 200)
+
+        # make_move + unmake_move over every legal move of the TODO position
+        moves = list(game.legal_moves())
+
+        def make_all():
+            for _ in range(50):
+                for move in moves:
+                    game.unmake_move(game.make_move(*move))
+
+        results[f"{name}_make_unmake_per_sec"] = best_rate(make_all, 50 * len(moves))
+
+        # moves that capture, to time captures per second
+        capturing = [(board, player, origin, destination)
+                     for _, board, player, origin, destination, expected in cases if expected]
+
+        def capture_all():
+            for board, player, origin, destination in capturing * 50:
+                game.set_position(board, player)
+                game.make_move(origin, destination)
+
+        results[f"{name}_capturing_moves_per_sec"] = best_rate(capture_all, 50 * len(capturing))
+    return results
+
+
+def _time(func):
+    """
+    Returns how many seconds one call of func takes.
+    """
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def run_suite(depth=3, repeat=3):
+    """
+    Runs the whole suite and returns its results as a dictionary.
+    """
+    results = {"capture_cases": check_captures(), "make_unmake_positions": check_make_unmake()}
+    results.update(run_perft(depth))
+    results.update(microbenchmarks(repeat))
+    return results
+
+
+def main():
+    """
+    Runs the suite from the command line.
+    """
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--depth", type=int, default=3, help="perft depth")
+    parser.add_argument("--repeat", type=int, default=3, help="timed repetitions")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = run_suite(args.depth, args.repeat)
+    for key, value in results.items():
+        if isinstance(value, float):
+            value = f"{value:,.1f}"
+        print(f"{key}: {value}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
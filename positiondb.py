@@ -0,0 +1,615 @@
+"""
+Contains an on-disk index of the positions reached in archived games, for
+questions like "which games reached this position", "how did each reply
+from here score" and "which games had a corner capture" without replaying
+the archive.
+
+Games are replayed through the rules engine (every move is checked, as in
+replay.py) on a pool of worker processes. Each position reached gets a
+posting (key, game id, ply), where key is the position's Zobrist key and
+ply the number of moves played to reach it, and each move played gets
+counted under its position with the game's result. A position reached twice
+in a game is counted twice.
+
+A database is a directory holding an index.json manifest and one or more
+segment files. Adding games writes a new segment, so an archive can be
+indexed as it grows: games already indexed from a file are skipped, since
+record files are only ever appended to. Queries look in every segment, so
+compact merges them into one once there are many. Segments are memory-mapped
+and searched by bisection, like the opening book (book.py), and are never
+changed once written.
+
+Segment layout (all integers little-endian), each table sorted as noted:
+
+    header   4s magic b"HSPD", u8 version, u8 rows, u8 cols, u8 reserved,
+             u32 first game id, u32 games, u32 postings, u32 moves, u32 corner captures
+    games    per game, by id: u8 result, u8 reserved, u16 plies, u16 captures,
+             u16 ply of the first corner capture (0 for none)
+    postings u64 key, u32 game id, u16 ply; by key, game id and ply
+    moves    u64 key, u8 origin square, u8 destination square, u32 times played,
+             u32 black wins, u32 red wins; by key and move
+    corners  u32 game id, u16 ply of the first corner capture; by game id
+
+Results are 0 for unfinished, 1 for a black win, 2 for a red win and 3 for a
+game that isn't valid (it has no postings), including games too long for the
+u16 ply fields. Squares are numbered y * cols + x, so boards of up to 256
+squares fit. A database holds games of variant 1 on one board size, 9x9
+unless --size is given when it is created.
+
+Usage:
+    python positiondb.py add games.db games.hsg more_games.txt [--workers N] [--size 13]
+    python positiondb.py query games.db [--moves "h6-h4 a3-e3"]
+    python positiondb.py corners games.db
+    python positiondb.py compact games.db
+"""
+import argparse
+import heapq
+import itertools
+import json
+import mmap
+import os
+import struct
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import record
+import variants
+import zobrist
+from replay import chunks, read_games
+from rules import Rules, square_name
+
+MAGIC = b"HSPD"
+VERSION = 1
+MANIFEST = "index.json"
+HEADER = struct.Struct("<4sBBBBIIIII")
+GAME = struct.Struct("<BxHHH")
+POSTING = struct.Struct("<QIH")
+MOVE = struct.Struct("<QBBIII")
+CORNER = struct.Struct("<IH")
+KEY = struct.Struct("<Q")
+
+RESULTS = {None: 0, "BLACK": 1, "RED": 2}
+INVALID = 3
+# longest game the u16 ply fields can hold
+MAX_PLIES = 0xFFFF
+
+# a position reached in game (an id) after ply moves
+Posting = namedtuple("Posting", "game ply")
+# how often move was played from a position, and how those games ended
+MoveStats = namedtuple("MoveStats", "move played black_wins red_wins")
+# a game in the database. path and number say where it came from; winner is
+# None for unfinished games, and corner_ply is the ply of its first corner
+# capture, 0 for none
+GameInfo = namedtuple("GameInfo", "game path number valid winner plies captures corner_ply")
+
+
+def index_game(rules, game, number, postings, moves):
+    """
+    Replays one game, given as a GameRecord or a line of algebraic notation,
+    adding its postings under game id number to postings and its moves to
+    moves. Returns its (result, plies, captures, first corner capture ply).
+    A game with an illegal move, or longer than MAX_PLIES, is marked invalid
+    and adds nothing.
+    """
+    try:
+        if isinstance(game, str):
+            played, _, _ = record.game_from_text(game, rules.COLS)
+        else:
+            played = game.moves
+    except ValueError:
+        return INVALID, 0, 0, 0
+    if len(played) > MAX_PLIES:
+        return INVALID, 0, 0, 0
+
+    rules.reset_game_state()
+    cols = rules.COLS
+    corners = {(0, 0), (cols - 1, 0), (0, rules.ROWS - 1), (cols - 1, rules.ROWS - 1)}
+    found = [ (rules.key, number, 0) ]
+    keys = []
+    captures = 0
+    corner_ply = 0
+    for ply, (origin, destination) in enumerate(played, 1):
+        if rules.winner or rules.board.get(origin) != rules.get_active_player() \
+           or destination not in rules.test_move(origin):
+            return INVALID, 0, 0, 0
+        keys.append( (rules.key, origin[1] * cols + origin[0], destination[1] * cols + destination[0]) )
+        captured = rules.make_move(origin, destination).captured or ()
+        captures += len(captured)
+        # a pawn in a corner can only be taken by a corner capture
+        if not corner_ply and corners.intersection(captured):
+            corner_ply = ply
+        found.append( (rules.key, number, ply) )
+
+    postings.extend(found)
+    # the rules decide the result, whatever the archive says
+    black, red = rules.winner == "BLACK", rules.winner == "RED"
+    for move in keys:
+        counts = moves.get(move)
+        if counts is None:
+            moves[move] = [1, black, red]
+        else:
+            counts[0] += 1
+            counts[1] += black
+            counts[2] += red
+    return RESULTS[rules.winner], len(played), min(captures, 0xFFFF), corner_ply
+
+
+def index_chunk(games, first_game, rows=Rules.ROWS, cols=Rules.COLS):
+    """
+    Indexes a list of games played on a rows x cols board in a worker
+    process, numbering them from first_game. Returns the packed games table,
+    and the postings and moves tables of the chunk, each sorted.
+    """
+    rules = Rules(variants.resized(rows, cols))
+    postings = []
+    moves = {}
+    table = bytearray()
+    for number, game in enumerate(games, first_game):
+        table += GAME.pack(*index_game(rules, game, number, postings, moves))
+    postings.sort()
+    return (bytes(table),
+            b"".join(POSTING.pack(*posting) for posting in postings),
+            b"".join(MOVE.pack(*move, *counts) for move, counts in sorted(moves.items())))
+
+
+def _merge_moves(tables):
+    """
+    Merges sorted iterables of MOVE tuples, adding up the counts of a move
+    that is in more than one. Yields MOVE tuples in order.
+    """
+    merged = heapq.merge(*tables)
+    for move, group in itertools.groupby(merged, key=lambda entry: entry[:3]):
+        played = black = red = 0
+        for entry in group:
+            played += entry[3]
+            black += entry[4]
+            red += entry[5]
+        yield (*move, played, black, red)
+
+
+def write_segment(path, rows, cols, first_game, games, postings, moves):
+    """
+    Writes a segment from the games table (bytes) and sorted tables of
+    postings and moves (each a list of bytes objects to merge), to a
+    temporary file first so a half written segment is never left at path.
+    """
+    count = len(games) // GAME.size
+    corners = [ (number, corner_ply) for number, (_, _, _, corner_ply)
+                in enumerate(GAME.iter_unpack(games), first_game) if corner_ply ]
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as file:
+        file.write(HEADER.pack(MAGIC, VERSION, rows, cols, 0, first_game, count, 0, 0, 0))
+        file.write(games)
+        posting_count = 0
+        for posting in heapq.merge(*(POSTING.iter_unpack(table) for table in postings)):
+            file.write(POSTING.pack(*posting))
+            posting_count += 1
+        move_count = 0
+        for move in _merge_moves(MOVE.iter_unpack(table) for table in moves):
+            file.write(MOVE.pack(*move))
+            move_count += 1
+        for corner in corners:
+            file.write(CORNER.pack(*corner))
+        # now the sizes of the tables are known
+        file.seek(0)
+        file.write(HEADER.pack(MAGIC, VERSION, rows, cols, 0, first_game, count,
+                               posting_count, move_count, len(corners)))
+    os.replace(temporary, path)
+
+
+class Segment:
+    """
+    A memory-mapped segment file.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.rows, self.cols, _, self.first_game, self.games,
+         self.postings, self.moves, self.corners) = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} position database segment")
+        self._postings_at = HEADER.size + self.games * GAME.size
+        self._moves_at = self._postings_at + self.postings * POSTING.size
+        self._corners_at = self._moves_at + self.moves * MOVE.size
+
+    def _find(self, start, size, count, key):
+        """
+        Returns the number of the first record at least key in a table of
+        count records of size bytes sorted by key, starting at offset start.
+        """
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if KEY.unpack_from(self._map, start + middle * size)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _records(self, layout, start, count, key):
+        """
+        Yields the records of a table with the given key.
+        """
+        number = self._find(start, layout.size, count, key)
+        offset = start + number * layout.size
+        end = start + count * layout.size
+        while offset < end:
+            entry = layout.unpack_from(self._map, offset)
+            if entry[0] != key:
+                return
+            yield entry
+            offset += layout.size
+
+    def find_postings(self, key):
+        """
+        Yields the Postings of the position with key, by game and ply.
+        """
+        for _, game, ply in self._records(POSTING, self._postings_at, self.postings, key):
+            yield Posting(game, ply)
+
+    def count_postings(self, key):
+        """
+        Returns how many times the position with key was reached.
+        """
+        return self._find(self._postings_at, POSTING.size, self.postings, key + 1) - \
+               self._find(self._postings_at, POSTING.size, self.postings, key)
+
+    def find_moves(self, key):
+        """
+        Yields the (key, origin, destination, played, black wins, red wins)
+        records of the moves played from the position with key.
+        """
+        return self._records(MOVE, self._moves_at, self.moves, key)
+
+    def game(self, number):
+        """
+        Returns the (result, plies, captures, corner ply) of game id number.
+        """
+        return GAME.unpack_from(self._map, HEADER.size + (number - self.first_game) * GAME.size)
+
+    def corner_captures(self):
+        """
+        Yields (game id, ply of its first corner capture) for every game with a corner capture.
+        """
+        yield from CORNER.iter_unpack(self._map[self._corners_at:self._corners_at + self.corners * CORNER.size])
+
+    def tables(self):
+        """
+        Returns memoryviews of the raw games, postings and moves tables, for
+        merging segments. They must be released before the segment is closed.
+        """
+        view = memoryview(self._map)
+        return (view[HEADER.size:self._postings_at], view[self._postings_at:self._moves_at],
+                view[self._moves_at:self._corners_at])
+
+    def close(self):
+        """
+        Closes the file.
+        """
+        self._map.close()
+        self._file.close()
+
+
+class PositionDB:
+    """
+    A position database directory, created if it doesn't exist.
+    """
+    def __init__(self, path, rows=Rules.ROWS, cols=Rules.COLS):
+        if rows * cols > 256:
+            raise ValueError("position databases only support boards of up to 256 squares")
+        self.path = path
+        manifest = os.path.join(path, MANIFEST)
+        if os.path.exists(manifest):
+            with open(manifest, encoding="utf-8") as file:
+                self.manifest = json.load(file)
+            if self.manifest["version"] != VERSION:
+                raise ValueError(f"{path} is not a version {VERSION} position database")
+        else:
+            os.makedirs(path, exist_ok=True)
+            # segments: file, first game id, games and the (path, first game number,
+            # count) of the archives its games came from. indexed: archive path ->
+            # games indexed from it
+            self.manifest = {"version": VERSION, "rows": rows, "cols": cols, "games": 0,
+                             "next_segment": 0, "segments": [], "indexed": {}}
+        self.rows = self.manifest["rows"]
+        self.cols = self.manifest["cols"]
+        self.variant = variants.resized(self.rows, self.cols)
+        self._keys = zobrist.get_keys(self.rows, self.cols)
+        self.segments = [Segment(os.path.join(path, entry["file"]))
+                         for entry in self.manifest["segments"]]
+
+    def __len__(self):
+        return self.manifest["games"]
+
+    def _save(self):
+        """
+        Writes the manifest, replacing the old one in one step.
+        """
+        manifest = os.path.join(self.path, MANIFEST)
+        with open(manifest + ".tmp", "w", encoding="utf-8") as file:
+            json.dump(self.manifest, file, indent=1)
+        os.replace(manifest + ".tmp", manifest)
+
+    def _new_segment_file(self):
+        """
+        Returns the name of the next segment file.
+        """
+        name = f"segment-{self.manifest['next_segment']:05d}.hspd"
+        self.manifest["next_segment"] += 1
+        return name
+
+    def add(self, paths, workers=None, chunk_size=256, segment_games=20000):
+        """
+        Indexes the games in paths that aren't in the database yet, writing
+        a new segment every segment_games games so memory use stays bounded.
+        Yields the number of games indexed after each chunk. With workers=0
+        everything runs in this process.
+        """
+        def numbered():
+            for path in paths:
+                source = os.path.abspath(path)
+                skip = self.manifest["indexed"].get(source, 0)
+                games = read_games(path, self.rows, self.cols)
+                for number, game in enumerate(itertools.islice(games, skip, None), skip):
+                    yield source, number, game
+
+        segment = None
+
+        def finish():
+            # write the segment and only then record it, so an interrupted
+            # add leaves the database as it was
+            entry = segment["entry"]
+            write_segment(os.path.join(self.path, entry["file"]), self.rows, self.cols,
+                          entry["first_game"], b"".join(segment["games"]),
+                          segment["postings"], segment["moves"])
+            self.manifest["segments"].append(entry)
+            self.manifest["games"] += entry["games"]
+            for source, _, count in entry["sources"]:
+                self.manifest["indexed"][source] = self.manifest["indexed"].get(source, 0) + count
+            self._save()
+            self.segments.append(Segment(os.path.join(self.path, entry["file"])))
+
+        def collect(chunk, result):
+            nonlocal segment
+            games, postings, moves = result
+            if segment is None:
+                segment = {"entry": {"file": self._new_segment_file(), "first_game": chunk[0],
+                                     "games": 0, "sources": []},
+                           "games": [], "postings": [], "moves": []}
+            segment["games"].append(games)
+            segment["postings"].append(postings)
+            segment["moves"].append(moves)
+            entry = segment["entry"]
+            entry["games"] += len(chunk[1])
+            for source, number in chunk[1]:
+                sources = entry["sources"]
+                if sources and sources[-1][0] == source and sources[-1][1] + sources[-1][2] == number:
+                    sources[-1][2] += 1
+                else:
+                    sources.append([source, number, 1])
+            if entry["games"] >= segment_games:
+                finish()
+                segment = None
+            return len(chunk[1])
+
+        def jobs():
+            next_game = self.manifest["games"]
+            # chunks never straddle two segments
+            for games in chunks(numbered(), min(chunk_size, segment_games)):
+                yield next_game, [(source, number) for source, number, _ in games], \
+                      [game for _, _, game in games]
+                next_game += len(games)
+
+        if workers == 0:
+            for first_game, sources, games in jobs():
+                yield collect( (first_game, sources),
+                               index_chunk(games, first_game, self.rows, self.cols) )
+        else:
+            workers = workers or os.cpu_count() or 1
+            with ProcessPoolExecutor(workers) as pool:
+                pending = deque()
+                for first_game, sources, games in jobs():
+                    pending.append( ((first_game, sources), pool.submit(index_chunk, games, first_game,
+                                                                        self.rows, self.cols)) )
+                    # keep the workers busy without reading the whole archive ahead
+                    if len(pending) >= 2 * workers:
+                        chunk, future = pending.popleft()
+                        yield collect(chunk, future.result())
+                while pending:
+                    chunk, future = pending.popleft()
+                    yield collect(chunk, future.result())
+        if segment is not None:
+            finish()
+
+    def compact(self):
+        """
+        Merges every segment into one, so queries only search one file.
+        Returns the number of segments merged.
+        """
+        if len(self.segments) < 2:
+            return len(self.segments)
+        entries = self.manifest["segments"]
+        tables = [segment.tables() for segment in self.segments]
+        entry = {"file": self._new_segment_file(), "first_game": entries[0]["first_game"],
+                 "games": sum(old["games"] for old in entries),
+                 "sources": [source for old in entries for source in old["sources"]]}
+        write_segment(os.path.join(self.path, entry["file"]), self.rows, self.cols, entry["first_game"],
+                      b"".join(games for games, _, _ in tables),
+                      [postings for _, postings, _ in tables], [moves for _, _, moves in tables])
+        for views in tables:
+            for view in views:
+                view.release()
+        old_files = [old["file"] for old in entries]
+        self.manifest["segments"] = [entry]
+        self._save()
+        self.close()
+        for name in old_files:
+            os.remove(os.path.join(self.path, name))
+        self.segments = [Segment(os.path.join(self.path, entry["file"]))]
+        return len(old_files)
+
+    def key(self, board, player):
+        """
+        Returns the key positions are stored under: their Zobrist key, as
+        kept by the rules engine in Rules.key.
+        """
+        return self._keys.compute(board, player)
+
+    def postings(self, key, limit=None):
+        """
+        Returns up to limit Postings of the games that reached the position
+        with key, by game id.
+        """
+        found = itertools.chain.from_iterable(segment.find_postings(key) for segment in self.segments)
+        return list(itertools.islice(found, limit))
+
+    def count(self, key):
+        """
+        Returns how many times the position with key was reached, over every game.
+        """
+        return sum(segment.count_postings(key) for segment in self.segments)
+
+    def move_stats(self, key):
+        """
+        Returns the MoveStats of every move played from the position with
+        key, most played first.
+        """
+        cols = self.cols
+        stats = []
+        for _, origin, destination, played, black, red in \
+                _merge_moves([segment.find_moves(key) for segment in self.segments]):
+            move = ( (origin % cols, origin // cols), (destination % cols, destination // cols) )
+            stats.append(MoveStats(move, played, black, red))
+        stats.sort(key=lambda entry: -entry.played)
+        return stats
+
+    def game(self, number):
+        """
+        Returns the GameInfo of game id number.
+        """
+        for segment, entry in zip(self.segments, self.manifest["segments"]):
+            if segment.first_game <= number < segment.first_game + segment.games:
+                result, plies, captures, corner_ply = segment.game(number)
+                # find the archive it came from
+                offset = number - segment.first_game
+                for path, first, count in entry["sources"]:
+                    if offset < count:
+                        break
+                    offset -= count
+                return GameInfo(number, path, first + offset, result != INVALID,
+                                record.WINNERS.get(result), plies, captures, corner_ply)
+        raise IndexError(f"no game {number}")
+
+    def corner_captures(self):
+        """
+        Returns (game id, ply of its first corner capture) for every game with a corner capture.
+        """
+        return [corner for segment in self.segments for corner in segment.corner_captures()]
+
+    def close(self):
+        """
+        Closes the segment files.
+        """
+        for segment in self.segments:
+            segment.close()
+        self.segments = []
+
+
+def _position(text, variant=variants.STANDARD):
+    """
+    Returns a Rules object for variant with the moves in text (algebraic
+    notation, separated by spaces) played from the starting position.
+    Raises ValueError for illegal moves.
+    """
+    game = Rules(variant)
+    for token in text.split():
+        origin, destination, _ = record.parse_move(token, game.COLS)
+        if game.board.get(origin) != game.get_active_player() or destination not in game.test_move(origin):
+            raise ValueError(f"illegal move {token}")
+        game.make_move(origin, destination)
+    return game
+
+
+def main():
+    """
+    Adds games to, queries or compacts a database from the command line.
+    """
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["add", "query", "corners", "compact"])
+    parser.add_argument("database", help="database directory")
+    parser.add_argument("paths", nargs="*", help="game record or text files to add")
+    parser.add_argument("--moves", default="",
+                        help="query the position after these moves, e.g. \"h6-h4 a3-e3\" "
+                             "(default: the starting position)")
+    parser.add_argument("--limit", type=int, default=10, help="most games to list")
+    parser.add_argument("--workers", type=int, help="worker processes (default: one per core, "
+                                                     "0 to index in this process)")
+    parser.add_argument("--chunk", type=int, default=256, help="games sent to a worker at a time")
+    parser.add_argument("--segment-games", type=int, default=20000,
+                        help="most games per segment written by add, which bounds its memory use")
+    parser.add_argument("--size", type=int, default=Rules.ROWS,
+                        help="board size of a new database (an existing one keeps its own)")
+    args = parser.parse_args()
+
+    try:
+        database = PositionDB(args.database, args.size, args.size)
+    except ValueError as error:
+        parser.error(str(error))
+    start = time.perf_counter()
+    if args.command == "add":
+        if not args.paths:
+            parser.error("add needs game files")
+        try:
+            games = sum(database.add(args.paths, args.workers, args.chunk, args.segment_games))
+        except ValueError as error:
+            parser.error(str(error))
+        elapsed = time.perf_counter() - start
+        print(f"games_added: {games}")
+        print(f"games: {len(database)}")
+        print(f"segments: {len(database.segments)}")
+        print(f"seconds: {elapsed:,.1f}")
+        print(f"games_per_sec: {games / elapsed if elapsed else 0.0:,.1f}")
+
+    elif args.command == "query":
+        try:
+            game = _position(args.moves, database.variant)
+        except ValueError as error:
+            parser.error(str(error))
+        key = game.key
+        count = database.count(key)
+        postings = database.postings(key, args.limit)
+        stats = database.move_stats(key)
+        elapsed = time.perf_counter() - start
+        player = game.get_active_player()
+        print(f"{count} times in {len(database)} games ({elapsed * 1000:.2f} ms), {player} to move")
+        for entry in stats[:args.limit]:
+            origin, destination = (square_name(pos, database.cols) for pos in entry.move)
+            wins, losses = entry.black_wins, entry.red_wins
+            if player == "RED":
+                wins, losses = losses, wins
+            print(f"  {origin}-{destination}: played {entry.played}, "
+                  f"won {100 * wins / entry.played:.1f}%, lost {100 * losses / entry.played:.1f}%")
+        for posting in postings:
+            info = database.game(posting.game)
+            print(f"  game {info.game} ({info.path} #{info.number}) at ply {posting.ply}: "
+                  f"{info.winner or 'unfinished'} after {info.plies} plies")
+
+    elif args.command == "corners":
+        corners = database.corner_captures()
+        elapsed = time.perf_counter() - start
+        print(f"{len(corners)} of {len(database)} games have a corner capture ({elapsed * 1000:.2f} ms)")
+        for number, ply in corners[:args.limit]:
+            info = database.game(number)
+            print(f"  game {number} ({info.path} #{info.number}) at ply {ply}")
+
+    else:
+        merged = database.compact()
+        print(f"merged {merged} segments in {time.perf_counter() - start:,.1f} seconds")
+    database.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,30 @@
+"""
+Contains the helpers shared by the game server (server.py) and its clients
+for the newline-delimited JSON messages they exchange; the messages
+themselves are described in server.py. Kept apart from the server so
+clients can use them without importing asyncio.
+"""
+import json
+
+DEFAULT_PORT = 8765
+
+
+def encode(message):
+    """
+    Returns a message as a line of JSON, ready to send.
+    """
+    return (json.dumps(message, separators=(",", ":")) + "\n").encode()
+
+
+def board_to_list(board):
+    """
+    Returns a board dictionary as a list of [x, y, color], for JSON.
+    """
+    return [[x, y, color] for (x, y), color in board.items()]
+
+
+def board_from_list(squares):
+    """
+    Returns a board dictionary from board_to_list's format.
+    """
+    return {(x, y): color for x, y, color in squares}
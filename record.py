@@ -0,0 +1,322 @@
+"""
+Contains a compact binary format for archiving played games, a streaming
+writer, an mmap based reader, and conversion to and from the algebraic
+notation described in TODO.md.
+
+File layout (all integers little-endian):
+
+    file header   4s magic b"HSGR", u8 version, u8 rows, u8 cols, u8 reserved
+    games         one after another, each:
+                    u32 number of moves, u8 result, u8 flags, u16 reserved
+                    then 2 bytes per move: u8 origin square, u8 destination square
+    index         u64 offset of each game
+    trailer       u64 offset of the index, u32 number of games, 4s magic b"HSGI"
+
+Squares are numbered y * cols + x, so boards of up to 256 squares fit.
+Results are 0 for unfinished, 1 for a black win and 2 for a red win.
+The index and trailer are written by close(); a file whose writer never
+closed can still be read, the games are just found by scanning instead.
+
+The text format is one game per line: moves like h6-c6, with any pawns
+the move captures appended as xc4xc5, then the result (BLACK, RED or *).
+"""
+import argparse
+import mmap
+import struct
+from collections import namedtuple
+
+import variants
+from rules import Rules, parse_square, square_name
+
+MAGIC = b"HSGR"
+INDEX_MAGIC = b"HSGI"
+VERSION = 1
+FILE_HEADER = struct.Struct("<4sBBBB")
+GAME_HEADER = struct.Struct("<IBBH")
+TRAILER = struct.Struct("<QI4s")
+
+RESULTS = {None: 0, "BLACK": 1, "RED": 2}
+WINNERS = {code: winner for winner, code in RESULTS.items()}
+
+# moves are (origin, destination) pairs of (x, y) positions
+GameRecord = namedtuple("GameRecord", "moves winner")
+
+
+class RecordWriter:
+    """
+    Streams games to a record file.
+    Moves are added one at a time with record_move and each game is written
+    out in one piece by end_game, so the file never has half a game in it.
+    With append=True, games are added to the end of an existing file.
+    """
+    def __init__(self, path, rows=9, cols=9, append=False):
+        if rows * cols > 256:
+            raise ValueError("record files only support boards of up to 256 squares")
+        self.rows = rows
+        self.cols = cols
+        self._offsets = []
+        self._moves = []
+
+        if append:
+            self._file = open(path, "r+b")
+            reader = RecordReader(path)
+            try:
+                if (reader.rows, reader.cols) != (rows, cols):
+                    raise ValueError(f"{path} holds {reader.rows}x{reader.cols} games")
+                self._offsets = list(reader.offsets)
+                end = reader.data_end
+            finally:
+                reader.close()
+            # the index is rewritten on close, after the new games
+            self._file.seek(end)
+            self._file.truncate()
+        else:
+            self._file = open(path, "wb")
+            self._file.write(FILE_HEADER.pack(MAGIC, VERSION, rows, cols, 0))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _square(self, pos):
+        """
+        Returns the square number of an (x, y) position.
+        """
+        return pos[1] * self.cols + pos[0]
+
+    def record_move(self, origin, destination):
+        """
+        Adds a move to the game being recorded.
+        """
+        self._moves.append(self._square(origin))
+        self._moves.append(self._square(destination))
+
+    def undo_move(self):
+        """
+        Removes the last move recorded, e.g. after a takeback.
+        """
+        del self._moves[-2:]
+
+    def end_game(self, winner=None):
+        """
+        Writes out the game being recorded with its winner ('BLACK', 'RED' or None).
+        Does nothing if no moves were recorded.
+        """
+        if not self._moves:
+            return
+        self._offsets.append(self._file.tell())
+        self._file.write(GAME_HEADER.pack(len(self._moves) // 2, RESULTS[winner], 0, 0))
+        self._file.write(bytes(self._moves))
+        self._moves = []
+
+    def write_game(self, moves, winner=None):
+        """
+        Writes a whole game at once.
+        """
+        for origin, destination in moves:
+            self.record_move(origin, destination)
+        self.end_game(winner)
+
+    def close(self):
+        """
+        Writes the game in progress, if any, as unfinished, then the index and
+        trailer, and closes the file.
+        """
+        if self._file.closed:
+            return
+        self.end_game(None)
+        index_offset = self._file.tell()
+        self._file.write(struct.pack(f"<{len(self._offsets)}Q", *self._offsets))
+        self._file.write(TRAILER.pack(index_offset, len(self._offsets), INDEX_MAGIC))
+        self._file.close()
+
+
+class RecordReader:
+    """
+    Reads a record file through mmap, so files far bigger than memory can be
+    read and only the pages actually used are loaded.
+    Supports len(), indexing and iteration, which yields GameRecords.
+    """
+    def __init__(self, path):
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.rows, self.cols, _ = FILE_HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a game record file")
+        if version != VERSION:
+            raise ValueError(f"{path} has unsupported version {version}")
+
+        size = len(self._map)
+        index_offset = count = None
+        if size >= FILE_HEADER.size + TRAILER.size:
+            index_offset, count, magic = TRAILER.unpack_from(self._map, size - TRAILER.size)
+            if magic != INDEX_MAGIC or index_offset + 8 * count + TRAILER.size != size:
+                index_offset = None
+
+        if index_offset is not None:
+            self.offsets = memoryview(self._map)[index_offset:index_offset + 8 * count].cast("Q")
+            self.data_end = index_offset
+        else:
+            # no index, e.g. the writer never closed: find the games by walking them
+            self.offsets = []
+            offset = FILE_HEADER.size
+            while offset + GAME_HEADER.size <= size:
+                moves = GAME_HEADER.unpack_from(self._map, offset)[0]
+                end = offset + GAME_HEADER.size + 2 * moves
+                if end > size:
+                    break
+                self.offsets.append(offset)
+                offset = end
+            self.data_end = offset
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def _position(self, square):
+        """
+        Returns the (x, y) position of a square number.
+        """
+        return (square % self.cols, square // self.cols)
+
+    def __getitem__(self, number):
+        """
+        Returns game number as a GameRecord.
+        """
+        offset = self.offsets[number]
+        count, result, _, _ = GAME_HEADER.unpack_from(self._map, offset)
+        start = offset + GAME_HEADER.size
+        squares = self._map[start:start + 2 * count]
+        position = self._position
+        moves = [(position(squares[i]), position(squares[i + 1])) for i in range(0, len(squares), 2)]
+        return GameRecord(moves, WINNERS[result])
+
+    def __iter__(self):
+        for number in range(len(self)):
+            yield self[number]
+
+    def close(self):
+        """
+        Closes the file.
+        """
+        if isinstance(self.offsets, memoryview):
+            self.offsets.release()
+        self._map.close()
+        self._file.close()
+
+
+def iter_games(path):
+    """
+    Yields every game in a record file as a GameRecord, one at a time.
+    """
+    with RecordReader(path) as reader:
+        yield from reader
+
+
+def move_to_text(origin, destination, captured=(), cols=9):
+    """
+    Returns a move in algebraic notation, e.g. 'h6-c6xb6xc4xc5'.
+    """
+    text = f"{square_name(origin, cols)}-{square_name(destination, cols)}"
+    return text + "".join("x" + square_name(pos, cols) for pos in sorted(captured))
+
+
+def game_to_text(moves, winner=None, rules=Rules):
+    """
+    Returns a game as one line of algebraic notation. The moves are replayed
+    through the rules to find the captures each one makes.
+    """
+    game = rules()
+    tokens = []
+    for origin, destination in moves:
+        undo = game.make_move(origin, destination)
+        tokens.append(move_to_text(origin, destination, undo.captured or (), game.COLS))
+    tokens.append(winner or "*")
+    return " ".join(tokens)
+
+
+def parse_move(text, cols=9):
+    """
+    Returns (origin, destination, captured) from a move in algebraic notation.
+    captured is None if the move has no capture annotation.
+    """
+    squares, *captures = text.strip().lower().split("x")
+    origin, destination = squares.split("-")
+    captured = {parse_square(name, cols) for name in captures} if captures else None
+    return parse_square(origin, cols), parse_square(destination, cols), captured
+
+
+def game_from_text(line, cols=9):
+    """
+    Returns (moves, captures, winner) from one line of algebraic notation,
+    where captures has the annotated captured squares of each move (or None).
+    A missing result counts as unfinished.
+    """
+    tokens = line.split()
+    winner = None
+    if tokens and tokens[-1].upper() in ("BLACK", "RED", "*"):
+        result = tokens.pop().upper()
+        winner = None if result == "*" else result
+    moves, captures = [], []
+    for token in tokens:
+        origin, destination, captured = parse_move(token, cols)
+        moves.append( (origin, destination) )
+        captures.append(captured)
+    return moves, captures, winner
+
+
+def export_text(record_path, text_path):
+    """
+    Writes every game in a record file to a text file. Returns the number of games.
+    """
+    count = 0
+    with RecordReader(record_path) as reader, open(text_path, "w", encoding="utf-8") as out:
+        # replay on a board the size the file says, so the captures come out right
+        variant = variants.resized(reader.rows, reader.cols)
+        for game in reader:
+            out.write(game_to_text(game.moves, game.winner, lambda: Rules(variant)) + "\n")
+            count += 1
+    return count
+
+
+def import_text(text_path, record_path):
+    """
+    Writes every game in a text file to a new record file. Returns the number of games.
+    """
+    count = 0
+    with open(text_path, encoding="utf-8") as lines, RecordWriter(record_path) as writer:
+        for line in lines:
+            if line.strip():
+                moves, _, winner = game_from_text(line)
+                writer.write_game(moves, winner)
+                count += 1
+    return count
+
+
+def main():
+    """
+    Converts between record files and algebraic notation from the command line.
+    """
+    parser = argparse.ArgumentParser(description="Convert Hasami Shogi game records.")
+    parser.add_argument("command", choices=["export", "import"],
+                        help="export: record file to text, import: text to record file")
+    parser.add_argument("source")
+    parser.add_argument("destination")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        count = export_text(args.source, args.destination)
+    else:
+        count = import_text(args.source, args.destination)
+    print(f"{count} games converted")
+
+
+if __name__ == "__main__":
+    main()
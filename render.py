@@ -0,0 +1,244 @@
+"""
+Renders archived games to images without a window, e.g. board thumbnails
+or animated GIFs for publishing games.
+
+Positions are drawn by graphics.Graphics on SDL's dummy video driver, the
+same way the game window draws them: the board layer is drawn once and
+only the squares that change between moves are redrawn, with the piece
+sprites cached. The last move is highlighted and finished games end with
+the game over message. Games are read as a stream (as in replay.py) and
+rendered on a pool of worker processes, each keeping its own Graphics.
+
+Frames are written as PNG files, one directory per game, or as one
+animated GIF per game, which needs Pillow (pip install pillow). --final
+writes just the final position of each game, as a thumbnail. The moves
+aren't checked, so check doubtful archives with replay.py first.
+
+Usage:
+    python render.py games.hsg --out images/ [--format png|gif] [--size 375] [--final]
+"""
+import argparse
+import importlib.util
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import graphics
+import pygame
+import record
+from replay import chunks, read_games
+from rules import Rules
+
+# how many frames the last frame of a GIF stays up for
+GIF_HOLD = 4
+# colours in the palette the frames of a GIF share
+GIF_COLORS = 128
+
+
+class Renderer:
+    """
+    Draws positions offscreen and returns them as surfaces of size x size pixels.
+    """
+    def __init__(self, size=graphics.WIN_WIDTH):
+        self.size = size
+        self.window = graphics.Graphics(headless=True)
+
+    def frame(self):
+        """
+        Returns what is drawn at the moment, scaled to size.
+        """
+        # nothing is shown offscreen, so there is nothing to present
+        self.window.dirty_rects = []
+        screen = self.window.screen
+        if screen.get_width() == self.size:
+            return screen.copy()
+        return pygame.transform.smoothscale(screen, (self.size, self.size))
+
+    def render_game(self, moves, winner=None, final_only=False):
+        """
+        Yields a frame of the starting position and of the position after
+        each move, or with final_only just the final position.
+        """
+        game = Rules()
+        window = self.window
+        window.invalidate()
+        if not final_only:
+            window.draw(game.board, game.get_active_player())
+            yield self.frame()
+        for ply, (origin, destination) in enumerate(moves, 1):
+            game.make_move(origin, destination)
+            if final_only and ply < len(moves):
+                continue
+            window.draw(game.board, game.get_active_player())
+            window.highlight_square( (origin, destination) )
+            if ply == len(moves) and winner:
+                window.display_game_over(winner)
+            yield self.frame()
+        if final_only and not moves:
+            window.draw(game.board, game.get_active_player())
+            yield self.frame()
+
+
+def to_image(surface):
+    """
+    Returns a surface as an RGB Pillow image.
+    """
+    from PIL import Image
+
+    return Image.frombytes("RGB", surface.get_size(), pygame.image.tobytes(surface, "RGB"))
+
+
+def save_gif(frames, path, duration=500):
+    """
+    Writes frames as an animated GIF that loops, showing each for duration
+    milliseconds and holding the last one a little longer.
+    """
+    from PIL import Image
+
+    images = [to_image(frame) for frame in frames]
+    # give every frame the same palette, taken from the first and last frames
+    # (which between them have the board, both pieces, the highlight and the
+    # game over text), instead of working out a palette per frame. Several
+    # times quicker, and the frames compress better
+    first, last = images[0], images[-1]
+    sample = Image.new("RGB", (first.width * 2, first.height))
+    sample.paste(first, (0, 0))
+    sample.paste(last, (first.width, 0))
+    palette = sample.quantize(GIF_COLORS, dither=Image.Dither.NONE)
+    images = [image.quantize(palette=palette, dither=Image.Dither.NONE) for image in images]
+    durations = [duration] * (len(images) - 1) + [duration * GIF_HOLD]
+    images[0].save(path, save_all=True, append_images=images[1:], duration=durations, loop=0)
+
+
+# each worker process's Renderer, by size
+_renderers = {}
+
+
+def render_chunk(jobs, out, size, fmt, final_only, duration):
+    """
+    Renders a list of (name, game) jobs in a worker process, where game is a
+    GameRecord or a line of algebraic notation and name is what its files are
+    called. Returns (image files written, frames rendered, errors) with
+    errors as (name, message).
+    """
+    renderer = _renderers.get(size)
+    if renderer is None:
+        renderer = _renderers[size] = Renderer(size)
+    images = 0
+    frame_count = 0
+    errors = []
+    for name, game in jobs:
+        try:
+            if isinstance(game, str):
+                moves, _, winner = record.game_from_text(game)
+            else:
+                moves, winner = game
+            frames = renderer.render_game(moves, winner, final_only)
+            if final_only:
+                pygame.image.save(next(frames), os.path.join(out, f"{name}.{fmt}"))
+                images += 1
+                frame_count += 1
+            elif fmt == "gif":
+                frames = list(frames)
+                save_gif(frames, os.path.join(out, f"{name}.gif"), duration)
+                images += 1
+                frame_count += len(frames)
+            else:
+                directory = os.path.join(out, name)
+                os.makedirs(directory, exist_ok=True)
+                for ply, frame in enumerate(frames):
+                    pygame.image.save(frame, os.path.join(directory, f"{ply:04d}.png"))
+                    images += 1
+                    frame_count += 1
+        except (ValueError, KeyError) as error:
+            # bad notation, or a move from an empty square
+            errors.append( (name, str(error)) )
+    return images, frame_count, errors
+
+
+def render(paths, out, size=graphics.WIN_WIDTH, fmt="png", final_only=False, duration=500,
+           workers=None, chunk_size=16):
+    """
+    Renders every game in paths into the directory out and yields
+    render_chunk's (images, frames, errors) for each chunk of games as it finishes.
+    With workers=0 everything runs in this process.
+    """
+    os.makedirs(out, exist_ok=True)
+
+    def named():
+        for path in paths:
+            stem = os.path.splitext(os.path.basename(path))[0]
+            for number, game in enumerate(read_games(path)):
+                yield f"{stem}-{number:06d}", game
+
+    arguments = (out, size, fmt, final_only, duration)
+    stream = chunks(named(), chunk_size)
+    if workers == 0:
+        for chunk in stream:
+            yield render_chunk(chunk, *arguments)
+        return
+
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(workers) as pool:
+        pending = deque()
+        for chunk in stream:
+            pending.append(pool.submit(render_chunk, chunk, *arguments))
+            # keep the workers busy without reading the whole archive ahead
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def main():
+    """
+    Renders the archives named on the command line and prints the totals.
+    """
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="+", help="game record or text files")
+    parser.add_argument("--out", required=True, help="directory to write the images to")
+    parser.add_argument("--format", choices=["png", "gif"], default="png",
+                        help="PNG frames, or an animated GIF per game (needs Pillow)")
+    parser.add_argument("--size", type=int, default=graphics.WIN_WIDTH,
+                        help="width and height of the images in pixels")
+    parser.add_argument("--final", action="store_true",
+                        help="only render the final position of each game")
+    parser.add_argument("--duration", type=int, default=500, help="milliseconds per GIF frame")
+    parser.add_argument("--workers", type=int, help="worker processes (default: one per core, "
+                                                     "0 to render in this process)")
+    parser.add_argument("--chunk", type=int, default=16, help="games sent to a worker at a time")
+    args = parser.parse_args()
+
+    if args.format == "gif" and not args.final and importlib.util.find_spec("PIL") is None:
+        parser.error("GIF export needs Pillow: pip install pillow")
+    if args.format == "gif" and args.final:
+        # a single frame is a picture, not an animation
+        args.format = "png"
+
+    images = 0
+    frames = 0
+    failed = 0
+    start = time.perf_counter()
+    for written, rendered, errors in render(args.paths, args.out, args.size, args.format,
+                                            args.final, args.duration, args.workers, args.chunk):
+        images += written
+        frames += rendered
+        failed += len(errors)
+        for name, error in errors:
+            print(f"{name}: {error}", file=sys.stderr)
+    elapsed = time.perf_counter() - start
+
+    print(f"images: {images}")
+    print(f"frames: {frames}")
+    print(f"failed_games: {failed}")
+    print(f"seconds: {elapsed:,.1f}")
+    print(f"images_per_sec: {images / elapsed if elapsed else 0.0:,.1f}")
+    print(f"frames_per_sec: {frames / elapsed if elapsed else 0.0:,.1f}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+"""
+Replays archived games through the rules engine to check that they are
+still valid, e.g. after a change to the rules.
+
+Every move is checked against test_move, the captures annotated in text
+games are checked against the captures the rules make, and the recorded
+winner is checked against the winner the rules find. Games are read as a
+stream and replayed on a pool of worker processes, so archives far bigger
+than memory can be checked. Takes game record files (record.py) or text
+files with one game per line in algebraic notation.
+
+Usage:
+    python replay.py games.hsg more_games.txt [--output results.jsonl]
+
+Exits with status 1 if any game is invalid.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+
+import record
+from rules import Rules, square_name
+
+# what can be wrong with a game, in the order it is checked
+ERROR_KINDS = ("notation", "finished", "turn", "illegal", "captures", "winner")
+
+
+def read_games(path, rows=Rules.ROWS, cols=Rules.COLS):
+    """
+    Yields every game in a file as a GameRecord or, for text files, as the
+    line it is written on, so the parsing happens in the worker processes.
+    The file type is worked out from its first bytes. Raises ValueError for
+    record files of another board size than rows x cols.
+    """
+    with open(path, "rb") as file:
+        binary = file.read(len(record.MAGIC)) == record.MAGIC
+    if binary:
+        with record.RecordReader(path) as reader:
+            if (reader.rows, reader.cols) != (rows, cols):
+                raise ValueError(f"{path} holds {reader.rows}x{reader.cols} games")
+            yield from reader
+    else:
+        with open(path, encoding="utf-8") as lines:
+            for line in lines:
+                if line.strip():
+                    yield line
+
+
+def _names(squares):
+    """
+    Returns squares as a sorted, comma separated list of names.
+    """
+    return ",".join(sorted(square_name(pos) for pos in squares)) or "none"
+
+
+def replay_game(game):
+    """
+    Replays one game, given as a GameRecord or a line of algebraic notation.
+    Returns a dictionary describing the result; error is None for valid games,
+    otherwise it says what went wrong, kind is one of ERROR_KINDS and ply is
+    the move it went wrong on (None for the result).
+    """
+    result = {"moves": 0, "captures": 0, "winner": None, "error": None, "kind": None, "ply": None}
+    try:
+        if isinstance(game, str):
+            moves, captures, winner = record.game_from_text(game)
+            # a move written without captures says it captured nothing
+            captures = [captured or set() for captured in captures]
+        else:
+            moves, winner = game
+            # binary records don't store captures, so there is nothing to compare
+            captures = [None] * len(moves)
+    except ValueError as error:
+        result.update(error=f"bad notation: {error}", kind="notation")
+        return result
+
+    rules = Rules()
+    for ply, ((origin, destination), expected) in enumerate(zip(moves, captures), 1):
+        if rules.winner:
+            kind, error = "finished", f"move after {rules.winner} won"
+        elif rules.board.get(origin) != rules.get_active_player():
+            kind, error = "turn", f"no {rules.get_active_player()} pawn on {square_name(origin)}"
+        elif destination not in rules.test_move(origin):
+            kind, error = "illegal", f"illegal move {record.move_to_text(origin, destination)}"
+        else:
+            kind = None
+        if kind:
+            result.update(error=error, kind=kind, ply=ply)
+            return result
+
+        captured = set(rules.make_move(origin, destination).captured or ())
+        result["moves"] = ply
+        result["captures"] += len(captured)
+        if expected is not None and captured != expected:
+            result.update(error=f"captured {_names(captured)}, recorded {_names(expected)}",
+                          kind="captures", ply=ply)
+            return result
+
+    result["winner"] = rules.winner
+    if rules.winner != winner:
+        result.update(error=f"winner is {rules.winner or 'nobody'}, recorded {winner or 'nobody'}",
+                      kind="winner")
+    return result
+
+
+def replay_chunk(games):
+    """
+    Replays a list of games in a worker process. Returns their results in order.
+    """
+    return [replay_game(game) for game in games]
+
+
+def chunks(games, size):
+    """
+    Yields lists of up to size items from games.
+    """
+    chunk = []
+    for game in games:
+        chunk.append(game)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def replay(paths, workers=None, chunk_size=256):
+    """
+    Replays every game in paths and yields (path, game number, result) for
+    each, in order. With workers=0 everything runs in this process.
+    Only a few chunks are in flight at once, so memory use doesn't grow with
+    the size of the archive.
+    """
+    def numbered():
+        for path in paths:
+            for number, game in enumerate(read_games(path)):
+                yield path, number, game
+
+    stream = chunks(numbered(), chunk_size)
+    if workers == 0:
+        for chunk in stream:
+            yield from _label(chunk, replay_chunk([game for _, _, game in chunk]))
+        return
+
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(workers) as pool:
+        pending = deque()
+        for chunk in stream:
+            pending.append( (chunk, pool.submit(replay_chunk, [game for _, _, game in chunk])) )
+            # keep the workers busy without reading the whole archive ahead
+            if len(pending) >= 2 * workers:
+                chunk, future = pending.popleft()
+                yield from _label(chunk, future.result())
+        while pending:
+            chunk, future = pending.popleft()
+            yield from _label(chunk, future.result())
+
+
+def _label(chunk, results):
+    """
+    Yields (path, game number, result) for the games in chunk.
+    """
+    for (path, number, _), result in zip(chunk, results):
+        yield path, number, result
+
+
+def main():
+    """
+    Replays the archives named on the command line and prints the totals.
+    """
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="+", help="game record or text files")
+    parser.add_argument("--output", help="write one JSON result per game to this file")
+    parser.add_argument("--workers", type=int, help="worker processes (default: one per core, "
+                                                     "0 to replay in this process)")
+    parser.add_argument("--chunk", type=int, default=256, help="games sent to a worker at a time")
+    parser.add_argument("--json", help="also write the totals to this file")
+    args = parser.parse_args()
+
+    totals = Counter()
+    errors = Counter()
+    output = open(args.output, "w", encoding="utf-8") if args.output else None
+    start = time.perf_counter()
+    try:
+        for path, number, result in replay(args.paths, args.workers, args.chunk):
+            totals["games"] += 1
+            totals["moves"] += result["moves"]
+            totals["captures"] += result["captures"]
+            totals[(result["winner"] or "unfinished").lower()] += 1
+            if result["error"]:
+                totals["invalid"] += 1
+                errors[result["kind"]] += 1
+                where = f" move {result['ply']}" if result["ply"] else ""
+                print(f"{path} game {number}{where}: {result['error']}", file=sys.stderr)
+            if output:
+                output.write(json.dumps({"path": path, "game": number, **result}) + "\n")
+    finally:
+        if output:
+            output.close()
+    elapsed = time.perf_counter() - start
+
+    summary = {
+               "games": totals["games"],
+               "valid": totals["games"] - totals["invalid"],
+               "invalid": totals["invalid"],
+               "moves": totals["moves"],
+               "captures": totals["captures"],
+               "black_wins": totals["black"],
+               "red_wins": totals["red"],
+               "unfinished": totals["unfinished"],
+               "errors": dict(errors),
+               "seconds": elapsed,
+               "games_per_sec": totals["games"] / elapsed if elapsed else 0.0,
+               "moves_per_sec": totals["moves"] / elapsed if elapsed else 0.0,
+              }
+    for key, value in summary.items():
+        if isinstance(value, float):
+            value = f"{value:,.1f}"
+        print(f"{key}: {value}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump(summary, file, indent=2)
+    sys.exit(1 if totals["invalid"] else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,429 @@
+"""
+Contains the rules engine for Hasami Shogi.
+Nothing in here imports pygame or prints anything, so games can be
+simulated headlessly at full speed, e.g. for analysis or for testing bots.
+game.py builds the graphical game on top of this.
+The board size and rules come from a variants.Variant; variant 1 on a 9x9
+board is the default.
+"""
+from collections import namedtuple
+
+import tables
+import variants
+import zobrist
+
+# everything make_move changes, so that unmake_move can put it back exactly.
+# player, winner and key are whose turn it was, the winner and the Zobrist key
+# before the move
+Undo = namedtuple("Undo", "origin destination captured player winner key")
+
+# algebraic notation: rows are lettered from the top and columns are numbered
+# from the right, as labelled on the board, so (0, 0) is a9 and (8, 8) is i1
+ROW_LETTERS = "abcdefghijklmnopqrs"
+
+
+def square_name(pos, cols=9):
+    """
+    Returns the algebraic name of an (x, y) position, e.g. (3, 7) -> 'h6'.
+    """
+    x, y = pos
+    return f"{ROW_LETTERS[y]}{cols - x}"
+
+
+def parse_square(name, cols=9):
+    """
+    Returns the (x, y) position of an algebraic square name, e.g. 'h6' -> (3, 7).
+    Raises ValueError for names that aren't on the board.
+    """
+    name = name.strip().lower()
+    if len(name) < 2 or name[0] not in ROW_LETTERS or not name[1:].isdigit():
+        raise ValueError(f"not a square: {name!r}")
+    x, y = cols - int(name[1:]), ROW_LETTERS.index(name[0])
+    if not 0 <= x < cols:
+        raise ValueError(f"not a square: {name!r}")
+    return (x, y)
+
+
+class Rules:
+    """
+    The board and rules of a game of Hasami Shogi, variant 1 unless another
+    variants.Variant is given.
+    Tracks the board, whose turn it is, the pieces remaining for each
+    player and the winner, but does not render anything.
+    """
+    # constants
+    VARIANT = variants.STANDARD
+    ROWS = VARIANT.rows
+    COLS = VARIANT.cols
+    # set to a record.RecordWriter to archive the games played through play_move
+    recorder = None
+
+    def __init__(self, variant=None):
+        if variant is not None:
+            self.VARIANT = variant
+            self.ROWS, self.COLS = variant.rows, variant.cols
+        # rays and capture patterns for this board size, shared between games
+        self._tables = tables.get_tables(self.ROWS, self.COLS)
+        self._zobrist = zobrist.get_keys(self.ROWS, self.COLS)
+        # corner captures are only looked for where the variant has them
+        self._corner_caps = self._tables.corner_caps if self.VARIANT.corner_captures else {}
+        # the variant's rules the hot paths need, looked up once here
+        self._jumps = self.VARIANT.jumps
+        self._line = self.VARIANT.line
+        self._min_pieces = self.VARIANT.min_pieces
+        # the rows of each side's camp, for the variants won by a line of pawns
+        start_rows = self.VARIANT.start_rows
+        self._camps = {
+                       "RED": range(start_rows),
+                       "BLACK": range(self.ROWS - start_rows, self.ROWS),
+                      }
+        # initialize new game state
+        self.reset_game_state()
+
+    def reset_game_state(self):
+        """
+        Resets the game state to its initial conditions.
+        """
+        # archive the game that's ending, if it got anywhere
+        if self.recorder is not None:
+            self.recorder.end_game(self.winner)
+        # track the board state using a dictionary
+        # pawns are recorded using xy coords as keys in a tuple
+        self.board = self.create_board()
+        # initialize player turn to black as they always start
+        self._active_player = "BLACK"
+        # initialize dictionary to hold how many pieces lost by each player
+        self._pieces_remaining = {
+                                  "BLACK": self.COLS * self.VARIANT.start_rows,
+                                  "RED": self.COLS * self.VARIANT.start_rows,
+                                 }
+        # initialize the new game as unfinished
+        self.winner = None
+        # Zobrist key of the position, kept up to date by make_move
+        self.key = self._zobrist.compute(self.board, self._active_player)
+        # undo records of the moves played so far, and of moves taken back
+        self._history = []
+        self._redo = []
+
+    def create_board(self):
+        """
+        Create the game board using a dictionary. The keys of each item are
+        a tuple representing coordinates on the board such that the first item key is (0, 0).
+        The value of each item represents whether that square is occupied by either
+        color of pawn. Unoccupied squares are left out of the dictionary.
+        """
+        # create a new dictionary to hold the squares
+        new_board = {}
+        start_rows = self.VARIANT.start_rows
+        for y in range (self.ROWS):
+            for x in range (self.COLS):
+                # fill the top rows with Red pawns
+                if y < start_rows:
+                    new_board[ (x, y) ] = 'RED'
+                # fill the bottom rows with Black pawns
+                elif y >= self.ROWS - start_rows:
+                    new_board[ (x, y) ] = 'BLACK'
+                # the rest of the board starts empty
+
+        return new_board
+
+    def set_position(self, board, active_player="BLACK"):
+        """
+        Sets up an arbitrary position from a board dictionary in the same
+        format as create_board, e.g. for analysis or testing.
+        """
+        self.board = dict(board)
+        self._active_player = active_player
+        self._pieces_remaining = {"BLACK": 0, "RED": 0}
+        for color in self.board.values():
+            self._pieces_remaining[color] += 1
+        self.winner = None
+        self.key = self._zobrist.compute(self.board, active_player)
+        self._history = []
+        self._redo = []
+
+    def get_active_player(self):
+        """
+        Returns whose turn it is - either 'RED' or 'BLACK'.
+        """
+        return self._active_player
+
+    def get_pieces_remaining(self, player):
+        """
+        Returns the number of pieces 'RED' or 'BLACK' has left on the board.
+        """
+        return self._pieces_remaining[player]
+
+    def test_move(self, origin):
+        """
+        Returns the set of all squares the piece on origin can legally move to.
+        Pawns can move horizontally or vertically like rooks but cannot jump
+        other pawns, except in variants with jumps, where a pawn may also
+        jump a pawn next to it onto the empty square beyond.
+        """
+        # set to hold all possible moves from origin square.
+        legal_moves = set()
+        board = self.board
+
+        # walk out along each ray until another pawn is in the way
+        for ray in self._tables.rays[origin]:
+            for square in ray:
+                if square in board:
+                    break
+                legal_moves.add(square)
+
+        if self._jumps:
+            for ray in self._tables.rays[origin]:
+                if len(ray) > 1 and ray[0] in board and ray[1] not in board:
+                    legal_moves.add(ray[1])
+
+        return legal_moves
+
+    def legal_moves(self):
+        """
+        Yields every legal (origin, destination) move for the active player.
+        """
+        origins = [pos for pos, color in self.board.items() if color == self._active_player]
+        for origin in origins:
+            for destination in self.test_move(origin):
+                yield origin, destination
+
+    def count_moves(self, player=None):
+        """
+        Returns how many legal moves player (by default the active player) has.
+        """
+        player = player or self._active_player
+        return sum(len(self.test_move(pos)) for pos, color in self.board.items()
+                   if color == player)
+
+    def check_captures(self, pos):
+        """
+        Method called by make_move to check if any captures
+        are made by move.
+        First check if any opposing player pawns are adjacent to pawn that was just moved.
+        If yes then checks what is on the opposite site of opposing pawn.
+        If it is an empty square or off the board then nothing is captured. If it is a pawn
+        belonging to the active player then the opposing pawns in between are captured.
+        If two or more pawns of the opposing player are lined next to pawn then keep checking
+        until there is either an empty square, board boundary or pawn belonging to the player.
+
+        Also checks for corner captures by calling check_corner_cap.
+        Returns a list of the captured positions.
+        """
+        # initialize a list to hold capture positions to send back to make_move
+        capture_list = []
+        board = self.board
+        player = self._active_player
+
+        # get the opposing player
+        if player == "BLACK":
+            opponent = "RED"
+        else:
+            opponent = "BLACK"
+
+        # if pos is next to a corner, then check if corner capture
+        if pos in self._corner_caps:
+            corner_capture = self.check_corner_cap(pos, opponent)
+            # returns None if no corner captures
+            if corner_capture is not None:
+                capture_list.append(corner_capture)
+
+        # look above, below, left and right of the piece
+        for ray in self._tables.rays[pos]:
+            for n, square in enumerate(ray):
+                occupant = board.get(square)
+                if occupant != opponent:
+                    # a run of at least one opponent pawn closed off by our own pawn
+                    if n and occupant == player:
+                        capture_list.extend(ray[:n])
+                    break
+
+        return capture_list
+
+    def preview_captures(self, origin, destination):
+        """
+        Returns the list of positions the active player would capture by
+        moving from origin to destination, without making the move.
+        """
+        board = self.board
+        del board[origin]
+        board[destination] = self._active_player
+        try:
+            return self.check_captures(destination)
+        finally:
+            # put the pawn back where it came from
+            del board[destination]
+            board[origin] = self._active_player
+
+    def check_corner_cap(self, origin, opponent):
+        """
+        Helper method called by check_captures to check
+        for special corner_captures.
+        Returns the captured corner position or None.
+        """
+        partner, corner = self._tables.corner_caps[origin]
+
+        # both squares next to the corner must belong to the active player
+        if self.board.get(origin) != self._active_player or \
+           self.board.get(partner) != self._active_player:
+            return None
+
+        if self.board.get(corner) == opponent:
+            return corner
+
+        return None
+
+    def check_line(self, pos):
+        """
+        Returns True if the pawn on pos is part of a line of VARIANT.line
+        pawns of its colour, none of them in that side's own camp.
+        """
+        board = self.board
+        player = board[pos]
+        camp = self._camps[player]
+        if pos[1] in camp:
+            return False
+        length = self._line
+        for rays in self._tables.lines[pos]:
+            count = 1
+            for ray in rays:
+                for square in ray:
+                    if board.get(square) != player or square[1] in camp:
+                        break
+                    count += 1
+            if count >= length:
+                return True
+        return False
+
+    def make_move(self, origin, destination):
+        """
+        Moves the active player's piece from origin to destination,
+        removes any captured pieces and switches the turn.
+        Does not check the move is legal; use test_move for that.
+        Returns an Undo record that unmake_move can use to take the move back,
+        so positions can be searched without copying the board.
+        """
+        player = self._active_player
+        undo = Undo(origin, destination, None, player, self.winner, self.key)
+        keys = self._zobrist.pieces
+
+        # update the board: copy the piece to the destination square,
+        self.board[ (destination) ] = player
+        # remove it from its origin,
+        del self.board[ (origin) ]
+        self.key ^= keys[player][origin] ^ keys[player][destination]
+
+        # checking if the move makes any captures
+        cap_list = self.check_captures(destination)
+
+        # remove captured pieces from the board
+        if cap_list:
+            undo = undo._replace(captured=tuple(cap_list))
+            # captured pieces always belong to the player who didn't move
+            opponent = self.board[cap_list[0]]
+            self._pieces_remaining[opponent] -= len(cap_list)
+            for piece in cap_list:
+                # and delete the captured piece from the game board
+                del self.board[ (piece) ]
+                self.key ^= keys[opponent][piece]
+
+        # in variants won by a line of pawns, the moved pawn can complete one
+        if self._line and not self.winner and self.check_line(destination):
+            self.winner = player
+
+        # switch the active player following a legal move
+        self._update_turn()
+
+        return undo
+
+    def unmake_move(self, undo):
+        """
+        Takes back the move described by an Undo record from make_move.
+        Moves must be unmade in the reverse order they were made.
+        """
+        player = undo.player
+        del self.board[undo.destination]
+        self.board[undo.origin] = player
+
+        if undo.captured:
+            if player == "BLACK":
+                opponent = "RED"
+            else:
+                opponent = "BLACK"
+            for piece in undo.captured:
+                self.board[piece] = opponent
+            self._pieces_remaining[opponent] += len(undo.captured)
+
+        self._active_player = player
+        self.winner = undo.winner
+        self.key = undo.key
+
+    def play_move(self, origin, destination):
+        """
+        Makes a move as part of the game being played, recording it in the
+        history so it can be taken back. Clears any moves waiting to be redone.
+        Returns the move's Undo record.
+        """
+        undo = self.make_move(origin, destination)
+        self._history.append(undo)
+        self._redo.clear()
+        if self.recorder is not None:
+            self.recorder.record_move(origin, destination)
+        return undo
+
+    def takeback(self):
+        """
+        Takes back the last move played. Returns its Undo record,
+        or None if there is nothing to take back.
+        """
+        if not self._history:
+            return None
+        undo = self._history.pop()
+        self.unmake_move(undo)
+        self._redo.append(undo)
+        if self.recorder is not None:
+            self.recorder.undo_move()
+        return undo
+
+    def redo(self):
+        """
+        Replays the last move taken back. Returns its new Undo record,
+        or None if there is nothing to redo.
+        """
+        if not self._redo:
+            return None
+        taken_back = self._redo.pop()
+        undo = self.make_move(taken_back.origin, taken_back.destination)
+        self._history.append(undo)
+        if self.recorder is not None:
+            self.recorder.record_move(taken_back.origin, taken_back.destination)
+        return undo
+
+    def _update_turn(self):
+        """
+        Flips the active player depending on whether it's RED or BLACKs turn
+        following a legal move. Ends the game if a player has fewer pawns
+        remaining than the variant's min_pieces (1 or 0 in variant 1).
+        """
+        min_pieces = self._min_pieces
+
+        if self._pieces_remaining["BLACK"] < min_pieces:
+            self.winner = "RED"
+            return
+
+        if self._pieces_remaining["RED"] < min_pieces:
+            self.winner = "BLACK"
+
+        # else switch the active player
+        if self._active_player == "BLACK":
+            self._active_player = "RED"
+        else:
+            self._active_player = "BLACK"
+        self.key ^= self._zobrist.black_to_move
+
+    def count_repetitions(self):
+        """
+        Returns how many times the current position has come up before
+        in the moves played, by comparing Zobrist keys.
+        """
+        return sum(1 for undo in self._history if undo.key == self.key)
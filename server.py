@@ -0,0 +1,351 @@
+"""
+Contains an asyncio game server that hosts many games of Hasami Shogi at once.
+
+Clients connect over TCP and talk in JSON messages, one per line.
+Client to server:
+    {"type": "join"}                      wait for an opponent and start a match
+    {"type": "move", "origin": [x, y], "destination": [x, y]}
+    {"type": "stats"}                     ask for the server's statistics
+Server to client:
+    {"type": "start", "match": n, "color": "BLACK", "board": [[x, y, color], ...], "turn": "BLACK"}
+    {"type": "moved", "origin": [x, y], "destination": [x, y], "captured": [[x, y], ...],
+     "turn": "RED", "winner": null, "ply": 1}
+    {"type": "error", "message": "..."}   the last message was refused
+    {"type": "left"}                      the opponent disconnected
+    {"type": "stats", ...}
+
+Moves are checked on the server with test_move and played with play_move;
+both players get the result of every move. A move takes a few tens of
+microseconds to check and play, so it runs on the event loop itself:
+handing it to a thread would cost more than the move. The server measures
+how late its event loop runs (loop_lag_ms) to show it isn't held up.
+
+Usage:
+    python server.py [--host 127.0.0.1] [--port 8765] [--processes N] [--report SECONDS]
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+from collections import deque
+from multiprocessing import Process
+
+from framestats import percentile
+from protocol import DEFAULT_PORT, board_to_list, encode
+from rules import Rules
+
+# longest line a client may send, in bytes
+MAX_MESSAGE = 4096
+
+
+def _square(value):
+    """
+    Returns a square sent by a client as an (x, y) tuple, or None if it isn't one.
+    """
+    if isinstance(value, list) and len(value) == 2 and all(type(n) is int for n in value):
+        return tuple(value)
+    return None
+
+
+class Match:
+    """
+    A game between two connected players.
+    """
+    def __init__(self, number, black, red):
+        self.number = number
+        self.rules = Rules()
+        self.players = {"BLACK": black, "RED": red}
+        self.ply = 0
+        # seconds from receiving each move to having queued its result for both players
+        self.latencies = deque(maxlen=1000)
+
+    def opponent(self, player):
+        """
+        Returns the other player in the match.
+        """
+        if self.players["BLACK"] is player:
+            return self.players["RED"]
+        return self.players["BLACK"]
+
+
+class Player:
+    """
+    A connected client.
+    """
+    def __init__(self, writer):
+        self.writer = writer
+        self.color = None
+        self.match = None
+
+    def send(self, message):
+        """
+        Queues a message to the client. Sending never waits; drain the writer for that.
+        """
+        if not self.writer.is_closing():
+            self.writer.write(encode(message))
+
+
+class GameServer:
+    """
+    Pairs up players as they join and runs their matches.
+    """
+    def __init__(self):
+        self.matches = {}
+        self.players = set()
+        self._waiting = None
+        self._next_match = 1
+        self.finished = 0
+        self.moves = 0
+        self.started = time.perf_counter()
+        # recent move latencies across every match, in seconds
+        self.latencies = deque(maxlen=10000)
+        self.loop_lag = deque(maxlen=1000)
+
+    async def handle(self, reader, writer):
+        """
+        Serves one client connection until it closes.
+        """
+        player = Player(writer)
+        self.players.add(player)
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except (ConnectionError, asyncio.LimitOverrunError, ValueError):
+                    break
+                if not line:
+                    break
+                received = time.perf_counter()
+                try:
+                    message = json.loads(line)
+                    kind = message["type"]
+                except (ValueError, KeyError, TypeError):
+                    player.send({"type": "error", "message": "messages must be JSON objects with a type"})
+                    continue
+
+                if kind == "join":
+                    self.join(player)
+                elif kind == "move":
+                    self.move(player, message, received)
+                elif kind == "stats":
+                    player.send(self.stats(player))
+                else:
+                    player.send({"type": "error", "message": f"unknown message type {kind!r}"})
+                await self._drain(player)
+        finally:
+            self.leave(player)
+            writer.close()
+
+    async def _drain(self, player):
+        """
+        Waits until the messages queued for player, and for their opponent,
+        have been handed to the network.
+        """
+        writers = [player.writer]
+        if player.match is not None:
+            writers.append(player.match.opponent(player).writer)
+        for writer in writers:
+            if not writer.is_closing():
+                try:
+                    await writer.drain()
+                except ConnectionError:
+                    pass
+
+    def join(self, player):
+        """
+        Puts player in the queue, or starts a match with the player waiting.
+        """
+        if player.match is not None and not player.match.rules.winner:
+            player.send({"type": "error", "message": "already playing"})
+            return
+        self._end_match(player)
+        if self._waiting is None or self._waiting is player:
+            self._waiting = player
+            return
+
+        black, red = self._waiting, player
+        self._waiting = None
+        match = Match(self._next_match, black, red)
+        self._next_match += 1
+        self.matches[match.number] = match
+        board = board_to_list(match.rules.board)
+        for color, member in match.players.items():
+            member.color = color
+            member.match = match
+            member.send({"type": "start", "match": match.number, "color": color,
+                         "board": board, "turn": match.rules.get_active_player()})
+
+    def move(self, player, message, received):
+        """
+        Checks and plays a move, then sends the result to both players.
+        """
+        match = player.match
+        if match is None:
+            player.send({"type": "error", "message": "not in a match"})
+            return
+        rules = match.rules
+        origin = _square(message.get("origin"))
+        destination = _square(message.get("destination"))
+        if origin is None or destination is None:
+            player.send({"type": "error", "message": "moves need an origin and a destination [x, y]"})
+            return
+
+        if rules.winner:
+            error = "the game is over"
+        elif rules.get_active_player() != player.color:
+            error = "not your turn"
+        elif rules.board.get(origin) != player.color:
+            error = "no pawn of yours on the origin square"
+        elif destination not in rules.test_move(origin):
+            error = "illegal move"
+        else:
+            error = None
+        if error:
+            player.send({"type": "error", "message": error})
+            return
+
+        undo = rules.play_move(origin, destination)
+        match.ply += 1
+        self.moves += 1
+        delta = {"type": "moved", "origin": list(origin), "destination": list(destination),
+                 "captured": [list(pos) for pos in undo.captured or ()],
+                 "turn": rules.get_active_player(), "winner": rules.winner,
+                 "ply": match.ply}
+        for member in match.players.values():
+            member.send(delta)
+
+        latency = time.perf_counter() - received
+        match.latencies.append(latency)
+        self.latencies.append(latency)
+        if rules.winner:
+            self.finished += 1
+
+    def leave(self, player):
+        """
+        Forgets a disconnected player and tells their opponent.
+        """
+        self.players.discard(player)
+        if self._waiting is player:
+            self._waiting = None
+        match = player.match
+        if match is not None:
+            opponent = match.opponent(player)
+            if not match.rules.winner:
+                opponent.send({"type": "left"})
+            self._end_match(player)
+
+    def _end_match(self, player):
+        """
+        Takes player's match, if any, off the server.
+        """
+        match = player.match
+        if match is None:
+            return
+        for member in match.players.values():
+            member.match = None
+        self.matches.pop(match.number, None)
+
+    def stats(self, player=None):
+        """
+        Returns the server's statistics as a message. Latencies are in milliseconds;
+        match_latency_ms_* are over each match's mean latency.
+        """
+        latencies = list(self.latencies)
+        means = [sum(match.latencies) / len(match.latencies)
+                 for match in self.matches.values() if match.latencies]
+        message = {
+                   "type": "stats",
+                   "pid": os.getpid(),
+                   "players": len(self.players),
+                   "matches": len(self.matches),
+                   "matches_started": self._next_match - 1,
+                   "matches_finished": self.finished,
+                   "moves": self.moves,
+                   "moves_per_sec": self.moves / (time.perf_counter() - self.started),
+                   "latency_ms_p50": 1000 * percentile(latencies, 0.5),
+                   "latency_ms_p95": 1000 * percentile(latencies, 0.95),
+                   "latency_ms_max": 1000 * max(latencies, default=0.0),
+                   "match_latency_ms_p50": 1000 * percentile(means, 0.5),
+                   "match_latency_ms_p95": 1000 * percentile(means, 0.95),
+                   "loop_lag_ms_max": 1000 * max(self.loop_lag, default=0.0),
+                  }
+        if player is not None and player.match is not None and player.match.latencies:
+            match = player.match
+            message["your_match_latency_ms"] = 1000 * sum(match.latencies) / len(match.latencies)
+        return message
+
+    async def watch_loop(self, interval=0.05):
+        """
+        Measures how much later than asked the event loop wakes up.
+        """
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(interval)
+            self.loop_lag.append(time.perf_counter() - start - interval)
+
+
+async def serve(host="127.0.0.1", port=DEFAULT_PORT, report=None, reuse_port=False):
+    """
+    Runs a GameServer until cancelled. With report, prints the statistics
+    every report seconds.
+    """
+    game_server = GameServer()
+    server = await asyncio.start_server(game_server.handle, host, port, limit=MAX_MESSAGE,
+                                        reuse_port=reuse_port or None)
+    watcher = asyncio.create_task(game_server.watch_loop())
+    print(f"process {os.getpid()} serving on {host}:{port}", flush=True)
+    try:
+        async with server:
+            if report:
+                while True:
+                    await asyncio.sleep(report)
+                    print(game_server.stats(), flush=True)
+            else:
+                await server.serve_forever()
+    finally:
+        watcher.cancel()
+
+
+def run(host, port, report, reuse_port=False):
+    """
+    Runs a server process until interrupted.
+    """
+    try:
+        asyncio.run(serve(host, port, report, reuse_port))
+    except KeyboardInterrupt:
+        pass
+
+
+def main():
+    """
+    Starts the server from the command line.
+    """
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--processes", type=int, default=1,
+                        help="server processes sharing the port; each hosts its own matches, "
+                             "so players are only paired with others on the same process")
+    parser.add_argument("--report", type=float, help="print statistics every this many seconds")
+    args = parser.parse_args()
+
+    if args.processes == 1:
+        run(args.host, args.port, args.report)
+        return
+    # the kernel spreads new connections over the processes
+    processes = [Process(target=run, args=(args.host, args.port, args.report, True))
+                 for _ in range(args.processes)]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.join()
+
+
+if __name__ == "__main__":
+    main()
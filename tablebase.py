@@ -0,0 +1,459 @@
+"""
+Contains an endgame tablebase generator and prober for Hasami Shogi.
+
+A game ends as soon as a side drops below two pawns, so endgames with only a
+few pawns left are common. For each material configuration (e.g. black 3
+against red 2) the generator works out, for every position, whether the side
+to move wins, loses or draws with best play, and how many plies it takes.
+
+Positions are numbered by a perfect index: the black pawns' squares and the
+red pawns' squares are ranked as combinations, then the side to move is
+added, so every index is a position and every position has one index. The
+results are stored one byte per position in a file that is memory-mapped
+for probing, so a probe is a few arithmetic operations and one byte read.
+
+The tables are built by retrograde analysis. First every position is
+scanned (on several processes) to find the moves that end the game or
+capture into an already solved smaller configuration. Then the results
+are spread backwards from the decided positions one ply at a time, by
+un-making moves, until nothing changes. Whatever is left is a draw.
+
+Pure Python is slow for this: 2v2 on the full 9x9 board has about 19
+million positions and 3v2 about 512 million, so smaller boards are
+supported for experiments, e.g.
+    python tablebase.py --size 5 --material 2v2 3v2 2v3
+"""
+import argparse
+import mmap
+import os
+import re
+import struct
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import combinations
+from math import comb
+
+import variants
+from rules import Rules
+
+MAGIC = b"HSTB"
+VERSION = 1
+# magic, version, rows, cols, black pawns, red pawns, 3 bytes reserved
+HEADER = struct.Struct("<4sBBBBB3x")
+
+# stored byte for a drawn position. Decided positions store plies + 1, where
+# plies is how long the game lasts with best play: the side to move wins when
+# it is odd (it makes the last move) and loses when it is even. Being left
+# without a legal move counts as losing straight away, as in ai.AlphaBeta.
+DRAW = 0
+MAX_PLIES = 254
+# degree of a position that can't be lost, in the generator
+BLOCKED = 255
+
+# the result of a probe: winner is 'BLACK', 'RED' or None for a draw,
+# plies is how many moves the game lasts with best play (0 for draws)
+Probe = namedtuple("Probe", "winner plies")
+
+
+def rules_class(rows, cols):
+    """
+    Returns a Rules class for a rows x cols board.
+    """
+    if (rows, cols) == (Rules.ROWS, Rules.COLS):
+        return Rules
+    return type(f"Rules{rows}x{cols}", (Rules,), {"VARIANT": variants.resized(rows, cols),
+                                                  "ROWS": rows, "COLS": cols})
+
+
+def table_name(rows, cols, black, red):
+    """
+    Returns the file name of the table for a material configuration.
+    """
+    return f"{rows}x{cols}_{black}v{red}.hstb"
+
+
+class PositionIndex:
+    """
+    The perfect index of the positions with black black pawns and red red
+    pawns on a rows x cols board.
+
+    Squares are numbered y * cols + x. The black squares are ranked as a
+    combination in colexicographic order, then the red squares the same way
+    among the squares black doesn't hold, and the index is
+    (black rank * red combinations + red rank) * 2 + side to move (0 black, 1 red).
+    """
+    def __init__(self, rows, cols, black, red):
+        self.rows = rows
+        self.cols = cols
+        self.black = black
+        self.red = red
+        squares = rows * cols
+        self._black_combinations = _combinations(squares, black)
+        self._red_combinations = _combinations(squares - black, red)
+        self.size = len(self._black_combinations) * len(self._red_combinations) * 2
+
+    def index(self, board, player):
+        """
+        Returns the index of a position given as a board dictionary and
+        the side to move.
+        """
+        cols = self.cols
+        blacks = sorted(y * cols + x for (x, y), color in board.items() if color == "BLACK")
+        reds = sorted(y * cols + x for (x, y), color in board.items() if color == "RED")
+        black_rank = sum(comb(square, n) for n, square in enumerate(blacks, 1))
+        # number the red squares as if black's squares weren't there
+        red_rank = sum(comb(square - sum(black < square for black in blacks), n)
+                       for n, square in enumerate(reds, 1))
+        return (black_rank * len(self._red_combinations) + red_rank) * 2 + (player == "RED")
+
+    def position(self, index):
+        """
+        Returns (board, player) for an index.
+        """
+        rest, side = divmod(index, 2)
+        black_rank, red_rank = divmod(rest, len(self._red_combinations))
+        blacks = self._black_combinations[black_rank]
+        free = [square for square in range(self.rows * self.cols) if square not in blacks]
+        cols = self.cols
+        board = {(square % cols, square // cols): "BLACK" for square in blacks}
+        for square in self._red_combinations[red_rank]:
+            square = free[square]
+            board[ (square % cols, square // cols) ] = "RED"
+        return board, ("RED" if side else "BLACK")
+
+
+@lru_cache(maxsize=None)
+def _combinations(n, k):
+    """
+    Returns every k-combination of range(n) in colexicographic order,
+    so the rank of combination c is sum(comb(c[i], i + 1)).
+    """
+    return sorted(combinations(range(n), k), key=lambda combination: combination[::-1])
+
+
+class Tablebase:
+    """
+    One memory-mapped table, for a single material configuration.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, rows, cols, black, red = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} tablebase")
+        self.index = PositionIndex(rows, cols, black, red)
+        if len(self._map) != HEADER.size + self.index.size:
+            raise ValueError(f"{path} is truncated")
+
+    def probe_index(self, index):
+        """
+        Returns the stored byte for a position index.
+        """
+        return self._map[HEADER.size + index]
+
+    def probe(self, board, player):
+        """
+        Returns a Probe for a position with this table's material.
+        """
+        value = self.probe_index(self.index.index(board, player))
+        if value == DRAW:
+            return Probe(None, 0)
+        plies = value - 1
+        if plies % 2:
+            return Probe(player, plies)
+        return Probe("RED" if player == "BLACK" else "BLACK", plies)
+
+    def close(self):
+        """
+        Closes the file.
+        """
+        self._map.close()
+        self._file.close()
+
+
+class TablebaseSet:
+    """
+    Every table in a directory, opened as they are first needed.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self._tables = {}
+        # material configurations with a table: (rows, cols) -> {(black, red)}
+        self.available = {}
+        for name in os.listdir(directory):
+            match = re.fullmatch(r"(\d+)x(\d+)_(\d+)v(\d+)\.hstb", name)
+            if match:
+                rows, cols, black, red = map(int, match.groups())
+                self.available.setdefault( (rows, cols), set() ).add( (black, red) )
+        # the most pawns in any table, to skip positions cheaply
+        self.max_pieces = max((black + red for tables in self.available.values()
+                               for black, red in tables), default=0)
+
+    def table(self, rows, cols, black, red):
+        """
+        Returns the Tablebase for a material configuration, or None if there isn't one.
+        """
+        if (black, red) not in self.available.get( (rows, cols), () ):
+            return None
+        key = (rows, cols, black, red)
+        if key not in self._tables:
+            self._tables[key] = Tablebase(os.path.join(self.directory, table_name(*key)))
+        return self._tables[key]
+
+    def probe(self, game):
+        """
+        Returns a Probe for the position in a rules object, or None if it
+        isn't covered by any table. Finished games aren't covered.
+        """
+        black = game.get_pieces_remaining("BLACK")
+        red = game.get_pieces_remaining("RED")
+        if black + red > self.max_pieces or game.winner or \
+           not variants.plays_standard_rules(game.VARIANT):
+            return None
+        table = self.table(game.ROWS, game.COLS, black, red)
+        if table is None:
+            return None
+        return table.probe(game.board, game.get_active_player())
+
+    def close(self):
+        """
+        Closes every open table.
+        """
+        for table in self._tables.values():
+            table.close()
+        self._tables = {}
+
+
+# the smaller tables each worker process has open, by path
+_worker_tables = {}
+
+
+def _child_value(directory, rows, cols, black, red, board, player):
+    """
+    Returns the stored byte of a position in an already built smaller table.
+    """
+    path = os.path.join(directory, table_name(rows, cols, black, red))
+    if path not in _worker_tables:
+        _worker_tables[path] = Tablebase(path)
+    table = _worker_tables[path]
+    return table.probe_index(table.index.index(board, player))
+
+
+def scan(directory, rows, cols, black, red, start, stop):
+    """
+    The first pass of the generator, run by the worker processes.
+    Plays every move from positions start to stop - 1 and returns three
+    byte strings with an entry per position:
+
+    wins: the stored value of the quickest win through a move that ends the
+        game or captures into a smaller table, or 0 for none
+    losses: the stored value of the slowest loss through such moves
+        (a position without any legal move is lost straight away)
+    degrees: how many moves stay within this table, or BLOCKED when the
+        position can't be lost because it has a winning or drawing move
+    """
+    index = PositionIndex(rows, cols, black, red)
+    game = rules_class(rows, cols)()
+    wins = bytearray(stop - start)
+    losses = bytearray(stop - start)
+    degrees = bytearray(stop - start)
+
+    for n, position in enumerate(range(start, stop)):
+        board, player = index.position(position)
+        game.set_position(board, player)
+        win = degree = 0
+        # no legal moves at all is a loss in 0 plies
+        loss = 1
+        blocked = False
+        for move in list(game.legal_moves()):
+            undo = game.make_move(*move)
+            if game.winner:
+                # plies 1, the quickest win there is
+                game.unmake_move(undo)
+                win, blocked = 2, True
+                break
+            if undo.captured:
+                child = _child_value(directory, rows, cols,
+                                     game.get_pieces_remaining("BLACK"),
+                                     game.get_pieces_remaining("RED"),
+                                     game.board, game.get_active_player())
+                # one ply longer than the game from the child position
+                value = child + 1
+                if child == DRAW:
+                    blocked = True
+                elif child % 2:
+                    # plies even: the opponent loses from there
+                    blocked = True
+                    win = min(win, value) if win else value
+                else:
+                    loss = max(loss, value)
+            else:
+                degree += 1
+            game.unmake_move(undo)
+        wins[n] = win
+        losses[n] = loss
+        degrees[n] = BLOCKED if blocked else degree
+    return bytes(wins), bytes(losses), bytes(degrees)
+
+
+def predecessors(game, index, board, player):
+    """
+    Yields the indices of the positions in the same table that lead to
+    (board, player) by a move that captures nothing. game is a scratch
+    rules object for the same board size.
+    """
+    mover = "RED" if player == "BLACK" else "BLACK"
+    # with mover to move, check_captures says what a pawn arriving on a square captures
+    game.set_position(board, mover)
+    rays = game._tables.rays
+    for square, color in board.items():
+        if color != mover or game.check_captures(square):
+            continue
+        for ray in rays[square]:
+            for origin in ray:
+                if origin in board:
+                    break
+                previous = dict(board)
+                del previous[square]
+                previous[origin] = mover
+                yield index.index(previous, mover)
+
+
+def generate(directory, rows, cols, black, red, workers=None, chunks_per_worker=8):
+    """
+    Builds the table for black black pawns against red red pawns on a rows x
+    cols board and writes it to directory. The tables it captures into must
+    already be there. Returns a dictionary of statistics.
+    """
+    start_time = time.perf_counter()
+    index = PositionIndex(rows, cols, black, red)
+    size = index.size
+
+    # first pass: every position's moves, spread over the worker processes
+    workers = workers or os.cpu_count() or 1
+    step = max(1, -(-size // (workers * chunks_per_worker)))
+    ranges = [(start, min(start + step, size)) for start in range(0, size, step)]
+    wins, losses, degrees = bytearray(), bytearray(), bytearray()
+    if workers == 1:
+        results = (scan(directory, rows, cols, black, red, start, stop) for start, stop in ranges)
+    else:
+        pool = ProcessPoolExecutor(workers)
+        results = pool.map(scan, *zip(*[(directory, rows, cols, black, red, start, stop)
+                                        for start, stop in ranges]))
+    try:
+        for chunk_wins, chunk_losses, chunk_degrees in results:
+            wins += chunk_wins
+            losses += chunk_losses
+            degrees += chunk_degrees
+    finally:
+        if workers != 1:
+            pool.shutdown()
+    scan_time = time.perf_counter() - start_time
+
+    # positions waiting to be decided, by stored value. A position can be
+    # queued more than once; only the first (quickest) value counts
+    pending = {}
+    for position in range(size):
+        if wins[position]:
+            pending.setdefault(wins[position], []).append(position)
+        elif degrees[position] == 0:
+            pending.setdefault(losses[position], []).append(position)
+
+    # retrograde pass: decide the positions one ply length at a time, and
+    # pass each result back to the positions that can move into it
+    values = bytearray(size)
+    game = rules_class(rows, cols)()
+    while pending:
+        value = min(pending)
+        if value > MAX_PLIES + 1:
+            raise ValueError(f"a game lasts longer than {MAX_PLIES} plies")
+        decided = []
+        for position in pending.pop(value):
+            if not values[position]:
+                values[position] = value
+                decided.append(position)
+        for position in decided:
+            board, player = index.position(position)
+            for previous in predecessors(game, index, board, player):
+                if values[previous]:
+                    continue
+                if value % 2:
+                    # position is lost for its side to move, so previous wins by moving there
+                    pending.setdefault(value + 1, []).append(previous)
+                elif degrees[previous] != BLOCKED:
+                    # position is won: one less way out for previous
+                    degrees[previous] -= 1
+                    losses[previous] = max(losses[previous], value + 1)
+                    if not degrees[previous]:
+                        pending.setdefault(losses[previous], []).append(previous)
+
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, table_name(rows, cols, black, red))
+    with open(path, "wb") as file:
+        file.write(HEADER.pack(MAGIC, VERSION, rows, cols, black, red))
+        file.write(values)
+
+    elapsed = time.perf_counter() - start_time
+    decided = [value for value in values if value]
+    return {
+            "positions": size,
+            "wins": sum(1 for value in decided if (value - 1) % 2),
+            "losses": sum(1 for value in decided if not (value - 1) % 2),
+            "draws": size - len(decided),
+            "longest_plies": max(decided, default=1) - 1,
+            "scan_seconds": scan_time,
+            "seconds": elapsed,
+            "positions_per_sec": size / elapsed,
+           }
+
+
+def dependencies(black, red):
+    """
+    Returns the material configurations (black, red) needs, smallest first,
+    ending with (black, red) itself. Sides with fewer than two pawns have
+    lost, so they don't need tables.
+    """
+    needed = {(b, r) for b in range(2, black + 1) for r in range(2, red + 1)}
+    return sorted(needed, key=lambda material: (sum(material), material))
+
+
+def main():
+    """
+    Builds tables from the command line.
+    """
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=5, help="rows and columns of the board")
+    parser.add_argument("--material", nargs="+", default=["2v2"],
+                        help="configurations to build as BLACKvRED, e.g. 2v2 3v2")
+    parser.add_argument("--dir", default="tablebases", help="directory for the tables")
+    parser.add_argument("--workers", type=int, help="processes for the first pass "
+                                                    "(default: one per core)")
+    args = parser.parse_args()
+
+    todo = []
+    for material in args.material:
+        match = re.fullmatch(r"(\d+)v(\d+)", material)
+        if not match:
+            parser.error(f"material must look like 3v2, not {material!r}")
+        for needed in dependencies(*map(int, match.groups())):
+            if needed not in todo:
+                todo.append(needed)
+    todo.sort(key=lambda material: (sum(material), material))
+
+    for black, red in todo:
+        path = os.path.join(args.dir, table_name(args.size, args.size, black, red))
+        if os.path.exists(path):
+            print(f"{black}v{red}: already built")
+            continue
+        stats = generate(args.dir, args.size, args.size, black, red, args.workers)
+        print(f"{black}v{red}: " + ", ".join(
+            f"{name} {value:,.1f}" if isinstance(value, float) else f"{name} {value:,}"
+            for name, value in stats.items()))
+
+
+if __name__ == "__main__":
+    main()
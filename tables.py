@@ -0,0 +1,75 @@
+"""
+Contains lookup tables for the rules engine.
+The rays a pawn can slide along, the corner capture patterns and each
+square's neighbours only depend on the size of the board, so they are
+built once per board size on first use and then shared by every game.
+"""
+from functools import lru_cache
+
+# directions are ordered up, down, left, right, matching check_captures
+DIRECTIONS = ( (0, -1), (0, 1), (-1, 0), (1, 0) )
+# the four lines through a square (across, down and the two diagonals),
+# each as its two opposite directions
+LINE_DIRECTIONS = ( ( (1, 0), (-1, 0) ), ( (0, 1), (0, -1) ),
+                    ( (1, 1), (-1, -1) ), ( (1, -1), (-1, 1) ) )
+
+
+class BoardTables:
+    """
+    Precomputed tables for a board of the given size. Positions are (x, y)
+    tuples as used by Rules.board.
+
+    rays: position -> a tuple of four rays (up, down, left, right), each
+        a tuple of the positions from next to the square out to the edge
+    corner_caps: position -> (partner, corner) for the eight squares next
+        to a corner. A pawn moving onto the square while its own side holds
+        partner captures an opponent pawn sitting in corner.
+    neighbours: position -> tuple of the orthogonally adjacent positions
+    lines: position -> for each of the four lines through the square, a pair
+        of rays going out from it in opposite directions, for finding pawns
+        in a row
+    """
+    def __init__(self, rows, cols):
+        self.rows = rows
+        self.cols = cols
+        self.positions = tuple( (x, y) for y in range(rows) for x in range(cols) )
+
+        self.rays = {}
+        self.neighbours = {}
+        self.lines = {}
+        for pos in self.positions:
+            rays = tuple(self._ray(pos, direction) for direction in DIRECTIONS)
+            self.rays[pos] = rays
+            self.neighbours[pos] = tuple(ray[0] for ray in rays if ray)
+            self.lines[pos] = tuple( (self._ray(pos, forward), self._ray(pos, backward))
+                                     for forward, backward in LINE_DIRECTIONS )
+
+        right, bottom = cols - 1, rows - 1
+        self.corner_caps = {}
+        for first, second, corner in ( ( (0, 1), (1, 0), (0, 0) ),
+                                       ( (right - 1, 0), (right, 1), (right, 0) ),
+                                       ( (0, bottom - 1), (1, bottom), (0, bottom) ),
+                                       ( (right - 1, bottom), (right, bottom - 1), (right, bottom) ) ):
+            self.corner_caps[first] = (second, corner)
+            self.corner_caps[second] = (first, corner)
+
+    def _ray(self, pos, direction):
+        """
+        Returns the positions from next to pos out to the edge of the board in direction.
+        """
+        (x, y), (dx, dy) = pos, direction
+        ray = []
+        n = 1
+        while 0 <= x + dx * n < self.cols and 0 <= y + dy * n < self.rows:
+            ray.append( (x + dx * n, y + dy * n) )
+            n += 1
+        return tuple(ray)
+
+
+@lru_cache(maxsize=None)
+def get_tables(rows, cols):
+    """
+    Returns the BoardTables for a rows x cols board, building them the
+    first time they are asked for.
+    """
+    return BoardTables(rows, cols)
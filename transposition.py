@@ -0,0 +1,129 @@
+"""
+Contains a fixed size transposition table keyed by Zobrist keys.
+Used to cache search results for positions that are reached more than once.
+"""
+from array import array
+from collections import namedtuple
+
+# what a stored value means relative to the true value of the position
+EXACT, LOWER, UPPER = 0, 1, 2
+
+Entry = namedtuple("Entry", "depth value flag move")
+
+
+def encode_move(move):
+    """
+    Packs an ((x, y), (x, y)) move into a 32 bit code, one byte per
+    coordinate, or 0 for no move. (0, 0) to (0, 0) is never a legal move,
+    so 0 can't be mistaken for one.
+    """
+    if move is None:
+        return 0
+    (x1, y1), (x2, y2) = move
+    return x1 << 24 | y1 << 16 | x2 << 8 | y2
+
+
+def decode_move(code):
+    """
+    Unpacks a move code from encode_move, returning None for 0.
+    """
+    if not code:
+        return None
+    return ( (code >> 24, (code >> 16) & 0xFF), ((code >> 8) & 0xFF, code & 0xFF) )
+
+
+class TranspositionTable:
+    """
+    A hash table with a fixed number of buckets that never grows.
+    Each bucket has two slots: a depth-preferred slot which is only replaced
+    by an entry searched at least as deep (or left over from an older search),
+    and an always-replace slot that takes everything else.
+
+    Keys, depths, values, flags and moves (packed by encode_move) are kept in
+    flat arrays so that the memory used is close to the size asked for.
+    Counts hits, misses and collisions (a probe finding another position's
+    entry in the bucket) so table sizes can be tuned.
+    """
+    # approximate bytes used by one slot across all the arrays
+    SLOT_BYTES = 8 + 1 + 4 + 1 + 1 + 4
+
+    def __init__(self, megabytes=16):
+        # round the bucket count down to a power of two so the index is a mask
+        buckets = max(1, int(megabytes * 1024 * 1024) // (2 * self.SLOT_BYTES))
+        self.buckets = 1 << (buckets.bit_length() - 1)
+        self._mask = self.buckets - 1
+        self.clear()
+
+    def clear(self):
+        """
+        Empties the table and resets its counters.
+        """
+        slots = 2 * self.buckets
+        self._keys = array("Q", bytes(8 * slots))
+        # depth -1 marks an empty slot
+        self._depths = array("b", [-1]) * slots
+        self._values = array("i", bytes(4 * slots))
+        self._flags = array("B", bytes(slots))
+        self._ages = array("B", bytes(slots))
+        self._moves = array("I", bytes(4 * slots))
+        self._age = 0
+        self.hits = 0
+        self.misses = 0
+        self.collisions = 0
+
+    def new_search(self):
+        """
+        Marks the start of a new search so entries left over from earlier
+        searches can be replaced in the depth-preferred slots.
+        """
+        self._age = (self._age + 1) & 0xFF
+
+    def probe(self, key):
+        """
+        Returns the Entry stored for key, or None.
+        """
+        slot = (key & self._mask) << 1
+        for index in (slot, slot + 1):
+            if self._keys[index] == key and self._depths[index] >= 0:
+                self.hits += 1
+                return Entry(self._depths[index], self._values[index],
+                             self._flags[index], decode_move(self._moves[index]))
+
+        self.misses += 1
+        if self._depths[slot] >= 0 or self._depths[slot + 1] >= 0:
+            self.collisions += 1
+        return None
+
+    def store(self, key, depth, value, flag, move=None):
+        """
+        Stores a search result for key, choosing a slot by the replacement policy.
+        """
+        slot = (key & self._mask) << 1
+        depths = self._depths
+        # use the depth-preferred slot if it is empty, stale, holds this same position,
+        # or holds a shallower search. otherwise fall back on the always-replace slot
+        if not (depths[slot] < 0 or self._ages[slot] != self._age
+                or self._keys[slot] == key or depth >= depths[slot]):
+            slot += 1
+
+        self._keys[slot] = key
+        depths[slot] = min(depth, 127)
+        self._values[slot] = value
+        self._flags[slot] = flag
+        self._ages[slot] = self._age
+        self._moves[slot] = encode_move(move)
+
+    def stats(self):
+        """
+        Returns a dictionary of the table's counters.
+        """
+        probes = self.hits + self.misses
+        used = sum(1 for depth in self._depths if depth >= 0)
+        return {
+                "buckets": self.buckets,
+                "hits": self.hits,
+                "misses": self.misses,
+                "collisions": self.collisions,
+                "hit_rate": self.hits / probes if probes else 0.0,
+                "fill": used / len(self._depths),
+               }
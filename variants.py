@@ -0,0 +1,64 @@
+"""
+Contains the variants of Hasami Shogi the rules engine can play.
+
+A variant is plain data: the board size, how many rows each side fills at
+the start, how a game is won and which captures and moves are allowed.
+rules.Rules takes a variant and builds its move and capture tables for
+that board size (tables.py), so nothing else needs to know the size.
+
+    rows, cols        board size
+    start_rows        rows each side fills at the start, red from the top
+                      and black from the bottom. These rows are also the
+                      side's camp
+    min_pieces        a side left with fewer pawns than this loses
+    line              a side wins by getting this many pawns in a row
+                      (across, down or diagonally) with none in its own
+                      camp; 0 for no such win
+    corner_captures   whether a pawn in a corner can be captured by
+                      holding the two squares next to it
+    jumps             whether a pawn may also jump over a pawn next to it
+                      onto the empty square beyond
+"""
+from collections import namedtuple
+
+Variant = namedtuple("Variant", "name rows cols start_rows min_pieces line corner_captures jumps")
+
+# variant 1, the game this project started with
+STANDARD = Variant("hasami", 9, 9, 1, 2, 0, True, False)
+
+# Dai Hasami Shogi: two rows each, pawns can jump, and five in a row outside
+# your own camp wins. A side with fewer than five pawns can't make a line
+DAI = Variant("dai", 9, 9, 2, 5, 5, True, True)
+
+# variant 1 on bigger boards, to stress the engine
+LARGE = STANDARD._replace(name="13x13", rows=13, cols=13)
+HUGE = STANDARD._replace(name="19x19", rows=19, cols=19)
+
+VARIANTS = {variant.name: variant for variant in (STANDARD, DAI, LARGE, HUGE)}
+
+
+def get_variant(name):
+    """
+    Returns the variant called name. Raises ValueError for unknown names.
+    """
+    try:
+        return VARIANTS[name]
+    except KeyError:
+        raise ValueError(f"unknown variant {name!r}; choose from {', '.join(VARIANTS)}") from None
+
+
+def resized(rows, cols, variant=STANDARD):
+    """
+    Returns variant played on a rows x cols board.
+    """
+    if (rows, cols) == (variant.rows, variant.cols):
+        return variant
+    return variant._replace(name=f"{variant.name}-{rows}x{cols}", rows=rows, cols=cols)
+
+
+def plays_standard_rules(variant):
+    """
+    Returns True if variant plays the rules of variant 1, whatever its board
+    size. Tables and books built for variant 1 only apply to these.
+    """
+    return variant._replace(name=STANDARD.name, rows=STANDARD.rows, cols=STANDARD.cols) == STANDARD
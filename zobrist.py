@@ -0,0 +1,48 @@
+"""
+Contains Zobrist hashing for Hasami Shogi positions.
+Every (colour, square) pair gets a random 64 bit key and a position's key is
+the XOR of the keys of its pawns, plus one more key when it is black's turn.
+Moving a pawn or capturing one only XORs a couple of keys in or out, so the
+rules engine can keep the key up to date in O(1) per move.
+"""
+import random
+from functools import lru_cache
+
+# fixed seed so keys are the same from run to run, e.g. for stored tables
+SEED = 0x4A5A
+
+
+class ZobristKeys:
+    """
+    The random keys for a board of the given size.
+
+    pieces: colour -> position -> key
+    black_to_move: XOR'd into the key whenever it is black's turn
+    """
+    def __init__(self, rows, cols):
+        rng = random.Random(SEED ^ (rows << 8) ^ cols)
+        self.pieces = {}
+        for color in ("BLACK", "RED"):
+            self.pieces[color] = {(x, y): rng.getrandbits(64)
+                                  for y in range(rows) for x in range(cols)}
+        self.black_to_move = rng.getrandbits(64)
+
+    def compute(self, board, active_player):
+        """
+        Returns the key of a position from scratch.
+        """
+        key = 0
+        for pos, color in board.items():
+            key ^= self.pieces[color][pos]
+        if active_player == "BLACK":
+            key ^= self.black_to_move
+        return key
+
+
+@lru_cache(maxsize=None)
+def get_keys(rows, cols):
+    """
+    Returns the ZobristKeys for a rows x cols board, generating them the first
+    time they are asked for.
+    """
+    return ZobristKeys(rows, cols)